@@ -1,7 +1,7 @@
 # apps/pokemon/admin.py
 
 from django.contrib import admin
-from .models import Pokemon, FavoritePokemon
+from .models import Pokemon, FavoritePokemon, Move, Ability
 
 
 @admin.register(Pokemon)
@@ -9,7 +9,7 @@ class PokemonAdmin(admin.ModelAdmin):
     list_display = ['name', 'type_primary', 'type_secondary', 'source', 'created_at']
     list_filter = ['source', 'type_primary', 'created_at']
     search_fields = ['name', 'type_primary', 'type_secondary']
-    readonly_fields = ['created_at']
+    readonly_fields = ['created_at', 'updated_at']
 
 
 @admin.register(FavoritePokemon)
@@ -19,3 +19,14 @@ class FavoritePokemonAdmin(admin.ModelAdmin):
     search_fields = ['user__username', 'pokemon__name']
     readonly_fields = ['created_at']
 
+
+@admin.register(Move)
+class MoveAdmin(admin.ModelAdmin):
+    list_display = ['name']
+    search_fields = ['name']
+
+
+@admin.register(Ability)
+class AbilityAdmin(admin.ModelAdmin):
+    list_display = ['name']
+    search_fields = ['name']
@@ -6,4 +6,7 @@ from django.apps import AppConfig
 class PokemonConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'apps.pokemon'
+    
+    def ready(self):
+        from . import signals  # noqa: F401
 
@@ -0,0 +1,84 @@
+# apps/pokemon/broadcast.py
+
+# Pushes committed Pokemon writes to the "map" channel group as coalesced batches
+import json
+import threading
+from contextlib import contextmanager
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.db import transaction
+from .mapdata import MAP_FIELDS
+
+MAP_GROUP = 'pokemon_map'
+
+def map_event_fields(pokemon):
+    """Compact per-Pokemon payload, the same fields the map reads"""
+    return {field: getattr(pokemon, field) for field in MAP_FIELDS}
+
+class MapBroadcaster:
+    """Collects upserts/deletions per thread and sends them to MAP_GROUP after commit
+
+    Events are staged only once their transaction commits and coalesced per Pokemon id
+    (last write wins). Inside batch() the flush waits until the outermost batch exits;
+    MapBroadcastMiddleware wraps every request in one, so a request sends at most one
+    message however many rows it writes. Outside a batch each commit flushes on its own.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def _state(self):
+        if not hasattr(self._local, 'pending'):
+            self._local.pending = {}
+            self._local.depth = 0
+        return self._local
+
+    def record_upserts(self, pokemon_list):
+        events = [(pokemon.pk, map_event_fields(pokemon)) for pokemon in pokemon_list if pokemon.pk]
+        if events:
+            transaction.on_commit(lambda: self._stage(events))
+
+    def record_deletions(self, pokemon_ids):
+        events = [(pokemon_id, None) for pokemon_id in pokemon_ids]
+        if events:
+            transaction.on_commit(lambda: self._stage(events))
+
+    @contextmanager
+    def batch(self):
+        state = self._state()
+        state.depth += 1
+        try:
+            yield
+        finally:
+            state.depth -= 1
+            if state.depth == 0:
+                self.flush()
+
+    def _stage(self, events):
+        state = self._state()
+        state.pending.update(events)
+        if state.depth == 0:
+            self.flush()
+
+    def flush(self):
+        state = self._state()
+        if not state.pending:
+            return
+        pending, state.pending = state.pending, {}
+
+        channel_layer = get_channel_layer()
+        if channel_layer is None:
+            return
+        # serialized once here, consumers forward the text as-is to every socket
+        text = json.dumps({
+            'type': 'changes',
+            'upserts': [fields for fields in pending.values() if fields is not None],
+            'deletions': [pokemon_id for pokemon_id, fields in pending.items() if fields is None],
+        })
+        try:
+            async_to_sync(channel_layer.group_send)(MAP_GROUP, {'type': 'map.changes', 'text': text})
+        except Exception as e:
+            # live updates are best effort, never fail the write that triggered them
+            print(f"Error broadcasting map changes: {e}")
+
+map_broadcaster = MapBroadcaster()
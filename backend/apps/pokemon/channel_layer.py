@@ -0,0 +1,306 @@
+# apps/pokemon/channel_layer.py
+
+# Channel layer shared by several local worker processes through one SQLite file (no broker)
+import asyncio
+import json
+import os
+import random
+import sqlite3
+import string
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS channel_messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    channel TEXT NOT NULL,
+    process TEXT NOT NULL,
+    expires REAL NOT NULL,
+    body TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS channel_messages_channel_idx ON channel_messages (channel, id);
+CREATE INDEX IF NOT EXISTS channel_messages_process_idx ON channel_messages (process, id);
+CREATE INDEX IF NOT EXISTS channel_messages_expires_idx ON channel_messages (expires);
+CREATE TABLE IF NOT EXISTS channel_groups (
+    grp TEXT NOT NULL,
+    channel TEXT NOT NULL,
+    joined REAL NOT NULL,
+    PRIMARY KEY (grp, channel)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS channel_groups_channel_idx ON channel_groups (channel);
+"""
+
+def channel_process(channel):
+    """Process part of a specific channel name ("<prefix>.<process>!<id>"), '' for general channels"""
+    bang = channel.find('!')
+    if bang == -1:
+        return ''
+    return channel[channel.rfind('.', 0, bang) + 1:bang]
+
+class SQLiteChannelLayer(BaseChannelLayer):
+    """Channel layer backed by a SQLite database in WAL mode
+
+    Every worker process points at the same file: sends and group sends insert rows, receivers
+    delete them. Process-specific channels (the ones new_channel() hands to consumers) are
+    drained by one poller per process, which fetches everything addressed to this process in
+    one query and dispatches it to local queues, so the polling cost does not grow with the
+    number of sockets. Polling backs off from poll_interval to max_poll_interval while idle.
+    A local queue whose channel has had no receive() waiting for `expiry` seconds (its consumer
+    is gone) is dropped along with what it holds, so reconnect churn doesn't pile them up.
+
+    Messages must be JSON serializable. Capacity, expiry and group expiry behave like
+    InMemoryChannelLayer: a full channel raises ChannelFull on send() and is skipped by
+    group_send(), and a channel with an expired message is removed from its groups.
+    """
+
+    extensions = ['groups', 'flush']
+
+    def __init__(self, path, expiry=60, group_expiry=86400, capacity=100, channel_capacity=None,
+                 poll_interval=0.002, max_poll_interval=0.05, **kwargs):
+        super().__init__(expiry=expiry, capacity=capacity, channel_capacity=channel_capacity, **kwargs)
+        self.path = path
+        self.group_expiry = group_expiry
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.client_prefix = uuid.uuid4().hex[:12]
+        # sqlite3 connections are used from the single executor thread only
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sqlite-channel-layer')
+        self._local = threading.local()
+        self._loop = None
+        self._queues = {}
+        # receive() calls waiting per channel, and since when channels have had none
+        self._waiting = {}
+        self._idle = {}
+        self._poller = None
+        self._last_cleanup = 0.0
+
+    # Database helpers (executor thread)
+
+    def _connection(self):
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            if not os.path.exists(self.path):
+                # messages can carry user data, keep the file private to this account
+                os.close(os.open(self.path, os.O_CREAT | os.O_WRONLY, 0o600))
+            db = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            db.executescript(SCHEMA)
+            self._local.db = db
+        return db
+
+    async def _run(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, function, *args)
+
+    def _insert(self, channels, body, expires):
+        db = self._connection()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            placeholders = ','.join('?' * len(channels))
+            counts = dict(db.execute(
+                f'SELECT channel, COUNT(*) FROM channel_messages WHERE channel IN ({placeholders}) GROUP BY channel',
+                channels,
+            ).fetchall())
+            accepted = [channel for channel in channels if counts.get(channel, 0) < self.get_capacity(channel)]
+            db.executemany(
+                'INSERT INTO channel_messages (channel, process, expires, body) VALUES (?, ?, ?, ?)',
+                [(channel, channel_process(channel), expires, body) for channel in accepted],
+            )
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        return accepted
+
+    def _pop(self, channel, now):
+        row = self._connection().execute(
+            'DELETE FROM channel_messages WHERE id = ('
+            'SELECT id FROM channel_messages WHERE channel = ? AND expires >= ? ORDER BY id LIMIT 1'
+            ') RETURNING body',
+            (channel, now),
+        ).fetchone()
+        return row[0] if row else None
+
+    def _cleanup(self, now):
+        db = self._connection()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            db.execute(
+                'DELETE FROM channel_groups WHERE channel IN (SELECT channel FROM channel_messages WHERE expires < ?)',
+                (now,),
+            )
+            db.execute('DELETE FROM channel_messages WHERE expires < ?', (now,))
+            db.execute('DELETE FROM channel_groups WHERE joined < ?', (now - self.group_expiry,))
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+
+    def _execute(self, sql, params=()):
+        self._connection().execute(sql, params)
+
+    def _group_channels(self, group, now):
+        return [row[0] for row in self._connection().execute(
+            'SELECT channel FROM channel_groups WHERE grp = ? AND joined >= ?', (group, now - self.group_expiry),
+        )]
+
+    def _close_connection(self):
+        db = getattr(self._local, 'db', None)
+        if db is not None:
+            db.close()
+            self._local.db = None
+
+    async def _maybe_cleanup(self):
+        now = time.time()
+        if now - self._last_cleanup >= 1.0:
+            self._last_cleanup = now
+            self._drop_abandoned_queues()
+            await self._run(self._cleanup, now)
+
+    # Channel layer API
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), 'message is not a dict'
+        self.require_valid_channel_name(channel)
+        assert '__asgi_channel__' not in message
+        accepted = await self._run(self._insert, [channel], json.dumps(message), time.time() + self.expiry)
+        if not accepted:
+            raise ChannelFull(channel)
+
+    async def receive(self, channel):
+        self.require_valid_channel_name(channel)
+        if '!' in channel:
+            if channel_process(channel) != self.client_prefix:
+                raise ValueError(f'{channel} is a specific channel of another process')
+            queue = self._local_queue(channel)
+            self._waiting[channel] = self._waiting.get(channel, 0) + 1
+            self._idle.pop(channel, None)
+            try:
+                return await queue.get()
+            finally:
+                waiting = self._waiting.pop(channel, 0) - 1
+                if waiting > 0:
+                    self._waiting[channel] = waiting
+                else:
+                    self._idle[channel] = time.monotonic()
+
+        delay = self.poll_interval
+        while True:
+            await self._maybe_cleanup()
+            body = await self._run(self._pop, channel, time.time())
+            if body is not None:
+                return json.loads(body)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.max_poll_interval)
+
+    async def new_channel(self, prefix='specific.'):
+        return '%s.%s!%s' % (prefix, self.client_prefix, ''.join(random.choice(string.ascii_letters) for i in range(12)))
+
+    def _local_queue(self, channel):
+        """Queue for one of our specific channels, starting this loop's poller if needed"""
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # tasks and queues belong to one event loop, start over on a new one
+            self._loop = loop
+            self._queues = {}
+            self._waiting = {}
+            self._idle = {}
+            self._poller = None
+        if self._poller is None or self._poller.done():
+            self._poller = loop.create_task(self._poll_process_channels())
+        return self._queue(channel)
+
+    def _queue(self, channel):
+        queue = self._queues.get(channel)
+        if queue is None:
+            queue = self._queues[channel] = asyncio.Queue(maxsize=self.get_capacity(channel))
+            # a message can arrive before the consumer's first receive()
+            self._idle[channel] = time.monotonic()
+        return queue
+
+    def _drop_abandoned_queues(self):
+        cutoff = time.monotonic() - self.expiry
+        for channel, since in list(self._idle.items()):
+            if since < cutoff:
+                del self._idle[channel]
+                self._queues.pop(channel, None)
+
+    async def _poll_process_channels(self):
+        delay = self.poll_interval
+        while True:
+            await self._maybe_cleanup()
+            messages = await self._run(self._poll_batch)
+            for channel, body in messages:
+                queue = self._queue(channel)
+                try:
+                    queue.put_nowait(json.loads(body))
+                except asyncio.QueueFull:
+                    # same as a full channel at send time: the message is dropped
+                    pass
+            if messages:
+                delay = self.poll_interval
+            else:
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.max_poll_interval)
+
+    def _poll_batch(self):
+        """Take every live message addressed to this process's specific channels"""
+        db = self._connection()
+        # a plain read first, idle polls should not take the write lock
+        if db.execute('SELECT 1 FROM channel_messages WHERE process = ? LIMIT 1', (self.client_prefix,)).fetchone() is None:
+            return []
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            rows = db.execute(
+                'DELETE FROM channel_messages WHERE process = ? AND expires >= ? RETURNING id, channel, body',
+                (self.client_prefix, time.time()),
+            ).fetchall()
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        rows.sort()
+        return [(channel, body) for _, channel, body in rows]
+
+    # Flush extension
+
+    async def flush(self):
+        await self._run(self._execute, 'DELETE FROM channel_messages')
+        await self._run(self._execute, 'DELETE FROM channel_groups')
+        self._queues = {}
+        self._waiting = {}
+        self._idle = {}
+
+    async def close(self):
+        if self._poller is not None:
+            self._poller.cancel()
+            self._poller = None
+        await self._run(self._close_connection)
+
+    # Groups extension
+
+    async def group_add(self, group, channel):
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        await self._run(
+            self._execute,
+            'INSERT OR REPLACE INTO channel_groups (grp, channel, joined) VALUES (?, ?, ?)',
+            (group, channel, time.time()),
+        )
+
+    async def group_discard(self, group, channel):
+        self.require_valid_channel_name(channel)
+        self.require_valid_group_name(group)
+        await self._run(self._execute, 'DELETE FROM channel_groups WHERE grp = ? AND channel = ?', (group, channel))
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), 'message is not a dict'
+        self.require_valid_group_name(group)
+        channels = await self._run(self._group_channels, group, time.time())
+        if channels:
+            # serialized once, one transaction for every member
+            await self._run(self._insert, channels, json.dumps(message), time.time() + self.expiry)
@@ -0,0 +1,53 @@
+# apps/pokemon/clock.py
+
+# Virtual time for the components that take a clock (and sleep), so tests can skip ahead
+import asyncio
+import heapq
+import itertools
+
+class VirtualClock:
+    """A monotonic clock that only moves when advance() is called
+
+    Call it like time.monotonic and pass sleep where asyncio.sleep would be used, e.g.
+    EnergyScheduler(clock=clock, sleep=clock.sleep). advance() wakes the sleepers in deadline
+    order and lets each round of woken tasks run until they block again, so a test can go
+    through many ticks in milliseconds.
+    """
+
+    def __init__(self, start = 0.0, settle_rounds = 20):
+        self.now = start
+        self.settle_rounds = settle_rounds
+        self._sleepers = []
+        self._order = itertools.count()
+
+    def __call__(self):
+        return self.now
+
+    async def sleep(self, seconds):
+        if seconds <= 0:
+            await asyncio.sleep(0)
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._sleepers, (self.now + seconds, next(self._order), future))
+        await future
+
+    @property
+    def sleepers(self):
+        return sum(1 for _, _, future in self._sleepers if not future.done())
+
+    async def settle(self):
+        for _ in range(self.settle_rounds):
+            await asyncio.sleep(0)
+
+    async def advance(self, seconds):
+        # tasks still finishing the previous step get to reach their next sleep first
+        await self.settle()
+        target = self.now + seconds
+        while self._sleepers and self._sleepers[0][0] <= target:
+            deadline, _, future = heapq.heappop(self._sleepers)
+            self.now = max(self.now, deadline)
+            if not future.done():
+                future.set_result(None)
+                await self.settle()
+        self.now = target
+        await self.settle()
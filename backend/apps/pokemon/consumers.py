@@ -1,127 +1,114 @@
 # apps/pokemon/consumers.py
 
 import json
-import asyncio
-import random
-import math
-from datetime import datetime
+import time
+from urllib.parse import parse_qs
+from django.conf import settings
 from channels.generic.websocket import AsyncWebsocketConsumer
-from channels.db import database_sync_to_async
-import aiohttp
-import os
-from pathlib import Path
-from dotenv import load_dotenv
-from .models import Pokemon
+from .broadcast import MAP_GROUP
+from .energy import energy_scheduler
+from .pokemon_state import pokemon_states
+from .energy_history import energy_history
+from .outbound import FrameQueue, SendPolicy, heartbeat_frame
+from .prefetch import weather_prefetcher
+from .loop_lag import loop_lag_monitor
+from .energy_codec import BINARY_SUBPROTOCOL, pack_batch, pack_energy_record, pack_heartbeat, pack_hello
 
-# Load .env from the main project directory (backend/)
-BASE_DIR = Path(__file__).resolve().parent.parent.parent
-load_dotenv(BASE_DIR / '.env')
-
-# Load polylines once at module level
-POLYLINES = None
+class MapUpdatesConsumer(AsyncWebsocketConsumer):
+    """Pushes batched create/update/delete events for the map (see broadcast.MapBroadcaster)"""
+    async def connect(self):
+        await self.channel_layer.group_add(MAP_GROUP, self.channel_name)
+        await self.accept()
+    
+    async def disconnect(self, close_code):
+        await self.channel_layer.group_discard(MAP_GROUP, self.channel_name)
+    
+    async def map_changes(self, event):
+        # already serialized once by the broadcaster
+        await self.send(text_data=event['text'])
 
-def load_polylines():
-    """Load polyline data from files"""
-    global POLYLINES
-    if POLYLINES is None:
-        POLYLINES = {}
-        polyline_dir = Path(__file__).resolve().parent / 'data'
-        with open(polyline_dir / 'polylines_A-J.json', 'r') as f:
-            POLYLINES['A-J'] = json.load(f)
-        with open(polyline_dir / 'polylines_K-Z.json', 'r') as f:
-            POLYLINES['K-Z'] = json.load(f)
-    return POLYLINES
+class EnergyFramesMixin:
+    """Frame encoding shared by the energy consumers
 
-def get_polyline_for_pokemon(pokemon_name):
-    """Get the appropriate polyline based on pokemon name's first letter"""
-    first_letter = pokemon_name[0].upper()
-    polylines = load_polylines()
-    
-    if first_letter <= 'J':
-        return polylines['A-J']
-    else:
-        return polylines['K-Z']
+    A client offering the BINARY_SUBPROTOCOL subprotocol gets fixed-layout binary frames
+    (energy_codec) after a hello frame; everyone else gets the JSON text frames.
+    Ticks come from `scheduler`, which a route can override with as_asgi(scheduler=...).
+    Newly watched Pokemon first get a {"type": "history", "series": {"<id>": {"timestamps",
+    "energy_levels"}}} burst of their readings from the last ?backfill= seconds
+    (POKEMON_ENERGY_BACKFILL by default, 0 turns it off); it is JSON on binary sockets too.
+    At most POKEMON_ENERGY_ACK_WINDOW (or ?ack=N) frame messages are unacknowledged at a
+    time: the client sends a JSON {"action": "ack"[, "count": n]} for what it took, and until
+    then newer frames replace the waiting ones (see outbound.FrameQueue).
+    """
+    scheduler = energy_scheduler
 
-def haversine_distance(lat1, lon1, lat2, lon2):
-    """Calculate the great circle distance between two points on Earth (in km)"""
-    R = 6371  # Earth's radius in kilometers
-    
-    dlat = math.radians(lat2 - lat1)
-    dlon = math.radians(lon2 - lon1)
+    def __init__(self, *args, scheduler = None, **kwargs):
+        # channels passes as_asgi() keyword arguments here but does not set them itself
+        super().__init__(*args, **kwargs)
+        if scheduler is not None:
+            self.scheduler = scheduler
     
-    a = (math.sin(dlat / 2) ** 2 +
-         math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) *
-         math.sin(dlon / 2) ** 2)
-    c = 2 * math.asin(math.sqrt(a))
+    async def accept_energy_socket(self):
+        # keeps weather warm for the cells being watched (no-op without an API key)
+        weather_prefetcher.ensure_running()
+        loop_lag_monitor.ensure_running()
+        self.backfill = self.backfill_seconds()
+        self.binary = BINARY_SUBPROTOCOL in self.scope.get('subprotocols', [])
+        if self.binary:
+            await self.accept(subprotocol=BINARY_SUBPROTOCOL)
+            await self.send(bytes_data=pack_hello())
+        else:
+            await self.accept()
     
-    return R * c
-
-def point_to_line_distance(point_lat, point_lon, line_start_lat, line_start_lon, 
-                            line_end_lat, line_end_lon):
-    """Calculate the distance from a point to a line segment (in km) using spherical geometry"""
-    # For short line segments, sample points along the line and find minimum distance
-    # This is more accurate for spherical geometry than linear interpolation
+    def ack_window(self):
+        default = getattr(settings, 'POKEMON_ENERGY_ACK_WINDOW', 16)
+        query = parse_qs(self.scope.get('query_string', b'').decode())
+        try:
+            window = int(query['ack'][0])
+        except (KeyError, ValueError):
+            return default
+        return window if window > 0 else default
     
-    # Calculate distance to endpoints
-    dist_start = haversine_distance(point_lat, point_lon, line_start_lat, line_start_lon)
-    dist_end = haversine_distance(point_lat, point_lon, line_end_lat, line_end_lon)
+    def acknowledge(self, message):
+        self.frames.ack(int(message.get('count', 1)))
     
-    # If line segment is very short, just use the minimum endpoint distance
-    segment_length = haversine_distance(line_start_lat, line_start_lon, line_end_lat, line_end_lon)
-    if segment_length < 0.1:  # Less than 100m
-        return min(dist_start, dist_end)
+    def backfill_seconds(self):
+        query = parse_qs(self.scope.get('query_string', b'').decode())
+        try:
+            return max(0.0, float(query['backfill'][0]))
+        except (KeyError, ValueError):
+            return getattr(settings, 'POKEMON_ENERGY_BACKFILL', 300)
     
-    # Sample points along the line segment to find closest point
-    # Use 10 samples for accuracy
-    min_distance = min(dist_start, dist_end)
-    num_samples = 10
+    async def send_backfill(self, ids):
+        if not self.backfill:
+            return
+        since = time.time() - self.backfill
+        series = {}
+        for pokemon_id in ids:
+            readings = energy_history.series(pokemon_id, since=since)
+            if readings['timestamps']:
+                series[str(pokemon_id)] = readings
+        if series:
+            await self.send(text_data=json.dumps({'type': 'history', 'series': series}))
     
-    for i in range(1, num_samples):
-        t = i / num_samples
-        # Interpolate latitude and longitude
-        sample_lat = line_start_lat + t * (line_end_lat - line_start_lat)
-        sample_lon = line_start_lon + t * (line_end_lon - line_start_lon)
-        
-        # Calculate distance to this sample point
-        dist = haversine_distance(point_lat, point_lon, sample_lat, sample_lon)
-        min_distance = min(min_distance, dist)
+    def encode_frame(self, event):
+        return pack_energy_record(event) if self.binary else event['text']
     
-    return min_distance
+    def encode_heartbeat(self):
+        return pack_heartbeat() if self.binary else heartbeat_frame()
 
-def is_point_near_polyline(point_lat, point_lon, polyline_data, max_distance_km=1.0):
-    """Check if a point is near any segment of a MultiLineString polyline"""
-    if not polyline_data or 'coordinates' not in polyline_data:
-        return False
-    
-    coordinates = polyline_data['coordinates']
-    
-    # Check each line string in the MultiLineString
-    for line_string in coordinates:
-        # Check each segment in the line string
-        for i in range(len(line_string) - 1):
-            start = line_string[i]
-            end = line_string[i + 1]
-            
-            # Coordinates are [longitude, latitude]
-            start_lon, start_lat = start[0], start[1]
-            end_lon, end_lat = end[0], end[1]
-            
-            # Calculate distance from point to line segment
-            distance = point_to_line_distance(
-                point_lat, point_lon,
-                start_lat, start_lon,
-                end_lat, end_lon
-            )
-            
-            if distance <= max_distance_km:
-                return True
-    
-    return False
+class PokemonEnergyConsumer(EnergyFramesMixin, AsyncWebsocketConsumer):
+    """Energy feed of one Pokemon, ticks are shared through the scheduler's channel group
 
-class PokemonEnergyConsumer(AsyncWebsocketConsumer):
+    ?changed_only=1[&threshold=N] only sends frames that moved (see outbound.SendPolicy).
+    """
     async def connect(self):
         self.pokemon_id = self.scope['url_route']['kwargs']['pokemon_id']
-        await self.accept()
+        self.policy = SendPolicy.from_scope(self.scope)
+        self.frames = FrameQueue(self.send, self.render_frame, max_in_flight=self.ack_window())
+        await self.accept_energy_socket()
+        self.scheduler.connection_opened()
+        self.counted = True
         
         # Verify pokemon exists
         pokemon = await self.get_pokemon(self.pokemon_id)
@@ -130,165 +117,143 @@ class PokemonEnergyConsumer(AsyncWebsocketConsumer):
             return
         
         self.pokemon = pokemon
-        # Start sending energy updates
-        self.update_task = asyncio.create_task(self.send_energy_updates())
+        # Join the Pokemon's energy group (starts its tick if we are the first watcher)
+        last_event = await self.scheduler.watch(pokemon, self.channel_layer, self.channel_name)
+        self.watching = True
+        await self.send_backfill([pokemon.id])
+        if last_event is not None:
+            await self.energy_update(last_event)
     
     async def disconnect(self, close_code):
-        # Cancel the update task when client disconnects
-        if hasattr(self, 'update_task'):
-            self.update_task.cancel()
-            try:
-                await self.update_task
-            except asyncio.CancelledError:
-                pass
+        if getattr(self, 'counted', False):
+            self.counted = False
+            self.scheduler.connection_closed()
+        if getattr(self, 'watching', False):
+            self.watching = False
+            await self.scheduler.unwatch(self.pokemon.id, self.channel_layer, self.channel_name)
+        if hasattr(self, 'frames'):
+            await self.frames.close()
     
-    @database_sync_to_async
-    def get_pokemon(self, pokemon_id):
-        """Get pokemon from database"""
+    async def receive(self, text_data=None, bytes_data=None):
+        # acks are the only messages this socket takes
         try:
-            return Pokemon.objects.get(id=pokemon_id)
-        except Pokemon.DoesNotExist:
-            return None
+            message = json.loads(text_data or '')
+            if message['action'] == 'ack':
+                self.acknowledge(message)
+        except (ValueError, TypeError, KeyError):
+            pass
     
-    async def send_energy_updates(self):
-        """Send energy updates to the client"""
-        while True:
-            try:
-                # Calculate energy based on weather
-                energy_data = await self.calculate_energy_level()
-                
-                await self.send(text_data=json.dumps({
-                    'energy_level': energy_data['energy_level'],
-                    'timestamp': datetime.now().isoformat(),
-                    'factors': energy_data['factors']
-                }))
-                
-                await asyncio.sleep(5)  # update every 5 seconds
-                
-            except asyncio.CancelledError:
-                raise
-            except Exception as e:
-                await self.send(text_data=json.dumps({
-                    'error': str(e)
-                }))
-                await asyncio.sleep(5)
+    async def get_pokemon(self, pokemon_id):
+        """Energy-relevant state of the Pokemon (cached, see pokemon_state), None if it doesn't exist"""
+        return await pokemon_states.get(int(pokemon_id))
     
-    async def calculate_energy_level(self):
-        """Calculate energy based on weather with +/- 20% variance and polyline proximity"""
-        latitude = self.pokemon.latitude
-        longitude = self.pokemon.longitude
-        api_key = os.getenv("OPENWEATHER_API_KEY")
-        
-        # Check if pokemon is near appropriate polyline
-        polyline_data = get_polyline_for_pokemon(self.pokemon.name)
-        is_near_polyline = is_point_near_polyline(latitude, longitude, polyline_data, max_distance_km=1.0)
-        
-        # Apply polyline proximity modifier
-        polyline_modifier = 1.0
-        if not is_near_polyline:
-            # Reduce energy if pokemon is not near its designated polyline
-            polyline_modifier = 0.85  # -15% energy if not near polyline
-        
-        if not api_key:
-            # Return default energy with polyline modifier if API key is not set
-            return {
-                'energy_level': 100.0 * polyline_modifier,
-                'factors': {
-                    'weather': 'clear',
-                    'temperature': None,
-                    'near_route': is_near_polyline,
-                    'weather_modifier': 0,
-                    'temp_modifier': 0,
-                    'location_modifier': -15 if not is_near_polyline else 0
-                }
-            }
-        
-        # Fetch weather from OpenWeatherMap API
+    async def energy_update(self, event):
+        # serialized once per tick by the scheduler; a slow reader only keeps the newest frame
+        if self.policy.wants(event):
+            self.frames.put(event['pokemon_id'], self.encode_frame(event))
+        elif self.policy.heartbeat_due():
+            # keyed apart, so it can't replace a frame that is still waiting
+            self.frames.put(None, self.encode_heartbeat())
+    
+    def render_frame(self, pending):
+        # a waiting frame makes the heartbeat redundant
+        heartbeat = pending.pop(None, None)
+        return next(iter(pending.values()), heartbeat)
+
+class EnergySubscriptionsConsumer(EnergyFramesMixin, AsyncWebsocketConsumer):
+    """Energy feed for many Pokemon over one socket
+
+    The client sends {"action": "subscribe" | "unsubscribe", "ids": [...]} (or an ack) and receives
+    {"type": "energy", "frames": {"<id>": <frame>, ...}} with every frame that arrived within
+    the batch window (scheduler ticks are aligned, so normally one message per tick).
+    ?changed_only=1[&threshold=N] only sends frames that moved, with heartbeats in between.
+    On the binary subprotocol a batch is one FRAME_BATCH message; acks and errors stay JSON.
+    """
+    batch_window = 0.02
+
+    async def connect(self):
+        self.subscriptions = set()
+        self.policy = SendPolicy.from_scope(self.scope)
+        self.frames = FrameQueue(self.send, self.render_frames, window=self.batch_window, max_in_flight=self.ack_window())
+        await self.accept_energy_socket()
+        self.scheduler.connection_opened()
+    
+    async def disconnect(self, close_code):
+        self.scheduler.connection_closed()
+        await self.frames.close()
+        for pokemon_id in list(self.subscriptions):
+            await self.scheduler.unwatch(pokemon_id, self.channel_layer, self.channel_name)
+        self.subscriptions.clear()
+    
+    async def receive(self, text_data=None, bytes_data=None):
         try:
-            async with aiohttp.ClientSession() as session:
-                url = f'https://api.openweathermap.org/data/2.5/weather?lat={latitude}&lon={longitude}&appid={api_key}&units=metric'
-                async with session.get(url) as response:
-                    if response.status == 200:
-                        weather_data = await response.json()
-                        
-                        # Extract weather conditions
-                        weather_description = weather_data['weather'][0]['description']
-                        temperature = weather_data['main']['temp']
-                        
-                        # Calculate energy based on weather
-                        result = self.calculate_energy_based_on_weather(
-                            weather_description, temperature, polyline_modifier, is_near_polyline
-                        )
-                        return result
-                    else:
-                        # Return default energy with polyline modifier if API call fails
-                        return {
-                            'energy_level': 100.0 * polyline_modifier,
-                            'factors': {
-                                'weather': 'unknown',
-                                'temperature': None,
-                                'near_route': is_near_polyline,
-                                'weather_modifier': 0,
-                                'temp_modifier': 0,
-                                'location_modifier': -15 if not is_near_polyline else 0
-                            }
-                        }
-        except Exception:
-            # Return default energy with polyline modifier on any error
-            return {
-                'energy_level': 100.0 * polyline_modifier,
-                'factors': {
-                    'weather': 'unknown',
-                    'temperature': None,
-                    'near_route': is_near_polyline,
-                    'weather_modifier': 0,
-                    'temp_modifier': 0,
-                    'location_modifier': -15 if not is_near_polyline else 0
-                }
-            }
-            
-    def calculate_energy_based_on_weather(self, weather_description, temperature, polyline_modifier=1.0, is_near_polyline=True):
-        """Calculate energy based on weather with +/- 20% variance and polyline proximity"""
-        
-        # Base energy level (100)
-        base_energy = 100
+            message = json.loads(text_data or '')
+            action = message['action']
+            if action == 'ack':
+                self.acknowledge(message)
+                return
+            ids = {int(pokemon_id) for pokemon_id in message['ids']}
+        except (ValueError, TypeError, KeyError):
+            await self.send_error('Expected {"action": "subscribe" | "unsubscribe", "ids": [...]}')
+            return
         
-        # Weather energy modifiers
-        weather_modifier = 0
-        if 'rain' in weather_description.lower():
-            energy_modifier = 0.8  # -20% energy
-            weather_modifier = -20
-        elif 'snow' in weather_description.lower():
-            energy_modifier = 0.9  # -10% energy
-            weather_modifier = -10
+        if action == 'subscribe':
+            await self.subscribe(ids)
+        elif action == 'unsubscribe':
+            await self.unsubscribe(ids)
         else:
-            energy_modifier = 1.0  # no change
-            
-        # Temperature energy modifiers
-        temp_modifier = 0
-        if temperature < 0:
-            energy_modifier *= 0.9  # -10% energy
-            temp_modifier = -10
-        elif temperature > 30:
-            energy_modifier *= 1.1  # +10% energy
-            temp_modifier = 10
+            await self.send_error(f'Unknown action: {action}')
+    
+    async def subscribe(self, ids):
+        new_ids = ids - self.subscriptions
+        limit = getattr(settings, 'POKEMON_ENERGY_MAX_SUBSCRIPTIONS', 200)
+        if len(self.subscriptions) + len(new_ids) > limit:
+            await self.send_error(f'At most {limit} subscriptions per connection')
+            return
         
-        # Apply polyline modifier
-        location_modifier = 0 if is_near_polyline else -15
-        energy_modifier *= polyline_modifier
-            
-        # Calculate final energy level
-        # +/- 20% variance
-        final_energy = base_energy * energy_modifier * random.uniform(0.8, 1.2)
+        # one query validates the whole batch
+        pokemon_list = await self.get_pokemon_batch(new_ids)
+        for pokemon in pokemon_list:
+            last_event = await self.scheduler.watch(pokemon, self.channel_layer, self.channel_name)
+            self.subscriptions.add(pokemon.id)
+            if last_event is not None:
+                await self.energy_update(last_event)
         
-        return {
-            'energy_level': max(0, min(final_energy, 100)),  # clamp between 0 and 100
-            'factors': {
-                'weather': weather_description,
-                'temperature': round(temperature, 1),
-                'near_route': is_near_polyline,
-                'weather_modifier': weather_modifier,
-                'temp_modifier': temp_modifier,
-                'location_modifier': location_modifier
-            }
-        }
\ No newline at end of file
+        found = {pokemon.id for pokemon in pokemon_list}
+        await self.send(text_data=json.dumps({
+            'type': 'subscribed',
+            'ids': sorted(self.subscriptions),
+            'unknown': sorted(new_ids - found),
+        }))
+        await self.send_backfill(sorted(found))
+    
+    async def unsubscribe(self, ids):
+        for pokemon_id in ids & self.subscriptions:
+            self.subscriptions.discard(pokemon_id)
+            self.policy.forget(pokemon_id)
+            await self.scheduler.unwatch(pokemon_id, self.channel_layer, self.channel_name)
+        await self.send(text_data=json.dumps({'type': 'unsubscribed', 'ids': sorted(self.subscriptions)}))
+    
+    async def send_error(self, error):
+        await self.send(text_data=json.dumps({'type': 'error', 'error': error}))
+    
+    async def get_pokemon_batch(self, ids):
+        return await pokemon_states.get_many(ids)
+    
+    async def energy_update(self, event):
+        if event['pokemon_id'] not in self.subscriptions:
+            return
+        if self.policy.wants(event):
+            self.frames.put(event['pokemon_id'], self.encode_frame(event))
+        elif self.policy.heartbeat_due():
+            self.frames.put(None, self.encode_heartbeat())
+    
+    def render_frames(self, pending):
+        heartbeat = pending.pop(None, None)
+        if not pending:
+            return heartbeat
+        if self.binary:
+            return pack_batch(list(pending.values()))
+        # frames are already JSON, splice them in instead of re-serializing
+        body = ','.join(f'"{pokemon_id}":{text}' for pokemon_id, text in pending.items())
+        return '{"type":"energy","frames":{' + body + '}}'
@@ -0,0 +1,475 @@
+# apps/pokemon/energy.py
+
+# Energy calculation (weather + route proximity) and the per-process scheduler that ticks it
+import json
+import asyncio
+import random
+import math
+import os
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from django.conf import settings
+from dotenv import load_dotenv
+from .weather import weather_cache
+from .pokemon_state import pokemon_states
+from .energy_history import energy_history
+
+# Load .env from the main project directory (backend/)
+BASE_DIR = Path(__file__).resolve().parent.parent.parent
+load_dotenv(BASE_DIR / '.env')
+
+# Load polylines once at module level
+POLYLINES = None
+
+def load_polylines():
+    """Load polyline data from files"""
+    global POLYLINES
+    if POLYLINES is None:
+        POLYLINES = {}
+        polyline_dir = Path(__file__).resolve().parent / 'data'
+        with open(polyline_dir / 'polylines_A-J.json', 'r') as f:
+            POLYLINES['A-J'] = json.load(f)
+        with open(polyline_dir / 'polylines_K-Z.json', 'r') as f:
+            POLYLINES['K-Z'] = json.load(f)
+    return POLYLINES
+
+def polyline_group(pokemon_name):
+    """Key of the polyline a Pokemon belongs to, by its name's first letter"""
+    return 'A-J' if pokemon_name[0].upper() <= 'J' else 'K-Z'
+
+def get_polyline_for_pokemon(pokemon_name):
+    """Get the appropriate polyline based on pokemon name's first letter"""
+    return load_polylines()[polyline_group(pokemon_name)]
+
+def haversine_distance(lat1, lon1, lat2, lon2):
+    """Calculate the great circle distance between two points on Earth (in km)"""
+    R = 6371  # Earth's radius in kilometers
+    
+    dlat = math.radians(lat2 - lat1)
+    dlon = math.radians(lon2 - lon1)
+    
+    a = (math.sin(dlat / 2) ** 2 +
+         math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) *
+         math.sin(dlon / 2) ** 2)
+    c = 2 * math.asin(math.sqrt(a))
+    
+    return R * c
+
+def point_to_line_distance(point_lat, point_lon, line_start_lat, line_start_lon, 
+                            line_end_lat, line_end_lon):
+    """Calculate the distance from a point to a line segment (in km) using spherical geometry"""
+    # For short line segments, sample points along the line and find minimum distance
+    # This is more accurate for spherical geometry than linear interpolation
+    
+    # Calculate distance to endpoints
+    dist_start = haversine_distance(point_lat, point_lon, line_start_lat, line_start_lon)
+    dist_end = haversine_distance(point_lat, point_lon, line_end_lat, line_end_lon)
+    
+    # If line segment is very short, just use the minimum endpoint distance
+    segment_length = haversine_distance(line_start_lat, line_start_lon, line_end_lat, line_end_lon)
+    if segment_length < 0.1:  # Less than 100m
+        return min(dist_start, dist_end)
+    
+    # Sample points along the line segment to find closest point
+    # Use 10 samples for accuracy
+    min_distance = min(dist_start, dist_end)
+    num_samples = 10
+    
+    for i in range(1, num_samples):
+        t = i / num_samples
+        # Interpolate latitude and longitude
+        sample_lat = line_start_lat + t * (line_end_lat - line_start_lat)
+        sample_lon = line_start_lon + t * (line_end_lon - line_start_lon)
+        
+        # Calculate distance to this sample point
+        dist = haversine_distance(point_lat, point_lon, sample_lat, sample_lon)
+        min_distance = min(min_distance, dist)
+    
+    return min_distance
+
+def is_point_near_polyline(point_lat, point_lon, polyline_data, max_distance_km=1.0):
+    """Check if a point is near any segment of a MultiLineString polyline"""
+    if not polyline_data or 'coordinates' not in polyline_data:
+        return False
+    
+    coordinates = polyline_data['coordinates']
+    
+    # Check each line string in the MultiLineString
+    for line_string in coordinates:
+        # Check each segment in the line string
+        for i in range(len(line_string) - 1):
+            start = line_string[i]
+            end = line_string[i + 1]
+            
+            # Coordinates are [longitude, latitude]
+            start_lon, start_lat = start[0], start[1]
+            end_lon, end_lat = end[0], end[1]
+            
+            # Calculate distance from point to line segment
+            distance = point_to_line_distance(
+                point_lat, point_lon,
+                start_lat, start_lon,
+                end_lat, end_lon
+            )
+            
+            if distance <= max_distance_km:
+                return True
+    
+    return False
+
+def route_proximity_batch(points):
+    """Near-route flag of each (name, latitude, longitude), runs in a RouteProximityPool worker"""
+    return [
+        is_point_near_polyline(latitude, longitude, get_polyline_for_pokemon(name), max_distance_km=1.0)
+        for name, latitude, longitude in points
+    ]
+
+class RouteProximityPool:
+    """Runs the route proximity checks off the event loop, in a bounded executor
+
+    The check walks up to a few thousand polyline segments in pure Python, which would stall
+    every socket of the process. Checks requested during the same loop iteration (the ticks of
+    every Pokemon due on the same interval boundary) go to the executor as one batch.
+    POKEMON_ENERGY_EXECUTOR picks 'thread' or 'process' workers, POKEMON_ENERGY_WORKERS
+    how many; the executor is created on first use and shared by every loop of the process.
+    """
+
+    def __init__(self):
+        self._executor = None
+        self._loop = None
+        self._pending = []
+        self.batches = 0
+        self.checks = 0
+        self.largest_batch = 0
+
+    def executor(self):
+        if self._executor is None:
+            workers = getattr(settings, 'POKEMON_ENERGY_WORKERS', 2)
+            if getattr(settings, 'POKEMON_ENERGY_EXECUTOR', 'thread') == 'process':
+                self._executor = ProcessPoolExecutor(max_workers=workers)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='route-proximity')
+        return self._executor
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    async def is_near_route(self, name, latitude, longitude):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._pending = []
+        future = loop.create_future()
+        self._pending.append(((name, latitude, longitude), future))
+        if len(self._pending) == 1:
+            # runs after every task woken in this iteration has queued its check
+            loop.call_soon(self._flush)
+        return await future
+
+    def _flush(self):
+        pending, self._pending = self._pending, []
+        self.batches += 1
+        self.checks += len(pending)
+        self.largest_batch = max(self.largest_batch, len(pending))
+        asyncio.ensure_future(self._run_batch(pending), loop=self._loop)
+
+    async def _run_batch(self, pending):
+        loop = asyncio.get_running_loop()
+        try:
+            results = await loop.run_in_executor(self.executor(), route_proximity_batch, [point for point, _ in pending])
+        except Exception as e:
+            for _, future in pending:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), result in zip(pending, results):
+            # the tick may have been cancelled meanwhile
+            if not future.done():
+                future.set_result(result)
+
+    def metrics(self):
+        return {
+            'batches': self.batches,
+            'checks': self.checks,
+            'largest_batch': self.largest_batch,
+        }
+
+route_proximity = RouteProximityPool()
+
+async def calculate_energy_level(pokemon):
+    """Calculate energy based on weather with +/- 20% variance and polyline proximity"""
+    latitude = pokemon.latitude
+    longitude = pokemon.longitude
+    api_key = os.getenv("OPENWEATHER_API_KEY")
+
+    # Check if pokemon is near appropriate polyline (in the worker pool, batched with other ticks);
+    # cached PokemonState records keep the answer until their coordinates change
+    is_near_polyline = getattr(pokemon, 'near_route', None)
+    if is_near_polyline is None:
+        is_near_polyline = await route_proximity.is_near_route(pokemon.name, latitude, longitude)
+        if hasattr(pokemon, 'near_route'):
+            pokemon.near_route = is_near_polyline
+
+    # Apply polyline proximity modifier
+    polyline_modifier = 1.0
+    if not is_near_polyline:
+        # Reduce energy if pokemon is not near its designated polyline
+        polyline_modifier = 0.85  # -15% energy if not near polyline
+
+    if not api_key:
+        # Return default energy with polyline modifier if API key is not set
+        return {
+            'energy_level': 100.0 * polyline_modifier,
+            'factors': {
+                'weather': 'clear',
+                'temperature': None,
+                'near_route': is_near_polyline,
+                'weather_modifier': 0,
+                'temp_modifier': 0,
+                'location_modifier': -15 if not is_near_polyline else 0
+            }
+        }
+
+    # Weather comes from the process-wide cache (one upstream call per grid cell and TTL)
+    weather = await weather_cache.get(latitude, longitude, api_key)
+    if weather is None:
+        # Return default energy with polyline modifier if the weather is unavailable
+        return {
+            'energy_level': 100.0 * polyline_modifier,
+            'factors': {
+                'weather': 'unknown',
+                'temperature': None,
+                'near_route': is_near_polyline,
+                'weather_modifier': 0,
+                'temp_modifier': 0,
+                'location_modifier': -15 if not is_near_polyline else 0
+            }
+        }
+
+    # Calculate energy based on weather
+    return calculate_energy_based_on_weather(
+        weather['description'], weather['temperature'], polyline_modifier, is_near_polyline
+    )
+
+def calculate_energy_based_on_weather(weather_description, temperature, polyline_modifier=1.0, is_near_polyline=True):
+    """Calculate energy based on weather with +/- 20% variance and polyline proximity"""
+
+    # Base energy level (100)
+    base_energy = 100
+
+    # Weather energy modifiers
+    weather_modifier = 0
+    if 'rain' in weather_description.lower():
+        energy_modifier = 0.8  # -20% energy
+        weather_modifier = -20
+    elif 'snow' in weather_description.lower():
+        energy_modifier = 0.9  # -10% energy
+        weather_modifier = -10
+    else:
+        energy_modifier = 1.0  # no change
+
+    # Temperature energy modifiers
+    temp_modifier = 0
+    if temperature < 0:
+        energy_modifier *= 0.9  # -10% energy
+        temp_modifier = -10
+    elif temperature > 30:
+        energy_modifier *= 1.1  # +10% energy
+        temp_modifier = 10
+
+    # Apply polyline modifier
+    location_modifier = 0 if is_near_polyline else -15
+    energy_modifier *= polyline_modifier
+
+    # Calculate final energy level
+    # +/- 20% variance
+    final_energy = base_energy * energy_modifier * random.uniform(0.8, 1.2)
+
+    return {
+        'energy_level': max(0, min(final_energy, 100)),  # clamp between 0 and 100
+        'factors': {
+            'weather': weather_description,
+            'temperature': round(temperature, 1),
+            'near_route': is_near_polyline,
+            'weather_modifier': weather_modifier,
+            'temp_modifier': temp_modifier,
+            'location_modifier': location_modifier
+        }
+    }
+
+def energy_group(pokemon_id, scheduler_name = None):
+    """Channel group receiving the energy frames of one Pokemon (from one scheduler)"""
+    if scheduler_name:
+        return f'pokemon_energy_{scheduler_name}_{pokemon_id}'
+    return f'pokemon_energy_{pokemon_id}'
+
+def energy_frame(energy_data, timestamp):
+    return json.dumps({
+        'energy_level': energy_data['energy_level'],
+        'timestamp': datetime.fromtimestamp(timestamp).isoformat(),
+        'factors': energy_data['factors']
+    })
+
+class EnergyScheduler:
+    """One energy tick per watched Pokemon, fanned out to its channel group
+
+    Sockets watch()/unwatch() a Pokemon; the first watcher starts its tick task and the last
+    one to leave cancels it, so weather lookups and energy calculations scale with the number
+    of distinct Pokemon being watched rather than with sockets. The latest frame is kept so a
+    socket joining a running tick gets a value straight away. Past POKEMON_ENERGY_MAX_CONNECTIONS
+    sockets in the process the interval grows with the load instead of ticks piling up.
+    Tasks belong to the event loop they were started on; state left behind by another loop
+    (e.g. a previous async_to_sync call) is dropped.
+
+    interval and jitter default to POKEMON_ENERGY_INTERVAL / POKEMON_ENERGY_JITTER: each tick
+    fires on an interval boundary of clock() plus a random delay of up to jitter seconds
+    (spreading the load, at the cost of frames no longer arriving together). clock/sleep are
+    time.monotonic/asyncio.sleep unless injected (clock.VirtualClock in tests). A route can
+    get its own cadence with a named scheduler, which ticks into its own groups:
+    PokemonEnergyConsumer.as_asgi(scheduler=EnergyScheduler(interval=1.0, name='fast')).
+
+    Groups are per scheduler instance, so per process: with a channel layer shared by several
+    workers (SQLiteChannelLayer) every worker ticks the Pokemon its own sockets watch and sends
+    only to them, instead of each socket getting one frame per worker per tick.
+    """
+
+    def __init__(self, interval = None, jitter = None, clock = time.monotonic, sleep = asyncio.sleep, name = None):
+        self._interval = interval
+        self._jitter = jitter
+        self.clock = clock
+        self.sleep = sleep
+        self.name = name
+        self.process = uuid.uuid4().hex[:12]
+        self.connections = 0
+        self._loop = None
+        self._watchers = {}
+        self._tasks = {}
+        self._last_frames = {}
+        self._pokemon = {}
+
+    def _check_loop(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self.connections = 0
+            self._watchers = {}
+            self._tasks = {}
+            self._last_frames = {}
+            self._pokemon = {}
+
+    @property
+    def interval(self):
+        if self._interval is not None:
+            return self._interval
+        return getattr(settings, 'POKEMON_ENERGY_INTERVAL', 5.0)
+
+    @interval.setter
+    def interval(self, value):
+        self._interval = value
+
+    @property
+    def jitter(self):
+        if self._jitter is not None:
+            return self._jitter
+        return getattr(settings, 'POKEMON_ENERGY_JITTER', 0.0)
+
+    @jitter.setter
+    def jitter(self, value):
+        self._jitter = value
+
+    def group(self, pokemon_id):
+        return f'{energy_group(pokemon_id, self.name)}.{self.process}'
+
+    def connection_opened(self):
+        self._check_loop()
+        self.connections += 1
+
+    def connection_closed(self):
+        self._check_loop()
+        self.connections = max(0, self.connections - 1)
+
+    def effective_interval(self):
+        """Tick interval, stretched in proportion once connections pass the per-process cap"""
+        limit = getattr(settings, 'POKEMON_ENERGY_MAX_CONNECTIONS', 5000)
+        return self.interval * max(1.0, self.connections / limit)
+
+    def last_frame(self, pokemon_id):
+        return self._last_frames.get(pokemon_id)
+
+    def watcher_count(self, pokemon_id):
+        return self._watchers.get(pokemon_id, 0)
+
+    @property
+    def active_pokemon(self):
+        return set(self._tasks)
+
+    def watched_pokemon(self):
+        """(pokemon, watcher count) for every Pokemon currently ticking"""
+        return [(self._pokemon[pokemon_id], count) for pokemon_id, count in self._watchers.items() if pokemon_id in self._pokemon]
+
+    async def watch(self, pokemon, channel_layer, channel_name):
+        """Add a socket to the Pokemon's group, returns the latest energy.update event (or None)"""
+        self._check_loop()
+        await channel_layer.group_add(self.group(pokemon.id), channel_name)
+        self._watchers[pokemon.id] = self._watchers.get(pokemon.id, 0) + 1
+        if pokemon.id not in self._tasks:
+            self._pokemon[pokemon.id] = pokemon
+            self._tasks[pokemon.id] = asyncio.create_task(self._run(pokemon, channel_layer))
+        return self._last_frames.get(pokemon.id)
+
+    async def unwatch(self, pokemon_id, channel_layer, channel_name):
+        self._check_loop()
+        await channel_layer.group_discard(self.group(pokemon_id), channel_name)
+        count = self._watchers.get(pokemon_id, 0) - 1
+        if count > 0:
+            self._watchers[pokemon_id] = count
+            return
+        self._watchers.pop(pokemon_id, None)
+        self._last_frames.pop(pokemon_id, None)
+        self._pokemon.pop(pokemon_id, None)
+        task = self._tasks.pop(pokemon_id, None)
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    async def _run(self, pokemon, channel_layer):
+        group = self.group(pokemon.id)
+        while True:
+            event = {'type': 'energy.update', 'pokemon_id': pokemon.id}
+            try:
+                # re-read every tick (a cache hit) so a moved Pokemon ticks from its new position
+                current = await pokemon_states.get(pokemon.id)
+                if current is None:
+                    raise LookupError('Pokemon not found')
+                pokemon = self._pokemon[pokemon.id] = current
+                # Calculate energy based on weather, once for every socket watching
+                energy_data = await calculate_energy_level(pokemon)
+                event['timestamp'] = time.time()
+                event['text'] = energy_frame(energy_data, event['timestamp'])
+                # raw values let change-only connections compare without parsing the text
+                event['energy_level'] = energy_data['energy_level']
+                event['factors'] = energy_data['factors']
+                self._last_frames[pokemon.id] = event
+                energy_history.record(pokemon.id, event['timestamp'], energy_data['energy_level'])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                event['text'] = json.dumps({'error': str(e)})
+            await channel_layer.group_send(group, event)
+            # ticks line up on interval boundaries, so sockets watching many Pokemon get their
+            # frames together and can batch them
+            interval = self.effective_interval()
+            delay = interval - self.clock() % interval
+            if self.jitter:
+                delay += random.uniform(0, self.jitter)
+            await self.sleep(delay)
+
+energy_scheduler = EnergyScheduler()
@@ -0,0 +1,120 @@
+# apps/pokemon/energy_batch.py
+
+# Vectorized energy for many Pokemon at once (the map-wide energy snapshot)
+import numpy as np
+from .energy import load_polylines, polyline_group
+
+EARTH_RADIUS_KM = 6371
+# points further than this (in degrees of latitude) from every route sample can't be within 1 km
+ROUTE_MARGIN_DEGREES = 0.01
+# candidate points compared against all route samples at a time, bounds the distance matrix
+CHUNK_SIZE = 64
+
+_route_samples = {}
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """energy.haversine_distance over broadcast arrays (degrees in, km out)"""
+    lat1, lon1, lat2, lon2 = np.radians(lat1), np.radians(lon1), np.radians(lat2), np.radians(lon2)
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+def route_samples(group):
+    """(lat, lon) arrays of the points energy.point_to_line_distance measures against
+
+    Both ends of every segment, plus 9 evenly spaced points on the segments of 100 m or
+    more, so the batch check gives the same answers as is_point_near_polyline.
+    """
+    if group not in _route_samples:
+        lats = []
+        lons = []
+        for line_string in load_polylines()[group].get('coordinates', []):
+            if len(line_string) < 2:
+                continue
+            line = np.asarray(line_string, dtype=float)
+            start_lon, start_lat = line[:-1, 0], line[:-1, 1]
+            end_lon, end_lat = line[1:, 0], line[1:, 1]
+            lats += [start_lat, end_lat]
+            lons += [start_lon, end_lon]
+            long_segments = haversine_km(start_lat, start_lon, end_lat, end_lon) >= 0.1
+            t = np.arange(1, 10)[:, None] / 10
+            lats.append((start_lat + t * (end_lat - start_lat))[:, long_segments].ravel())
+            lons.append((start_lon + t * (end_lon - start_lon))[:, long_segments].ravel())
+        _route_samples[group] = (np.concatenate(lats), np.concatenate(lons)) if lats else (np.empty(0), np.empty(0))
+    return _route_samples[group]
+
+def near_route_batch(names, latitudes, longitudes, max_distance_km = 1.0):
+    """is_point_near_polyline for many Pokemon, returns a bool array"""
+    latitudes = np.asarray(latitudes, dtype=float)
+    longitudes = np.asarray(longitudes, dtype=float)
+    near = np.zeros(len(latitudes), dtype=bool)
+    groups = np.array([polyline_group(name) for name in names])
+    for group in ('A-J', 'K-Z'):
+        sample_lats, sample_lons = route_samples(group)
+        if not len(sample_lats):
+            continue
+        margin = ROUTE_MARGIN_DEGREES * max_distance_km
+        candidates = np.flatnonzero(
+            (groups == group)
+            & (latitudes >= sample_lats.min() - margin) & (latitudes <= sample_lats.max() + margin)
+        )
+        for start in range(0, len(candidates), CHUNK_SIZE):
+            chunk = candidates[start:start + CHUNK_SIZE]
+            distances = haversine_km(latitudes[chunk, None], longitudes[chunk, None], sample_lats, sample_lons)
+            near[chunk] = (distances <= max_distance_km).any(axis=1)
+    return near
+
+def weather_multipliers(descriptions):
+    """Energy multiplier of each weather description in a table"""
+    multipliers = np.ones(len(descriptions))
+    for code, description in enumerate(descriptions):
+        description = description.lower()
+        if 'rain' in description:
+            multipliers[code] = 0.8
+        elif 'snow' in description:
+            multipliers[code] = 0.9
+    return multipliers
+
+def energy_batch(weather_codes, descriptions, temperatures, near_route, rng = None):
+    """calculate_energy_based_on_weather for N Pokemon at once
+
+    weather_codes index into the descriptions table, temperatures are degrees C with NaN
+    where there is no weather (those rows get the no-weather default, like
+    calculate_energy_level), near_route is a bool array. One variance factor is drawn per
+    row from rng (a numpy Generator, seed it for reproducible results).
+    Returns energy levels as a float array.
+    """
+    rng = rng if rng is not None else np.random.default_rng()
+    weather_codes = np.asarray(weather_codes, dtype=np.intp)
+    temperatures = np.asarray(temperatures, dtype=float)
+    near_route = np.asarray(near_route, dtype=bool)
+
+    route_multiplier = np.where(near_route, 1.0, 0.85)
+    multiplier = weather_multipliers(descriptions)[weather_codes] * route_multiplier
+    multiplier *= np.where(temperatures < 0, 0.9, np.where(temperatures > 30, 1.1, 1.0))
+    variance = rng.uniform(0.8, 1.2, len(weather_codes))
+    energy = np.clip(100 * multiplier * variance, 0, 100)
+    return np.where(np.isnan(temperatures), 100.0 * route_multiplier, energy)
+
+def energy_snapshot(rows, weather_for, seed = None):
+    """Energy of (id, name, latitude, longitude) rows in one batch
+
+    weather_for(latitude, longitude) returns the weather to use or None; seed fixes the variance.
+    """
+    ids, names, latitudes, longitudes = (list(column) for column in zip(*rows)) if rows else ([], [], [], [])
+    descriptions = {}
+    weather_codes = np.zeros(len(ids), dtype=np.intp)
+    temperatures = np.full(len(ids), np.nan)
+    for index, (latitude, longitude) in enumerate(zip(latitudes, longitudes)):
+        weather = weather_for(latitude, longitude)
+        if weather is not None:
+            weather_codes[index] = descriptions.setdefault(weather['description'], len(descriptions))
+            temperatures[index] = weather['temperature']
+
+    near_route = near_route_batch(names, latitudes, longitudes)
+    energy = energy_batch(weather_codes, list(descriptions) or [''], temperatures, near_route, rng=np.random.default_rng(seed))
+    return {
+        'count': len(ids),
+        'ids': ids,
+        'energy_levels': np.round(energy, 1).tolist(),
+        'near_route': near_route.tolist(),
+    }
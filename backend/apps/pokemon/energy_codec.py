@@ -0,0 +1,131 @@
+# apps/pokemon/energy_codec.py
+
+# Fixed-layout binary energy frames for sockets that negotiate BINARY_SUBPROTOCOL
+import json
+import struct
+import time
+from functools import lru_cache
+
+BINARY_SUBPROTOCOL = 'pokemon-energy.bin.v2'
+
+FRAME_HELLO = 0
+FRAME_ENERGY = 1
+FRAME_HEARTBEAT = 2
+FRAME_ERROR = 3
+FRAME_BATCH = 5
+
+# OpenWeatherMap descriptions get one byte; anything else is sent as OTHER_WEATHER + the text
+WEATHER_CODES = [
+    'unknown', 'clear', 'clear sky', 'few clouds', 'scattered clouds', 'broken clouds',
+    'overcast clouds', 'mist', 'fog', 'haze', 'smoke', 'dust', 'sand', 'light rain',
+    'moderate rain', 'heavy intensity rain', 'very heavy rain', 'extreme rain', 'freezing rain',
+    'light intensity shower rain', 'shower rain', 'heavy intensity shower rain', 'light intensity drizzle',
+    'drizzle', 'heavy intensity drizzle', 'thunderstorm', 'thunderstorm with light rain',
+    'thunderstorm with rain', 'thunderstorm with heavy rain', 'light snow', 'snow', 'heavy snow',
+    'sleet', 'light shower snow', 'shower snow', 'tornado', 'squalls',
+]
+WEATHER_CODE_BY_NAME = {name: code for code, name in enumerate(WEATHER_CODES)}
+OTHER_WEATHER = 255
+NO_TEMPERATURE = -32768
+
+# type, pokemon id, timestamp (10 ms units since EPOCH), energy * 100, weather code,
+# temperature * 10, weather/temperature/location modifiers, flags (bit 0: near route);
+# ids are signed 64-bit like the database's, and 64-bit timestamps don't wrap
+RECORD = struct.Struct('<BqQHBhbbbB')
+HEARTBEAT = struct.Struct('<BQ')
+ERROR = struct.Struct('<BqH')
+
+# frames carry timestamps relative to the process start, announced in the hello frame
+EPOCH = time.time()
+
+def timestamp_delta(timestamp):
+    return max(0, int(round((timestamp - EPOCH) * 100)))
+
+def pack_hello():
+    """First frame on a binary socket: epoch (float64 unix seconds) and the weather code table"""
+    table = json.dumps(WEATHER_CODES, separators=(',', ':')).encode('utf-8')
+    return struct.pack('<BBdH', FRAME_HELLO, 2, EPOCH, len(table)) + table
+
+@lru_cache(maxsize=4096)
+def _pack_record(pokemon_id, timestamp, energy_level, weather, temperature, weather_modifier,
+                 temp_modifier, location_modifier, near_route):
+    # every socket watching the Pokemon packs the same tick, so this is cached
+    code = WEATHER_CODE_BY_NAME.get(weather, OTHER_WEATHER)
+    record = RECORD.pack(
+        FRAME_ENERGY, pokemon_id, timestamp_delta(timestamp), int(round(energy_level * 100)), code,
+        NO_TEMPERATURE if temperature is None else int(round(temperature * 10)),
+        weather_modifier, temp_modifier, location_modifier, 1 if near_route else 0,
+    )
+    if code == OTHER_WEATHER:
+        # cut on a character boundary
+        text = weather.encode('utf-8')[:255].decode('utf-8', 'ignore').encode('utf-8')
+        record += bytes([len(text)]) + text
+    return record
+
+def pack_energy_record(event):
+    """Binary record for a scheduler energy.update event (error events become error frames)"""
+    if event.get('energy_level') is None:
+        error = json.loads(event['text']).get('error', '').encode('utf-8')[:65535].decode('utf-8', 'ignore').encode('utf-8')
+        return ERROR.pack(FRAME_ERROR, event['pokemon_id'], len(error)) + error
+    factors = event['factors']
+    return _pack_record(
+        event['pokemon_id'], event['timestamp'], event['energy_level'], factors.get('weather') or 'unknown',
+        factors.get('temperature'), factors.get('weather_modifier', 0), factors.get('temp_modifier', 0),
+        factors.get('location_modifier', 0), bool(factors.get('near_route')),
+    )
+
+def pack_heartbeat(timestamp = None):
+    return HEARTBEAT.pack(FRAME_HEARTBEAT, timestamp_delta(time.time() if timestamp is None else timestamp))
+
+def pack_batch(records):
+    return struct.pack('<BH', FRAME_BATCH, len(records)) + b''.join(records)
+
+def _unpack_one(data, offset, epoch):
+    frame_type = data[offset]
+    if frame_type == FRAME_ENERGY:
+        (_, pokemon_id, delta, energy, code, temperature, weather_modifier, temp_modifier,
+         location_modifier, flags) = RECORD.unpack_from(data, offset)
+        offset += RECORD.size
+        if code == OTHER_WEATHER:
+            length = data[offset]
+            weather = data[offset + 1:offset + 1 + length].decode('utf-8')
+            offset += 1 + length
+        else:
+            weather = WEATHER_CODES[code]
+        return {
+            'type': 'energy',
+            'pokemon_id': pokemon_id,
+            'timestamp': epoch + delta / 100,
+            'energy_level': energy / 100,
+            'factors': {
+                'weather': weather,
+                'temperature': None if temperature == NO_TEMPERATURE else temperature / 10,
+                'near_route': bool(flags & 1),
+                'weather_modifier': weather_modifier,
+                'temp_modifier': temp_modifier,
+                'location_modifier': location_modifier,
+            },
+        }, offset
+    if frame_type == FRAME_HEARTBEAT:
+        _, delta = HEARTBEAT.unpack_from(data, offset)
+        return {'type': 'heartbeat', 'timestamp': epoch + delta / 100}, offset + HEARTBEAT.size
+    if frame_type == FRAME_ERROR:
+        _, pokemon_id, length = ERROR.unpack_from(data, offset)
+        offset += ERROR.size
+        return {'type': 'error', 'pokemon_id': pokemon_id, 'error': data[offset:offset + length].decode('utf-8')}, offset + length
+    raise ValueError(f'Unknown frame type {frame_type}')
+
+def unpack_frame(data, epoch = EPOCH):
+    """Decode one binary message (the inverse of the pack_* helpers, for clients and tests)"""
+    if data[0] == FRAME_HELLO:
+        _, version, hello_epoch, length = struct.unpack_from('<BBdH', data)
+        return {'type': 'hello', 'version': version, 'epoch': hello_epoch, 'weather_codes': json.loads(data[12:12 + length])}
+    if data[0] == FRAME_BATCH:
+        (count,) = struct.unpack_from('<H', data, 1)
+        offset = 3
+        frames = []
+        for _ in range(count):
+            frame, offset = _unpack_one(data, offset, epoch)
+            frames.append(frame)
+        return {'type': 'batch', 'frames': frames}
+    return _unpack_one(data, 0, epoch)[0]
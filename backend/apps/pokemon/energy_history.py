@@ -0,0 +1,148 @@
+# apps/pokemon/energy_history.py
+
+# Recent energy readings per Pokemon in fixed-size array ring buffers
+import math
+import threading
+from array import array
+from collections import OrderedDict
+import numpy as np
+from django.conf import settings
+
+class EnergyRing:
+    """The last `capacity` (timestamp, energy) readings of one Pokemon
+
+    Timestamps are unix seconds (float64), energy levels float32; both arrays are allocated
+    once, so a ring costs 12 bytes per slot whatever happens.
+    """
+    __slots__ = ('timestamps', 'values', 'next', 'count')
+
+    def __init__(self, capacity):
+        self.timestamps = array('d', bytes(8 * capacity))
+        self.values = array('f', bytes(4 * capacity))
+        self.next = 0
+        self.count = 0
+
+    @property
+    def capacity(self):
+        return len(self.values)
+
+    @property
+    def nbytes(self):
+        return len(self.timestamps) * self.timestamps.itemsize + len(self.values) * self.values.itemsize
+
+    def append(self, timestamp, value):
+        self.timestamps[self.next] = timestamp
+        self.values[self.next] = value
+        self.next = (self.next + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def ordered(self):
+        """(timestamps, values) numpy copies, oldest first"""
+        timestamps = np.frombuffer(self.timestamps, dtype=np.float64)
+        values = np.frombuffer(self.values, dtype=np.float32)
+        if self.count < self.capacity:
+            return timestamps[:self.count].copy(), values[:self.count].copy()
+        return np.roll(timestamps, -self.next), np.roll(values, -self.next)
+
+class EnergyHistory:
+    """EnergyRing per Pokemon, filled by the energy scheduler's ticks
+
+    Rings hold POKEMON_ENERGY_HISTORY_SIZE readings; at most POKEMON_ENERGY_HISTORY_POKEMON
+    Pokemon are kept, the least recently ticked one is dropped first, so memory stays under
+    size * 12 bytes * Pokemon. History is per process: it covers the ticks this process ran.
+    Writes come from the event loop and reads from request threads, hence the lock.
+    """
+
+    def __init__(self, capacity = None, max_pokemon = None):
+        self._capacity = capacity
+        self._max_pokemon = max_pokemon
+        self._rings = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def capacity(self):
+        if self._capacity is not None:
+            return self._capacity
+        return getattr(settings, 'POKEMON_ENERGY_HISTORY_SIZE', 720)
+
+    @property
+    def max_pokemon(self):
+        if self._max_pokemon is not None:
+            return self._max_pokemon
+        return getattr(settings, 'POKEMON_ENERGY_HISTORY_POKEMON', 10000)
+
+    def record(self, pokemon_id, timestamp, energy_level):
+        with self._lock:
+            ring = self._rings.get(pokemon_id)
+            if ring is None:
+                ring = self._rings[pokemon_id] = EnergyRing(self.capacity)
+                while len(self._rings) > self.max_pokemon:
+                    self._rings.popitem(last=False)
+            else:
+                self._rings.move_to_end(pokemon_id)
+            ring.append(timestamp, energy_level)
+
+    def forget(self, pokemon_id):
+        with self._lock:
+            self._rings.pop(pokemon_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._rings.clear()
+
+    def readings(self, pokemon_id, since = None):
+        """(timestamps, energy levels) arrays, oldest first, optionally only after `since`"""
+        with self._lock:
+            ring = self._rings.get(pokemon_id)
+            if ring is None:
+                return np.empty(0), np.empty(0, dtype=np.float32)
+            timestamps, values = ring.ordered()
+        if since is not None:
+            keep = timestamps > since
+            timestamps, values = timestamps[keep], values[keep]
+        return timestamps, values
+
+    def series(self, pokemon_id, since = None):
+        """Readings as JSON-ready lists: {'timestamps': [...], 'energy_levels': [...]}"""
+        timestamps, values = self.readings(pokemon_id, since=since)
+        return {
+            'timestamps': np.round(timestamps, 3).tolist(),
+            'energy_levels': np.round(values.astype(float), 2).tolist(),
+        }
+
+    def downsample(self, pokemon_id, window, resolution, now):
+        """min/max/mean/count of the readings in each `resolution` second bucket of the last `window` seconds
+
+        Columnar, empty buckets left out; timestamps are the bucket starts.
+        """
+        start = now - window
+        timestamps, values = self.readings(pokemon_id, since=start)
+        buckets = math.ceil(window / resolution)
+        index = np.minimum(((timestamps - start) // resolution).astype(np.intp), buckets - 1)
+        counts = np.bincount(index, minlength=buckets)
+        sums = np.bincount(index, weights=values, minlength=buckets)
+        lows = np.full(buckets, np.inf)
+        highs = np.full(buckets, -np.inf)
+        np.minimum.at(lows, index, values)
+        np.maximum.at(highs, index, values)
+        filled = counts > 0
+        return {
+            'timestamps': np.round(start + np.flatnonzero(filled) * resolution, 3).tolist(),
+            'min': np.round(lows[filled], 2).tolist(),
+            'max': np.round(highs[filled], 2).tolist(),
+            'mean': np.round(sums[filled] / counts[filled], 2).tolist(),
+            'count': counts[filled].tolist(),
+        }
+
+    def metrics(self):
+        with self._lock:
+            rings = list(self._rings.values())
+        return {
+            'pokemon': len(rings),
+            'max_pokemon': self.max_pokemon,
+            'readings_per_pokemon': self.capacity,
+            'bytes_per_pokemon': self.capacity * 12,
+            'bytes': sum(ring.nbytes for ring in rings),
+        }
+
+energy_history = EnergyHistory()
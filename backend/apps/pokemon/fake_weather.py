@@ -0,0 +1,55 @@
+# apps/pokemon/fake_weather.py
+
+# Local stand-in for the OpenWeatherMap current weather endpoint (tests and load tests)
+import asyncio
+from aiohttp import web
+
+class FakeWeatherServer:
+    """Serves GET /data/2.5/weather on 127.0.0.1 with a configurable answer
+
+    Point OPENWEATHER_API_URL at server.url. description/temperature/status/delay can be
+    changed between requests; requests counts the calls received and peers the distinct
+    client connections they arrived on.
+    """
+
+    def __init__(self, description = 'clear sky', temperature = 20.0, status = 200, delay = 0.0):
+        self.description = description
+        self.temperature = temperature
+        self.status = status
+        self.delay = delay
+        self.requests = 0
+        self.peers = set()
+        self._runner = None
+        self._port = None
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self._port}/data/2.5/weather'
+
+    async def handle_weather(self, request):
+        self.requests += 1
+        self.peers.add(request.transport.get_extra_info('peername'))
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        if self.status != 200:
+            return web.json_response({'message': 'error'}, status=self.status)
+        return web.json_response({
+            'coord': {'lat': float(request.query.get('lat', 0)), 'lon': float(request.query.get('lon', 0))},
+            'weather': [{'description': self.description}],
+            'main': {'temp': self.temperature},
+        })
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/data/2.5/weather', self.handle_weather)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, '127.0.0.1', 0)
+        await site.start()
+        self._port = site._server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
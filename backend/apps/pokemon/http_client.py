@@ -0,0 +1,137 @@
+# apps/pokemon/http_client.py
+
+# Long-lived outbound HTTP client for async code in the pokemon app (weather lookups etc.)
+import asyncio
+import sys
+import weakref
+import aiohttp
+from django.conf import settings
+
+def client_settings():
+    """Pool/timeout settings, read when a session is created"""
+    return {
+        'limit': getattr(settings, 'POKEMON_HTTP_POOL_LIMIT', 100),
+        'limit_per_host': getattr(settings, 'POKEMON_HTTP_POOL_LIMIT_PER_HOST', 20),
+        'dns_ttl': getattr(settings, 'POKEMON_HTTP_DNS_TTL', 300),
+        'keepalive': getattr(settings, 'POKEMON_HTTP_KEEPALIVE', 30),
+        'connect_timeout': getattr(settings, 'POKEMON_HTTP_CONNECT_TIMEOUT', 3),
+        'read_timeout': getattr(settings, 'POKEMON_HTTP_READ_TIMEOUT', 5),
+        'total_timeout': getattr(settings, 'POKEMON_HTTP_TOTAL_TIMEOUT', 8),
+    }
+
+class ClientSessionPool:
+    """One pooled aiohttp.ClientSession per event loop
+
+    aiohttp sessions are bound to the loop they were created on, so the pool keeps one per
+    running loop (normally just the server's). Sessions share a bounded keep-alive connector
+    with DNS caching and strict timeouts, and are closed by close_all() when the server shuts
+    down (see ServerLifecycle).
+    """
+
+    def __init__(self):
+        self._sessions = weakref.WeakKeyDictionary()
+
+    def get(self):
+        loop = asyncio.get_running_loop()
+        session = self._sessions.get(loop)
+        if session is None:
+            session = self._create()
+            self._sessions[loop] = session
+        return session
+
+    def _create(self):
+        config = client_settings()
+        connector = aiohttp.TCPConnector(
+            limit=config['limit'],
+            limit_per_host=config['limit_per_host'],
+            ttl_dns_cache=config['dns_ttl'],
+            keepalive_timeout=config['keepalive'],
+        )
+        timeout = aiohttp.ClientTimeout(
+            total=config['total_timeout'],
+            sock_connect=config['connect_timeout'],
+            sock_read=config['read_timeout'],
+        )
+        return aiohttp.ClientSession(connector=connector, timeout=timeout, raise_for_status=False)
+
+    async def close_all(self):
+        """Close the sessions of the current loop, forget the ones bound to other loops"""
+        loop = asyncio.get_running_loop()
+        sessions = list(self._sessions.items())
+        self._sessions.clear()
+        for session_loop, session in sessions:
+            if session_loop is loop and not session.closed:
+                try:
+                    await session.close()
+                except Exception as e:
+                    print(f"Error closing HTTP client session: {e}")
+
+client_sessions = ClientSessionPool()
+
+def get_client_session():
+    """The shared session for the running loop (do not close it, or use it as a context manager)"""
+    return client_sessions.get()
+
+class ServerLifecycle:
+    """Per-process services: starts the cache invalidation listener with the first connection,
+    closes the pooled sessions and route proximity workers once when the server stops
+
+    Servers that speak ASGI lifespan (uvicorn, hypercorn) get there through LifespanApp.
+    daphne never sends lifespan events, so the first connection on a loop also registers a
+    "before shutdown" trigger on daphne's Twisted reactor: it runs on the same asyncio loop,
+    after SIGINT/SIGTERM and before the loop stops.
+    """
+
+    def __init__(self):
+        self._loop = None
+        self._stopped = False
+
+    def started(self):
+        """Called for every connection, only does work on a new loop"""
+        loop = asyncio.get_running_loop()
+        if self._loop is loop:
+            return
+        self._loop = loop
+        self._stopped = False
+        # imported here, it imports the app's models
+        from .invalidation import cache_invalidator
+        cache_invalidator.ensure_running()
+        reactor = sys.modules.get('twisted.internet.reactor')
+        if reactor is not None and getattr(reactor, 'running', False):
+            from twisted.internet import defer
+            reactor.addSystemEventTrigger(
+                'before', 'shutdown', lambda: defer.Deferred.fromFuture(asyncio.ensure_future(self.shutdown()))
+            )
+
+    async def shutdown(self):
+        if self._stopped:
+            return
+        self._stopped = True
+        await client_sessions.close_all()
+        # imported here, energy imports this module
+        from .energy import route_proximity
+        from .invalidation import cache_invalidator
+        route_proximity.shutdown()
+        await cache_invalidator.stop()
+        print('Closed the outbound HTTP sessions and route proximity workers', flush=True)
+
+server_lifecycle = ServerLifecycle()
+
+class LifespanApp:
+    """Outermost ASGI app: answers lifespan events and hooks every other connection into ServerLifecycle"""
+
+    def __init__(self, app = None):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'lifespan':
+            server_lifecycle.started()
+            return await self.app(scope, receive, send)
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await server_lifecycle.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
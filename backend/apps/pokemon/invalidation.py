@@ -0,0 +1,143 @@
+# apps/pokemon/invalidation.py
+
+# Fans Pokemon cache invalidations out to the other worker processes over the channel layer
+import asyncio
+import threading
+import uuid
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.db import transaction
+from .snapshot import shared_map_snapshot
+from .pokemon_state import pokemon_states
+from .energy_history import energy_history
+
+INVALIDATION_GROUP = 'pokemon_invalidations'
+# the layer drops group members after group_expiry (or an expired message), so listeners re-join
+REJOIN_INTERVAL = 60
+
+class CacheInvalidator:
+    """Keeps the per-process Pokemon caches of every worker in step with committed writes
+
+    The signal handlers invalidate this process's map snapshot, Pokemon states and energy
+    history; record() also collects the ids per thread and sends everything a transaction
+    wrote to INVALIDATION_GROUP as one message once it commits (a rollback drops them with
+    the on_commit callback). Each process listens on its own channel of that group
+    (ensure_running(), started for every connection by ServerLifecycle) and applies the
+    invalidations sent by the others.
+    """
+
+    def __init__(self, channel_layer = None):
+        self._channel_layer = channel_layer
+        self._local = threading.local()
+        self.origin = uuid.uuid4().hex
+        self._loop = None
+        self._task = None
+        self.received = 0
+
+    @property
+    def channel_layer(self):
+        if self._channel_layer is not None:
+            return self._channel_layer
+        return get_channel_layer()
+
+    def _state(self):
+        if not hasattr(self._local, 'flush'):
+            self._local.flush = None
+            self._local.pending = {}
+        return self._local
+
+    def record(self, pokemon_ids, forget_history = False):
+        state = self._state()
+        scheduled = self._flush_scheduled(state)
+        if not scheduled:
+            # a new batch per transaction
+            state.pending = {}
+        for pokemon_id in pokemon_ids:
+            if pokemon_id is not None:
+                state.pending[pokemon_id] = forget_history or state.pending.get(pokemon_id, False)
+        if state.pending and not scheduled:
+            pending = state.pending
+
+            def flush():
+                state.flush = None
+                self.flush(pending)
+            # outside a transaction this runs right away
+            state.flush = flush
+            transaction.on_commit(flush)
+
+    def _flush_scheduled(self, state):
+        # a rollback drops the callback, and the batch with it
+        connection = transaction.get_connection()
+        return state.flush is not None and any(func is state.flush for _, func, _ in connection.run_on_commit)
+
+    def flush(self, pending):
+        self.publish(sorted(pending), sorted(pokemon_id for pokemon_id, forget in pending.items() if forget))
+
+    def publish(self, pokemon_ids, forget_history = ()):
+        if self.channel_layer is None:
+            return
+        try:
+            async_to_sync(self.send)(pokemon_ids, forget_history)
+        except Exception as e:
+            # the other workers catch up on their next invalidation, never fail the write
+            print(f"Error publishing Pokemon invalidations: {e}")
+
+    async def send(self, pokemon_ids, forget_history = ()):
+        """forget_history: the ids whose energy history is dropped too (deleted or new Pokemon)"""
+        await self.channel_layer.group_send(INVALIDATION_GROUP, {
+            'type': 'pokemon.invalidate',
+            'origin': self.origin,
+            'ids': list(pokemon_ids),
+            'forget_history': list(forget_history),
+        })
+
+    def apply(self, message):
+        if message.get('origin') == self.origin:
+            return
+        self.received += 1
+        for pokemon_id in message['ids']:
+            pokemon_states.invalidate(pokemon_id)
+        for pokemon_id in message['forget_history']:
+            energy_history.forget(pokemon_id)
+        shared_map_snapshot.invalidate(committed=True)
+
+    def ensure_running(self):
+        loop = asyncio.get_running_loop()
+        if self._task is not None and not self._task.done() and self._loop is loop:
+            return
+        if self.channel_layer is None:
+            return
+        self._loop = loop
+        self._task = loop.create_task(self.run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def run(self):
+        channel_layer = self.channel_layer
+        channel = await channel_layer.new_channel()
+        loop = asyncio.get_running_loop()
+        joined = None
+        while True:
+            try:
+                if joined is None or loop.time() - joined >= REJOIN_INTERVAL:
+                    await channel_layer.group_add(INVALIDATION_GROUP, channel)
+                    joined = loop.time()
+                try:
+                    message = await asyncio.wait_for(channel_layer.receive(channel), REJOIN_INTERVAL)
+                except asyncio.TimeoutError:
+                    continue
+                self.apply(message)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Error applying Pokemon invalidations: {e}")
+                await asyncio.sleep(1)
+
+cache_invalidator = CacheInvalidator()
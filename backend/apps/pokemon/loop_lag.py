@@ -0,0 +1,50 @@
+# apps/pokemon/loop_lag.py
+
+# Event loop lag: how late the loop runs a timer, i.e. how long something blocked it
+import asyncio
+import time
+from .resilience import LatencyRecorder
+
+class LoopLagMonitor:
+    """Sleeps `interval` seconds in a loop and records how much later than that it woke up
+
+    A callback hogging the loop (CPU work, a blocking call) shows up as lag of about its
+    duration. Runs per event loop, started by the energy consumers.
+    """
+
+    def __init__(self, interval = 0.05, clock = time.monotonic):
+        self.interval = interval
+        self.clock = clock
+        self.lag = LatencyRecorder()
+        self._task = None
+
+    def ensure_running(self):
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done() or self._task.get_loop() is not loop:
+            self._task = loop.create_task(self.run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def run(self):
+        while True:
+            started = self.clock()
+            await asyncio.sleep(self.interval)
+            self.lag.record(max(0.0, self.clock() - started - self.interval))
+
+    def clear(self):
+        self.lag.clear()
+
+    def metrics(self):
+        return {
+            'interval_ms': self.interval * 1000,
+            'lag': self.lag.snapshot(),
+        }
+
+loop_lag_monitor = LoopLagMonitor()
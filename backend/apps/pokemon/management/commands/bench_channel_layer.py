@@ -0,0 +1,115 @@
+"""
+Django management command to benchmark group_send throughput of the channel layers
+Usage: python manage.py bench_channel_layer [--messages 2000] [--subscribers 20] [--processes 4]
+"""
+import asyncio
+import multiprocessing
+import os
+import tempfile
+import time
+from channels.layers import InMemoryChannelLayer
+from django.core.management.base import BaseCommand
+from apps.pokemon.channel_layer import SQLiteChannelLayer
+
+GROUP = 'bench'
+
+async def receive_all(layer, channels, messages):
+    async def drain(channel):
+        for _ in range(messages):
+            await layer.receive(channel)
+    await asyncio.gather(*[drain(channel) for channel in channels])
+
+async def subscribe(layer, subscribers):
+    channels = [await layer.new_channel() for _ in range(subscribers)]
+    for channel in channels:
+        await layer.group_add(GROUP, channel)
+    return channels
+
+async def send_all(layer, messages):
+    for i in range(messages):
+        await layer.group_send(GROUP, {'type': 'energy.update', 'pokemon_id': i, 'text': '{"energy_level": 50.0}'})
+
+async def bench_single_process(layer, messages, subscribers):
+    channels = await subscribe(layer, subscribers)
+    start = time.perf_counter()
+    receivers = asyncio.ensure_future(receive_all(layer, channels, messages))
+    await send_all(layer, messages)
+    await receivers
+    elapsed = time.perf_counter() - start
+    await layer.flush()
+    return elapsed
+
+def worker(path, messages, subscribers, ready, done):
+    """Receiving side of the cross-process run, one per process"""
+    async def run():
+        layer = SQLiteChannelLayer(path, capacity=messages)
+        channels = await subscribe(layer, subscribers)
+        ready.put(os.getpid())
+        await receive_all(layer, channels, messages)
+        done.put(time.perf_counter())
+        await layer.close()
+    asyncio.run(run())
+
+def bench_cross_process(path, messages, subscribers, processes):
+    context = multiprocessing.get_context('spawn')
+    ready = context.Queue()
+    done = context.Queue()
+    per_process = max(1, subscribers // processes)
+    workers = [
+        context.Process(target=worker, args=(path, messages, per_process, ready, done))
+        for _ in range(processes)
+    ]
+    for process in workers:
+        process.start()
+    for _ in workers:
+        ready.get(timeout=60)
+
+    async def send():
+        layer = SQLiteChannelLayer(path, capacity=messages)
+        start = time.perf_counter()
+        await send_all(layer, messages)
+        await layer.close()
+        return start
+
+    start = asyncio.run(send())
+    finished = max(done.get(timeout=300) for _ in workers)
+    for process in workers:
+        process.join()
+    return finished - start, per_process * processes
+
+
+class Command(BaseCommand):
+    help = 'Benchmark group_send -> receive throughput of InMemoryChannelLayer vs SQLiteChannelLayer'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=2000, help='Group messages to send')
+        parser.add_argument('--subscribers', type=int, default=20, help='Channels in the group')
+        parser.add_argument('--processes', type=int, default=4, help='Receiving processes for the cross-process run')
+
+    def report(self, label, elapsed, delivered):
+        self.stdout.write(f'{label:28} {delivered / elapsed:10.0f} deliveries/s ({delivered} in {elapsed:.2f}s)')
+
+    def handle(self, *args, **options):
+        messages = options['messages']
+        subscribers = options['subscribers']
+        processes = options['processes']
+
+        elapsed = asyncio.run(bench_single_process(InMemoryChannelLayer(capacity=messages), messages, subscribers))
+        self.report('in-memory, 1 process', elapsed, messages * subscribers)
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'layer.sqlite3')
+
+            async def sqlite_single():
+                layer = SQLiteChannelLayer(path, capacity=messages)
+                try:
+                    return await bench_single_process(layer, messages, subscribers)
+                finally:
+                    await layer.close()
+
+            elapsed = asyncio.run(sqlite_single())
+            self.report('sqlite, 1 process', elapsed, messages * subscribers)
+
+            if processes > 0:
+                elapsed, total_subscribers = bench_cross_process(path, messages, subscribers, processes)
+                self.report(f'sqlite, {processes} processes', elapsed, messages * total_subscribers)
@@ -0,0 +1,290 @@
+"""
+Django management command to load test the energy WebSockets of one daphne process
+Usage: python manage.py loadtest_energy [--clients 1000] [--pokemon 50] [--distribution zipf] [--duration 30] [--output results.json]
+"""
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+import aiohttp
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework.authtoken.models import Token
+from apps.pokemon.fake_weather import FakeWeatherServer
+from apps.pokemon.loop_lag import LoopLagMonitor
+from apps.pokemon.models import Pokemon
+
+LOADTEST_PREFIX = 'Loadtest'
+STAFF_USERNAME = 'loadtest-energy-staff'
+
+def raise_fd_limit():
+    """Lift the open file soft limit to the hard limit (each client is a socket on both ends)"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+def rss_bytes(pid):
+    """Resident set size of a process (Linux /proc), None where unavailable"""
+    try:
+        with open(f'/proc/{pid}/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+    return None
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def summarize(seconds):
+    """count and p50/p95/p99/max in ms of a list of durations in seconds"""
+    if not seconds:
+        return {'count': 0, 'p50_ms': None, 'p95_ms': None, 'p99_ms': None, 'max_ms': None}
+    ordered = sorted(seconds)
+
+    def at(fraction):
+        return round(ordered[min(len(ordered) - 1, int(len(ordered) * fraction))] * 1000, 2)
+
+    return {'count': len(ordered), 'p50_ms': at(0.5), 'p95_ms': at(0.95), 'p99_ms': at(0.99), 'max_ms': round(ordered[-1] * 1000, 2)}
+
+def assign_pokemon(ids, clients, distribution, skew, rng):
+    """Pokemon id of every client: uniform, or zipf (a few hot Pokemon, a long tail)"""
+    if distribution == 'zipf':
+        weights = [1 / (rank ** skew) for rank in range(1, len(ids) + 1)]
+        return rng.choices(ids, weights=weights, k=clients)
+    return [ids[i % len(ids)] for i in range(clients)]
+
+class ClientResult:
+    __slots__ = ('connect', 'first_frame', 'frame_times', 'error')
+
+    def __init__(self):
+        self.connect = None
+        self.first_frame = None
+        self.frame_times = []
+        self.error = None
+
+async def run_client(session, url, stop_at, handshakes, result):
+    started = time.perf_counter()
+    try:
+        async with handshakes:
+            websocket = await session.ws_connect(url, origin='http://127.0.0.1', heartbeat=None)
+        result.connect = time.perf_counter() - started
+        async with websocket:
+            while True:
+                remaining = stop_at - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    message = await websocket.receive(timeout=remaining)
+                except asyncio.TimeoutError:
+                    break
+                if message.type != aiohttp.WSMsgType.TEXT:
+                    result.error = f'socket closed ({message.type.name})'
+                    break
+                now = time.perf_counter()
+                if result.first_frame is None:
+                    result.first_frame = now - started
+                result.frame_times.append(now)
+    except Exception as e:
+        result.error = str(e) or type(e).__name__
+
+async def wait_for_port(port, process, timeout = 30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise CommandError(f'daphne exited with code {process.returncode}')
+        try:
+            _, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.2)
+    raise CommandError('daphne did not start listening')
+
+async def sample_rss(pid, samples, interval = 0.5):
+    while True:
+        rss = rss_bytes(pid)
+        if rss is not None:
+            samples.append(rss)
+        await asyncio.sleep(interval)
+
+async def fetch_metrics(session, base_url, token):
+    async with session.get(f'{base_url}/api/pokemon/realtime_metrics/', headers={'Authorization': f'Token {token}'}) as response:
+        if response.status != 200:
+            return None
+        return await response.json()
+
+
+class Command(BaseCommand):
+    help = 'Open many energy WebSockets against a local daphne process fed by a fake weather server and report its capacity'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clients', type=int, default=1000, help='Concurrent ws/pokemon/<id>/energy/ clients')
+        parser.add_argument('--pokemon', type=int, default=50, help='Distinct Pokemon the clients watch')
+        parser.add_argument('--distribution', choices=['uniform', 'zipf'], default='uniform', help='How clients spread over the Pokemon')
+        parser.add_argument('--skew', type=float, default=1.1, help='Zipf exponent for --distribution zipf')
+        parser.add_argument('--duration', type=float, default=30.0, help='Seconds to hold the sockets open once all are connected')
+        parser.add_argument('--handshakes', type=int, default=200, help='WebSocket handshakes in flight at once')
+        parser.add_argument('--weather-delay', type=float, default=0.05, help='Seconds the fake weather server takes to answer')
+        parser.add_argument('--seed', type=int, default=1, help='Seed for the client -> Pokemon assignment')
+        parser.add_argument('--output', help='Write the results as JSON to this file ("-" for stdout)')
+
+    def prepare_pokemon(self, count):
+        """Ids of `count` Pokemon, creating (and returning for cleanup) the ones missing"""
+        ids = list(Pokemon.objects.order_by('id').values_list('id', flat=True)[:count])
+        created = []
+        if len(ids) < count:
+            rng = random.Random(0)
+            new = Pokemon.objects.bulk_create([
+                Pokemon(
+                    name=f'{LOADTEST_PREFIX} {i}', latitude=34.0 + rng.uniform(-1, 1), longitude=-118.0 + rng.uniform(-1, 1),
+                    type_primary='normal', sprite='https://example.com/loadtest.png', source='API',
+                )
+                for i in range(count - len(ids))
+            ])
+            created = [pokemon.id for pokemon in new]
+            if None in created:
+                created = list(Pokemon.objects.filter(name__startswith=LOADTEST_PREFIX).values_list('id', flat=True))
+            ids += created
+        return ids, created
+
+    def handle(self, *args, **options):
+        fd_limit = raise_fd_limit()
+        if fd_limit is not None and fd_limit < 2 * options['clients'] + 100:
+            self.stderr.write(f'Open file limit is {fd_limit}, too low for {options["clients"]} clients on both ends')
+
+        ids, created = self.prepare_pokemon(options['pokemon'])
+        if not ids:
+            raise CommandError('No Pokemon to watch')
+        staff, _ = User.objects.get_or_create(username=STAFF_USERNAME, defaults={'is_staff': True})
+        token, _ = Token.objects.get_or_create(user=staff)
+        try:
+            results = asyncio.run(self.run(options, ids, token.key))
+        finally:
+            staff.delete()
+            if created:
+                Pokemon.objects.filter(id__in=created).delete()
+
+        self.report(results)
+        if options['output'] == '-':
+            self.stdout.write(json.dumps(results, indent=2))
+        elif options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump(results, output, indent=2)
+
+    async def run(self, options, ids, token):
+        weather = await FakeWeatherServer(delay=options['weather_delay']).start()
+        port = free_port()
+        env = dict(os.environ, OPENWEATHER_API_URL=weather.url, OPENWEATHER_API_KEY='loadtest')
+        process = subprocess.Popen(
+            [sys.executable, '-m', 'daphne', '-b', '127.0.0.1', '-p', str(port), 'pokemon_api.asgi:application'],
+            cwd=settings.BASE_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        rss_samples = []
+        sampler = None
+        monitor = LoopLagMonitor()
+        try:
+            await wait_for_port(port, process)
+            rss_idle = rss_bytes(process.pid)
+            sampler = asyncio.ensure_future(sample_rss(process.pid, rss_samples))
+            monitor.ensure_running()
+
+            assignment = assign_pokemon(ids, options['clients'], options['distribution'], options['skew'], random.Random(options['seed']))
+            clients = [ClientResult() for _ in assignment]
+            connector = aiohttp.TCPConnector(limit=0)
+            async with aiohttp.ClientSession(connector=connector) as session:
+                handshakes = asyncio.Semaphore(options['handshakes'])
+                started = time.perf_counter()
+                # generous upper bound, every client stops reading at stop_at
+                stop_at = started + options['duration'] + options['clients'] / 50 + 10
+                tasks = [
+                    asyncio.ensure_future(run_client(session, f'ws://127.0.0.1:{port}/ws/pokemon/{pokemon_id}/energy/', stop_at, handshakes, result))
+                    for pokemon_id, result in zip(assignment, clients)
+                ]
+                while any(result.connect is None and result.error is None for result in clients):
+                    await asyncio.sleep(0.05)
+                connected_at = time.perf_counter()
+                window_end = connected_at + options['duration']
+                await asyncio.sleep(options['duration'])
+                server = await fetch_metrics(session, f'http://127.0.0.1:{port}', token)
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+        finally:
+            if sampler is not None:
+                sampler.cancel()
+            await monitor.stop()
+            process.terminate()
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+            await weather.stop()
+
+        interval = (server or {}).get('energy', {}).get('interval') or 5.0
+        jitter = []
+        frames_in_window = 0
+        for result in clients:
+            times = result.frame_times
+            # the first frame may be the cached one sent on connect and the first tick of a Pokemon
+            # is not on an interval boundary, so steady-state gaps start at the second
+            jitter += [abs((later - earlier) - interval) for earlier, later in zip(times[1:], times[2:])]
+            frames_in_window += sum(1 for moment in times if connected_at <= moment <= window_end)
+
+        return {
+            'config': {key: options[key] for key in ('clients', 'pokemon', 'distribution', 'skew', 'duration', 'handshakes', 'weather_delay', 'seed')},
+            'connect': {
+                'ok': sum(1 for result in clients if result.connect is not None),
+                'failed': sum(1 for result in clients if result.connect is None),
+                'ramp_seconds': round(connected_at - started, 3),
+                'latency': summarize([result.connect for result in clients if result.connect is not None]),
+                'first_frame': summarize([result.first_frame for result in clients if result.first_frame is not None]),
+            },
+            'frames': {
+                'received': sum(len(result.frame_times) for result in clients),
+                'per_second': round(frames_in_window / options['duration'], 1),
+                'errors': sum(1 for result in clients if result.error is not None and result.connect is not None),
+            },
+            'tick_interval': interval,
+            'tick_jitter': summarize(jitter),
+            'server': {
+                'rss_idle_bytes': rss_idle,
+                'rss_peak_bytes': max(rss_samples) if rss_samples else None,
+                'event_loop_lag': (server or {}).get('event_loop', {}).get('lag'),
+                'weather_upstream_calls': weather.requests,
+                'metrics': server,
+            },
+            'client_event_loop_lag': monitor.lag.snapshot(),
+        }
+
+    def report(self, results):
+        def ms(summary):
+            if not summary or not summary.get('count'):
+                return 'n/a'
+            return f"p50 {summary['p50_ms']:.1f} / p95 {summary['p95_ms']:.1f} / p99 {summary['p99_ms']:.1f} / max {summary['max_ms']:.1f} ms"
+
+        connect = results['connect']
+        server = results['server']
+        self.stdout.write(f"clients            {connect['ok']} connected, {connect['failed']} failed in {connect['ramp_seconds']:.2f}s")
+        self.stdout.write(f"connect latency    {ms(connect['latency'])}")
+        self.stdout.write(f"first frame        {ms(connect['first_frame'])}")
+        self.stdout.write(f"frames/s           {results['frames']['per_second']} ({results['frames']['errors']} sockets dropped)")
+        self.stdout.write(f"tick jitter        {ms(results['tick_jitter'])} (interval {results['tick_interval']}s)")
+        if server['rss_peak_bytes'] is not None:
+            self.stdout.write(f"server RSS         {server['rss_idle_bytes'] / 2 ** 20:.1f} MiB idle, {server['rss_peak_bytes'] / 2 ** 20:.1f} MiB peak")
+        self.stdout.write(f"server loop lag    {ms(server['event_loop_lag'])}")
+        self.stdout.write(f"client loop lag    {ms(results['client_event_loop_lag'])}")
+        self.stdout.write(f"weather requests   {server['weather_upstream_calls']}")
@@ -0,0 +1,114 @@
+# apps/pokemon/mapdata.py
+
+# Compact struct-of-arrays encodings of the all_for_map dataset
+import json
+import os
+import struct
+
+# the only fields the map markers/popups read
+MAP_FIELDS = ['id', 'name', 'latitude', 'longitude', 'sprite', 'type_primary', 'type_secondary']
+
+BINARY_MAGIC = b'PKM2'
+# struct codes by byte width, for the integer columns
+UINT_CODES = {1: 'B', 2: 'H', 4: 'I', 8: 'Q'}
+
+def build_columnar_payload(rows, favorite_ids = ()):
+    """Build struct-of-arrays JSON from (id, name, lat, lon, sprite, type_primary, type_secondary) tuples
+
+    coords packs lat/lon pairs into one flat array, types are small integer codes into the
+    types lookup table, and sprites are stored as suffixes of their longest common prefix.
+    """
+    ids = []
+    names = []
+    coords = []
+    sprites = []
+    type_primary = []
+    type_secondary = []
+    type_codes = {'': 0}
+
+    for pokemon_id, name, latitude, longitude, sprite, primary, secondary in rows:
+        ids.append(pokemon_id)
+        names.append(name)
+        coords.append(latitude)
+        coords.append(longitude)
+        sprites.append(sprite or '')
+        type_primary.append(type_codes.setdefault(primary or '', len(type_codes)))
+        type_secondary.append(type_codes.setdefault(secondary or '', len(type_codes)))
+
+    sprite_prefix = os.path.commonprefix(sprites) if len(sprites) > 1 else ''
+
+    return {
+        'count': len(ids),
+        'ids': ids,
+        'names': names,
+        'coords': coords,
+        'sprite_prefix': sprite_prefix,
+        'sprites': [sprite[len(sprite_prefix):] for sprite in sprites],
+        'types': list(type_codes),
+        'type_primary': type_primary,
+        'type_secondary': type_secondary,
+        'favorite_ids': list(favorite_ids),
+    }
+
+def uint_width(values, widths):
+    """Smallest of the byte widths whose unsigned range holds every value"""
+    largest = max(values, default=0)
+    for width in widths:
+        if largest < 1 << (8 * width):
+            return width
+    raise ValueError(f'{largest} does not fit in {widths[-1]} bytes')
+
+def pack_columnar_binary(payload):
+    """Pack a columnar payload into little-endian binary
+
+    Layout: b'PKM2', uint32 count, uint32 meta length, UTF-8 JSON meta (names, sprites,
+    types, favorite_ids, id_bytes, type_bytes) space-padded so the columns start on an
+    8 byte boundary, then ids[count], float32 coords[2 * count], type_primary[count],
+    type_secondary[count]. ids are uint32, or uint64 once an id passes 2**32 - 1; type
+    codes are uint8, or uint16/uint32 when there are more distinct types.
+    """
+    count = payload['count']
+    id_bytes = uint_width(payload['ids'], (4, 8))
+    type_bytes = uint_width([len(payload['types']) - 1], (1, 2, 4))
+    meta = json.dumps({
+        'names': payload['names'],
+        'sprite_prefix': payload['sprite_prefix'],
+        'sprites': payload['sprites'],
+        'types': payload['types'],
+        'favorite_ids': payload['favorite_ids'],
+        'id_bytes': id_bytes,
+        'type_bytes': type_bytes,
+    }, separators=(',', ':')).encode('utf-8')
+    meta += b' ' * (-(12 + len(meta)) % 8)
+
+    type_code = UINT_CODES[type_bytes]
+    return b''.join([
+        BINARY_MAGIC,
+        struct.pack('<II', count, len(meta)),
+        meta,
+        struct.pack(f'<{count}{UINT_CODES[id_bytes]}', *payload['ids']),
+        struct.pack(f'<{2 * count}f', *payload['coords']),
+        struct.pack(f'<{count}{type_code}', *payload['type_primary']),
+        struct.pack(f'<{count}{type_code}', *payload['type_secondary']),
+    ])
+
+def unpack_columnar_binary(data):
+    """Inverse of pack_columnar_binary (coordinates come back at float32 precision)"""
+    if data[:4] != BINARY_MAGIC:
+        raise ValueError('Not a columnar map payload')
+    count, meta_length = struct.unpack_from('<II', data, 4)
+    offset = 12
+    payload = json.loads(data[offset:offset + meta_length])
+    offset += meta_length
+    payload['count'] = count
+    id_bytes = payload.pop('id_bytes')
+    type_bytes = payload.pop('type_bytes')
+    payload['ids'] = list(struct.unpack_from(f'<{count}{UINT_CODES[id_bytes]}', data, offset))
+    offset += id_bytes * count
+    payload['coords'] = list(struct.unpack_from(f'<{2 * count}f', data, offset))
+    offset += 8 * count
+    type_code = UINT_CODES[type_bytes]
+    payload['type_primary'] = list(struct.unpack_from(f'<{count}{type_code}', data, offset))
+    offset += type_bytes * count
+    payload['type_secondary'] = list(struct.unpack_from(f'<{count}{type_code}', data, offset))
+    return payload
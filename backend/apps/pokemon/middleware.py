@@ -0,0 +1,12 @@
+# apps/pokemon/middleware.py
+
+from .broadcast import map_broadcaster
+
+class MapBroadcastMiddleware:
+    """Coalesce every Pokemon write committed during a request into one live map message"""
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with map_broadcaster.batch():
+            return self.get_response(request)
@@ -0,0 +1,25 @@
+# Generated by Django 4.2.30 on 2026-10-19 10:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pokemon', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='pokemon',
+            index=models.Index(fields=['name', 'type_primary', 'type_secondary', 'category'], name='pokemon_name_search_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='pokemon',
+            index=models.Index(fields=['source', 'name'], name='pokemon_source_name_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='pokemon',
+            index=models.Index(fields=['type_primary', 'name'], name='pokemon_type_name_idx'),
+        ),
+    ]
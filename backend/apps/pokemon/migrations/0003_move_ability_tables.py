@@ -0,0 +1,82 @@
+# Generated by Django 4.2.30 on 2026-10-19 10:27
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def backfill_links(apps, schema_editor):
+    """Populate the through-tables from the existing moves/abilities JSON fields"""
+    Pokemon = apps.get_model('pokemon', 'Pokemon')
+    for attr, model_name, link_model_name, link_field in [
+        ('moves', 'Move', 'PokemonMove', 'move'),
+        ('abilities', 'Ability', 'PokemonAbility', 'ability'),
+    ]:
+        model = apps.get_model('pokemon', model_name)
+        link_model = apps.get_model('pokemon', link_model_name)
+        ids = {}
+        links = []
+        for pokemon_id, names in Pokemon.objects.values_list('id', attr).iterator():
+            normalized = {
+                name.strip().lower().replace(' ', '-')
+                for name in names or [] if isinstance(name, str) and name.strip()
+            }
+            for name in normalized:
+                if name not in ids:
+                    ids[name] = model.objects.get_or_create(name=name)[0].id
+                links.append(link_model(pokemon_id=pokemon_id, **{f'{link_field}_id': ids[name]}))
+        link_model.objects.bulk_create(links, batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pokemon', '0002_pokemon_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Ability',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True)),
+            ],
+            options={
+                'verbose_name_plural': 'abilities',
+                'ordering': ['name'],
+            },
+        ),
+        migrations.CreateModel(
+            name='Move',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True)),
+            ],
+            options={
+                'ordering': ['name'],
+            },
+        ),
+        migrations.CreateModel(
+            name='PokemonMove',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('move', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='pokemon_links', to='pokemon.move')),
+                ('pokemon', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='move_links', to='pokemon.pokemon')),
+            ],
+            options={
+                'unique_together': {('move', 'pokemon')},
+            },
+        ),
+        migrations.CreateModel(
+            name='PokemonAbility',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ability', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='pokemon_links', to='pokemon.ability')),
+                ('pokemon', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ability_links', to='pokemon.pokemon')),
+            ],
+            options={
+                'verbose_name_plural': 'pokemon abilities',
+                'unique_together': {('ability', 'pokemon')},
+            },
+        ),
+        migrations.RunPython(backfill_links, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,77 @@
+# Generated by Django 4.2.30 on 2026-10-19 10:30
+
+from django.db import migrations, models
+
+
+STAT_COLUMNS = {
+    'hp': 'stat_hp',
+    'attack': 'stat_attack',
+    'defense': 'stat_defense',
+    'special-attack': 'stat_special_attack',
+    'special-defense': 'stat_special_defense',
+    'speed': 'stat_speed',
+}
+
+
+def backfill_stat_columns(apps, schema_editor):
+    """Populate the stat columns from the existing stats JSON field"""
+    Pokemon = apps.get_model('pokemon', 'Pokemon')
+    batch = []
+    for pokemon in Pokemon.objects.only('id', 'stats').iterator():
+        stats = pokemon.stats if isinstance(pokemon.stats, dict) else {}
+        values = []
+        for stat_name, column in STAT_COLUMNS.items():
+            value = stats.get(stat_name, stats.get(stat_name.replace('-', '_')))
+            value = int(value) if isinstance(value, (int, float)) and value >= 0 else None
+            setattr(pokemon, column, value)
+            if value is not None:
+                values.append(value)
+        pokemon.stat_total = sum(values) if values else None
+        batch.append(pokemon)
+    Pokemon.objects.bulk_update(batch, [*STAT_COLUMNS.values(), 'stat_total'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pokemon', '0003_move_ability_tables'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pokemon',
+            name='stat_attack',
+            field=models.PositiveSmallIntegerField(blank=True, db_index=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='pokemon',
+            name='stat_defense',
+            field=models.PositiveSmallIntegerField(blank=True, db_index=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='pokemon',
+            name='stat_hp',
+            field=models.PositiveSmallIntegerField(blank=True, db_index=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='pokemon',
+            name='stat_special_attack',
+            field=models.PositiveSmallIntegerField(blank=True, db_index=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='pokemon',
+            name='stat_special_defense',
+            field=models.PositiveSmallIntegerField(blank=True, db_index=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='pokemon',
+            name='stat_speed',
+            field=models.PositiveSmallIntegerField(blank=True, db_index=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='pokemon',
+            name='stat_total',
+            field=models.PositiveSmallIntegerField(blank=True, db_index=True, editable=False, null=True),
+        ),
+        migrations.RunPython(backfill_stat_columns, migrations.RunPython.noop),
+    ]
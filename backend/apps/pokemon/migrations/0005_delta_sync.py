@@ -0,0 +1,36 @@
+# Generated by Django 4.2.30 on 2026-10-19 10:40
+
+from django.db import migrations, models
+
+
+def backfill_updated_at(apps, schema_editor):
+    """Existing rows have not changed since they were created"""
+    Pokemon = apps.get_model('pokemon', 'Pokemon')
+    Pokemon.objects.update(updated_at=models.F('created_at'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pokemon', '0004_stat_columns'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PokemonTombstone',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('pokemon_id', models.BigIntegerField()),
+                ('deleted_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+            ],
+            options={
+                'ordering': ['deleted_at'],
+            },
+        ),
+        migrations.AddField(
+            model_name='pokemon',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, db_index=True),
+        ),
+        migrations.RunPython(backfill_updated_at, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.30 on 2026-10-19 11:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pokemon', '0005_delta_sync'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='pokemon',
+            index=models.Index(fields=['latitude', 'longitude', 'name'], name='pokemon_location_idx'),
+        ),
+    ]
@@ -1,8 +1,21 @@
 # apps/pokemon/models.py
 
+import math
 from django.db import models
 from django.contrib.auth.models import User
 
+# PokeAPI stat name -> denormalized integer column on Pokemon
+STAT_COLUMNS = {
+    'hp': 'stat_hp',
+    'attack': 'stat_attack',
+    'defense': 'stat_defense',
+    'special-attack': 'stat_special_attack',
+    'special-defense': 'stat_special_defense',
+    'speed': 'stat_speed',
+}
+# largest value the PositiveSmallIntegerField stat columns hold on every backend
+MAX_STAT = 32767
+
 class Pokemon(models.Model):
     name = models.CharField(max_length=255)
     
@@ -32,6 +45,15 @@ class Pokemon(models.Model):
     # Stats
     stats = models.JSONField(default=dict, blank=True) # dictionary of the stats of the pokemon
     
+    # Indexed copies of the base stats, kept in sync with the stats dict by sync_stat_columns()
+    stat_hp = models.PositiveSmallIntegerField(null=True, blank=True, editable=False, db_index=True)
+    stat_attack = models.PositiveSmallIntegerField(null=True, blank=True, editable=False, db_index=True)
+    stat_defense = models.PositiveSmallIntegerField(null=True, blank=True, editable=False, db_index=True)
+    stat_special_attack = models.PositiveSmallIntegerField(null=True, blank=True, editable=False, db_index=True)
+    stat_special_defense = models.PositiveSmallIntegerField(null=True, blank=True, editable=False, db_index=True)
+    stat_speed = models.PositiveSmallIntegerField(null=True, blank=True, editable=False, db_index=True)
+    stat_total = models.PositiveSmallIntegerField(null=True, blank=True, editable=False, db_index=True)
+    
     # source tracking
     source = models.CharField(max_length=20, choices = [
         ('API', 'PokeAPI'),
@@ -48,12 +70,47 @@ class Pokemon(models.Model):
     )
     
     created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True) # change cursor for delta sync
     
     class Meta:
         ordering = ['name']
+        indexes = [
+            # default ordering for list/all_for_map; also covers the search_fields so ?search=
+            # (substring match, not seekable) scans this narrow index instead of the JSON-heavy rows
+            models.Index(fields=['name', 'type_primary', 'type_secondary', 'category'], name='pokemon_name_search_idx'),
+            # ?source= filter followed by the default ordering
+            models.Index(fields=['source', 'name'], name='pokemon_source_name_idx'),
+            # exact type lookups (admin list_filter) followed by the default ordering
+            models.Index(fields=['type_primary', 'name'], name='pokemon_type_name_idx'),
+            # energy_snapshot's ?bbox= latitude range, covering the columns it reads
+            models.Index(fields=['latitude', 'longitude', 'name'], name='pokemon_location_idx'),
+        ]
     
     def __str__(self):
         return self.name
+    
+    def sync_stat_columns(self):
+        """Copy the base stats out of the stats dict into the indexed integer columns"""
+        stats = self.stats if isinstance(self.stats, dict) else {}
+        values = []
+        for stat_name, column in STAT_COLUMNS.items():
+            # accept both PokeAPI spelling (special-attack) and underscores (special_attack)
+            value = stats.get(stat_name, stats.get(stat_name.replace('-', '_')))
+            # NaN/Infinity (valid in JSON input) and values past the column are left out
+            in_range = isinstance(value, (int, float)) and math.isfinite(value) and 0 <= value <= MAX_STAT
+            value = int(value) if in_range else None
+            setattr(self, column, value)
+            if value is not None:
+                values.append(value)
+        self.stat_total = sum(values) if values and sum(values) <= MAX_STAT else None
+    
+    def save(self, *args, **kwargs):
+        # bulk_create skips save(), so bulk ingest calls sync_stat_columns() itself
+        self.sync_stat_columns()
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'stats' in update_fields:
+            kwargs['update_fields'] = set(update_fields) | set(STAT_COLUMNS.values()) | {'stat_total'}
+        super().save(*args, **kwargs)
 
 class FavoritePokemon(models.Model):
     user = models.ForeignKey(User, on_delete = models.CASCADE)
@@ -61,4 +118,51 @@ class FavoritePokemon(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     
     class Meta:
-        unique_together = ('user', 'pokemon')
\ No newline at end of file
+        unique_together = ('user', 'pokemon')
+
+# Deleted Pokemon ids, so delta sync clients can drop them
+class PokemonTombstone(models.Model):
+    pokemon_id = models.BigIntegerField()
+    deleted_at = models.DateTimeField(auto_now_add=True, db_index=True)
+    
+    class Meta:
+        ordering = ['deleted_at']
+    
+    def __str__(self):
+        return f'{self.pokemon_id} deleted at {self.deleted_at}'
+
+class Move(models.Model):
+    name = models.CharField(max_length=100, unique=True)
+    
+    class Meta:
+        ordering = ['name']
+    
+    def __str__(self):
+        return self.name
+
+class Ability(models.Model):
+    name = models.CharField(max_length=100, unique=True)
+    
+    class Meta:
+        ordering = ['name']
+        verbose_name_plural = 'abilities'
+    
+    def __str__(self):
+        return self.name
+
+# Through-tables mirroring the moves/abilities JSON fields, which stay on Pokemon as a read cache.
+# (move, pokemon) leads the unique index so ?move= resolves to pokemon ids without touching the rows.
+class PokemonMove(models.Model):
+    pokemon = models.ForeignKey(Pokemon, on_delete = models.CASCADE, related_name = 'move_links')
+    move = models.ForeignKey(Move, on_delete = models.CASCADE, related_name = 'pokemon_links')
+    
+    class Meta:
+        unique_together = ('move', 'pokemon')
+
+class PokemonAbility(models.Model):
+    pokemon = models.ForeignKey(Pokemon, on_delete = models.CASCADE, related_name = 'ability_links')
+    ability = models.ForeignKey(Ability, on_delete = models.CASCADE, related_name = 'pokemon_links')
+    
+    class Meta:
+        unique_together = ('ability', 'pokemon')
+        verbose_name_plural = 'pokemon abilities'
\ No newline at end of file
@@ -0,0 +1,149 @@
+# apps/pokemon/outbound.py
+
+# Per-connection send policy for energy frames: bounded queues and change-only delivery
+import asyncio
+import json
+import time
+from datetime import datetime
+from urllib.parse import parse_qs
+from django.conf import settings
+
+def heartbeat_frame():
+    return json.dumps({'type': 'heartbeat', 'timestamp': datetime.now().isoformat()})
+
+class FrameQueue:
+    """Latest-wins outbound queue of one connection
+
+    Frames are keyed (by Pokemon id); putting a key that is still waiting replaces its stale
+    frame, and when maxsize keys are waiting the oldest one is dropped. render() turns the
+    waiting frames into one message; with a window the sender waits that long after the first
+    frame so frames arriving together go out as one.
+
+    Frames only wait here while the sender is held back, and awaiting send() doesn't hold it
+    back under daphne: daphne writes every message straight into the Twisted transport, so a
+    socket that stops reading buffers in the server without limit. The real bound is
+    max_in_flight (POKEMON_ENERGY_ACK_WINDOW, or ?ack=N, on the energy sockets): at most that
+    many messages go out until the client acknowledges them with ack(); meanwhile frames
+    coalesce here, newest wins, so a slow reader costs at most max_in_flight messages in the
+    server plus maxsize frames here. A failed send stops the queue; later frames are dropped.
+    """
+
+    def __init__(self, send, render, maxsize = None, window = 0, max_in_flight = None):
+        self._send = send
+        self._render = render
+        self.window = window
+        self.maxsize = maxsize or getattr(settings, 'POKEMON_ENERGY_SEND_QUEUE', 256)
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        self._pending = {}
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self.stopped = False
+        self.dropped = 0
+
+    def put(self, key, text):
+        if self.stopped:
+            self.dropped += 1
+            return
+        if key in self._pending:
+            del self._pending[key]
+            self.dropped += 1
+        elif len(self._pending) >= self.maxsize:
+            del self._pending[next(iter(self._pending))]
+            self.dropped += 1
+        self._pending[key] = text
+        self._wakeup.set()
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def ack(self, count = 1):
+        """The client took `count` more messages, the sender may send that many again"""
+        if count > 0:
+            self.in_flight = max(0, self.in_flight - count)
+            self._wakeup.set()
+
+    def held_back(self):
+        return self.max_in_flight is not None and self.in_flight >= self.max_in_flight
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            if self.window:
+                await asyncio.sleep(self.window)
+            self._wakeup.clear()
+            if not self._pending or self.held_back():
+                continue
+            pending, self._pending = self._pending, {}
+            if self.max_in_flight is not None:
+                self.in_flight += 1
+            message = self._render(pending)
+            try:
+                if isinstance(message, bytes):
+                    await self._send(bytes_data=message)
+                else:
+                    await self._send(text_data=message)
+            except Exception as e:
+                print(f"Error sending energy frames, stopping the queue: {e}")
+                self.stopped = True
+                self._pending.clear()
+                self._task = None
+                return
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+class SendPolicy:
+    """Decides which energy frames a connection gets
+
+    By default every frame is sent. In changed-only mode a Pokemon's frame is sent when its
+    energy moved by at least threshold since the last frame sent or its factors changed;
+    otherwise the connection gets a heartbeat at most every heartbeat seconds.
+    """
+    __slots__ = ('changed_only', 'threshold', 'heartbeat', 'last_sent', 'last_heartbeat', 'clock')
+
+    def __init__(self, changed_only = False, threshold = None, heartbeat = None, clock = time.monotonic):
+        self.changed_only = changed_only
+        self.threshold = threshold if threshold is not None else getattr(settings, 'POKEMON_ENERGY_CHANGE_THRESHOLD', 2.0)
+        self.heartbeat = heartbeat if heartbeat is not None else getattr(settings, 'POKEMON_ENERGY_HEARTBEAT', 30)
+        self.last_sent = {}
+        self.clock = clock
+        self.last_heartbeat = clock()
+
+    @classmethod
+    def from_scope(cls, scope):
+        """?changed_only=1[&threshold=5] on the socket URL"""
+        query = parse_qs(scope.get('query_string', b'').decode())
+        changed_only = query.get('changed_only', ['0'])[0].lower() in ('1', 'true', 'yes')
+        try:
+            threshold = float(query['threshold'][0]) if 'threshold' in query else None
+        except ValueError:
+            threshold = None
+        return cls(changed_only=changed_only, threshold=threshold)
+
+    def wants(self, event):
+        """True if the frame in a scheduler event should go out"""
+        if not self.changed_only or event.get('energy_level') is None:
+            return True
+        pokemon_id = event['pokemon_id']
+        last = self.last_sent.get(pokemon_id)
+        if (last is not None and abs(event['energy_level'] - last[0]) < self.threshold
+                and event.get('factors') == last[1]):
+            return False
+        self.last_sent[pokemon_id] = (event['energy_level'], event.get('factors'))
+        self.last_heartbeat = self.clock()
+        return True
+
+    def heartbeat_due(self):
+        if self.clock() - self.last_heartbeat < self.heartbeat:
+            return False
+        self.last_heartbeat = self.clock()
+        return True
+
+    def forget(self, pokemon_id):
+        self.last_sent.pop(pokemon_id, None)
@@ -0,0 +1,146 @@
+# apps/pokemon/pokemon_state.py
+
+# Bounded in-process cache of the few Pokemon fields the energy feed needs
+import asyncio
+import threading
+from collections import OrderedDict
+from channels.db import database_sync_to_async
+from django.conf import settings
+from .models import Pokemon
+
+STATE_FIELDS = ('id', 'name', 'latitude', 'longitude')
+# ids outside a signed 64-bit integer can't be stored, so can't exist (and can't be queried)
+MIN_ID = -2 ** 63
+MAX_ID = 2 ** 63 - 1
+
+class PokemonState:
+    """What an energy tick needs of a Pokemon; near_route is filled in by the first tick"""
+    __slots__ = ('id', 'name', 'latitude', 'longitude', 'near_route')
+
+    def __init__(self, id, name, latitude, longitude, near_route = None):
+        self.id = id
+        self.name = name
+        self.latitude = latitude
+        self.longitude = longitude
+        self.near_route = near_route
+
+    def __repr__(self):
+        return f'PokemonState({self.id}, {self.name!r}, {self.latitude}, {self.longitude})'
+
+class PokemonStateCache:
+    """LRU of PokemonState by id, so socket connects and ticks don't go to the database
+
+    Misses load only STATE_FIELDS (never the JSON columns); concurrent misses for the same id
+    on a loop share one query, and get_many() loads all of its misses in one query. Unknown
+    ids (including ones past the 64-bit range) are not cached. Pokemon save/delete signals
+    invalidate() the id, and again once the write commits; a load that was already running
+    when that happened is not stored, so old coordinates can't come back.
+    POKEMON_STATE_CACHE_SIZE entries at most.
+    """
+
+    def __init__(self, maxsize = None):
+        self._maxsize = maxsize
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def maxsize(self):
+        if self._maxsize is not None:
+            return self._maxsize
+        return getattr(settings, 'POKEMON_STATE_CACHE_SIZE', 10000)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+        self._inflight.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def invalidate(self, pokemon_id):
+        # called from the signal handlers, usually on another thread than the loop
+        with self._lock:
+            self._generation += 1
+            self._entries.pop(pokemon_id, None)
+
+    def peek(self, pokemon_id):
+        return self._entries.get(pokemon_id)
+
+    async def get(self, pokemon_id):
+        """The Pokemon's state, None if it does not exist"""
+        if not MIN_ID <= pokemon_id <= MAX_ID:
+            return None
+        state = self._lookup(pokemon_id)
+        if state is not None:
+            return state
+        self.misses += 1
+        loop = asyncio.get_running_loop()
+        task = self._inflight.get(pokemon_id)
+        if task is None or task.done() or task.get_loop() is not loop:
+            task = loop.create_task(self._load([pokemon_id]))
+            self._inflight[pokemon_id] = task
+        try:
+            return (await asyncio.shield(task)).get(pokemon_id)
+        finally:
+            if self._inflight.get(pokemon_id) is task and task.done():
+                del self._inflight[pokemon_id]
+
+    async def get_many(self, ids):
+        """States of the ids that exist, in one query for all the misses"""
+        found = {}
+        missing = []
+        for pokemon_id in ids:
+            if not MIN_ID <= pokemon_id <= MAX_ID:
+                continue
+            state = self._lookup(pokemon_id)
+            if state is not None:
+                found[pokemon_id] = state
+            else:
+                missing.append(pokemon_id)
+        if missing:
+            self.misses += len(missing)
+            found.update(await self._load(missing))
+        return list(found.values())
+
+    def _lookup(self, pokemon_id):
+        state = self._entries.get(pokemon_id)
+        if state is not None:
+            self.hits += 1
+            try:
+                self._entries.move_to_end(pokemon_id)
+            except KeyError:
+                # invalidated meanwhile from another thread
+                pass
+        return state
+
+    async def _load(self, ids):
+        generation = self._generation
+        rows = await self.fetch_rows(ids)
+        states = {row[0]: PokemonState(*row) for row in rows}
+        maxsize = self.maxsize
+        with self._lock:
+            if generation == self._generation:
+                for pokemon_id, state in states.items():
+                    self._entries[pokemon_id] = state
+                    self._entries.move_to_end(pokemon_id)
+                while len(self._entries) > maxsize:
+                    self._entries.popitem(last=False)
+        return states
+
+    @database_sync_to_async
+    def fetch_rows(self, ids):
+        return list(Pokemon.objects.filter(id__in=ids).order_by().values_list(*STATE_FIELDS))
+
+    def metrics(self):
+        return {
+            'size': len(self._entries),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+pokemon_states = PokemonStateCache()
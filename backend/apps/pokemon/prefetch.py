@@ -0,0 +1,146 @@
+# apps/pokemon/prefetch.py
+
+# Keeps the weather cache warm for the grid cells Pokemon are placed in
+import asyncio
+import os
+import time
+from collections import Counter
+from channels.db import database_sync_to_async
+from django.conf import settings
+from .energy import energy_scheduler
+from .models import Pokemon
+from .weather import fetch_settings, weather_cache, weather_cell
+
+# one watched Pokemon counts as this many placed ones when ranking cells
+SUBSCRIBER_WEIGHT = 10
+
+def prefetch_settings():
+    return {
+        'enabled': getattr(settings, 'POKEMON_WEATHER_PREFETCH', True),
+        'rate': getattr(settings, 'POKEMON_WEATHER_PREFETCH_RATE', 50),
+        'interval': getattr(settings, 'POKEMON_WEATHER_PREFETCH_INTERVAL', 15),
+        'lead': getattr(settings, 'POKEMON_WEATHER_PREFETCH_LEAD', 60),
+        'rescan': getattr(settings, 'POKEMON_WEATHER_PREFETCH_RESCAN', 300),
+    }
+
+class RateBudget:
+    """Token bucket of upstream calls per minute, shared with the lazy fetches"""
+    __slots__ = ('rate', 'tokens', 'updated_at', 'clock')
+
+    def __init__(self, rate, clock = time.monotonic):
+        self.rate = rate
+        self.tokens = float(rate)
+        self.clock = clock
+        self.updated_at = clock()
+
+    def available(self):
+        now = self.clock()
+        self.tokens = min(float(self.rate), self.tokens + (now - self.updated_at) * self.rate / 60)
+        self.updated_at = now
+        return int(self.tokens)
+
+    def spend(self, calls):
+        # may go negative when lazy fetches overran the budget, the prefetcher then waits it out
+        self.tokens -= calls
+
+class WeatherPrefetcher:
+    """Refreshes the hottest weather cells ahead of expiry within an upstream rate budget
+
+    Cells are ranked by placed Pokemon plus SUBSCRIBER_WEIGHT per socket watching one of
+    them. Every interval, cells that are missing or within lead seconds of the TTL are fetched
+    in that order, as many as the budget allows; upstream calls made by lazy cache misses are
+    charged to the same budget. Placed Pokemon are rescanned from the database every rescan
+    seconds. Runs per event loop, started by the energy consumers.
+    """
+
+    def __init__(self, cache = weather_cache, scheduler = energy_scheduler, clock = time.monotonic):
+        self.cache = cache
+        self.scheduler = scheduler
+        self.clock = clock
+        self.budget = None
+        self._placed = Counter()
+        self._scanned_at = None
+        self._seen_calls = 0
+        self._task = None
+
+    def ensure_running(self):
+        config = prefetch_settings()
+        if not config['enabled'] or not os.getenv('OPENWEATHER_API_KEY'):
+            return
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done() or self._task.get_loop() is not loop:
+            self._task = loop.create_task(self.run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def run(self):
+        while True:
+            try:
+                await self.run_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Error prefetching weather: {e}")
+            await asyncio.sleep(prefetch_settings()['interval'])
+
+    @database_sync_to_async
+    def scan_placed_cells(self, cell_degrees):
+        counts = Counter()
+        for latitude, longitude in Pokemon.objects.values_list('latitude', 'longitude').iterator(chunk_size=2000):
+            counts[weather_cell(latitude, longitude, cell_degrees)] += 1
+        return counts
+
+    def cell_priorities(self, cell_degrees):
+        priorities = Counter(self._placed)
+        for pokemon, watchers in self.scheduler.watched_pokemon():
+            priorities[weather_cell(pokemon.latitude, pokemon.longitude, cell_degrees)] += SUBSCRIBER_WEIGHT * watchers
+        return priorities
+
+    def due_cells(self, priorities, ttl, lead):
+        """Cells needing a fetch, hottest first"""
+        due = []
+        for cell, priority in priorities.most_common():
+            if self.cache.is_fetching(cell):
+                continue
+            age = self.cache.cell_age(cell)
+            if age is None or age >= ttl - lead:
+                due.append(cell)
+        return due
+
+    async def run_once(self):
+        """One prefetch round, returns the cells fetched"""
+        config = prefetch_settings()
+        weather_config = fetch_settings()
+        api_key = os.getenv('OPENWEATHER_API_KEY')
+        if not api_key:
+            return []
+
+        if self.budget is None or self.budget.rate != config['rate']:
+            self.budget = RateBudget(config['rate'], clock=self.clock)
+        # lazy misses since the last round count against the budget too
+        self.charge_upstream_calls()
+
+        now = self.clock()
+        if self._scanned_at is None or now - self._scanned_at >= config['rescan']:
+            self._placed = await self.scan_placed_cells(weather_config['cell_degrees'])
+            self._scanned_at = now
+
+        due = self.due_cells(self.cell_priorities(weather_config['cell_degrees']), weather_config['ttl'], config['lead'])
+        cells = due[:max(0, self.budget.available())]
+        if cells:
+            await asyncio.gather(*[self.cache.prefetch(cell, api_key) for cell in cells])
+            self.charge_upstream_calls()
+        return cells
+
+    def charge_upstream_calls(self):
+        self.budget.spend(max(0, self.cache.upstream_calls - self._seen_calls))
+        self._seen_calls = self.cache.upstream_calls
+
+weather_prefetcher = WeatherPrefetcher()
@@ -0,0 +1,60 @@
+# apps/pokemon/renderers.py
+
+# DRF picks these from ?format= or the Accept header.
+import csv
+import io
+import json
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+from .mapdata import pack_columnar_binary
+
+
+# The export action streams its own body, so render() only handles the non-streamed
+# responses (errors) for the negotiated format.
+class NDJSONRenderer(BaseRenderer):
+    media_type = 'application/x-ndjson'
+    format = 'ndjson'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return (json.dumps(data) + '\n').encode(self.charset)
+
+
+class CSVRenderer(BaseRenderer):
+    media_type = 'text/csv'
+    format = 'csv'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        rows = data.items() if isinstance(data, dict) else [('detail', data)]
+        writer.writerow(['field', 'detail'])
+        for field, detail in rows:
+            writer.writerow([field, detail])
+        return buffer.getvalue().encode(self.charset)
+
+
+class ColumnarJSONRenderer(JSONRenderer):
+    # all_for_map struct-of-arrays payload (see mapdata.build_columnar_payload)
+    media_type = 'application/vnd.pokemon.columnar+json'
+    format = 'columnar'
+
+
+class ColumnarBinaryRenderer(BaseRenderer):
+    # little-endian float32 variant of the columnar payload (see mapdata.pack_columnar_binary)
+    media_type = 'application/vnd.pokemon.columnar'
+    format = 'columnar-bin'
+    charset = None
+    render_style = 'binary'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        if 'coords' not in data:
+            # error responses
+            return json.dumps(data).encode('utf-8')
+        return pack_columnar_binary(data)
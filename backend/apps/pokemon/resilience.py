@@ -0,0 +1,112 @@
+# apps/pokemon/resilience.py
+
+# Circuit breaker and latency bookkeeping for upstream dependencies (weather)
+import time
+from collections import deque
+from django.conf import settings
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+class CircuitBreaker:
+    """Stops calling an upstream after repeated failures
+
+    closed: calls go through; failure_threshold consecutive failures open the breaker.
+    open: calls are skipped until reset_timeout seconds have passed.
+    half_open: one probe call is let through; success closes the breaker, failure reopens it.
+    Thresholds come from settings unless given.
+    """
+
+    def __init__(self, failure_threshold = None, reset_timeout = None, clock = time.monotonic):
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self.clock = clock
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.times_opened = 0
+
+    @property
+    def failure_threshold(self):
+        if self._failure_threshold is not None:
+            return self._failure_threshold
+        return getattr(settings, 'POKEMON_WEATHER_BREAKER_FAILURES', 5)
+
+    @property
+    def reset_timeout(self):
+        if self._reset_timeout is not None:
+            return self._reset_timeout
+        return getattr(settings, 'POKEMON_WEATHER_BREAKER_RESET', 30)
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return CLOSED
+        if self.clock() - self.opened_at >= self.reset_timeout:
+            return HALF_OPEN
+        return OPEN
+
+    def allow(self):
+        """True if a call may go upstream now (in half-open, only the one probe)"""
+        state = self.state
+        if state == CLOSED:
+            return True
+        if state == HALF_OPEN and not self.probing:
+            self.probing = True
+            return True
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.probing or self.failures >= self.failure_threshold:
+            if self.opened_at is None or self.probing:
+                self.times_opened += 1
+            self.opened_at = self.clock()
+            self.probing = False
+
+    def reset(self):
+        self.record_success()
+        self.times_opened = 0
+
+    def snapshot(self):
+        return {
+            'state': self.state,
+            'consecutive_failures': self.failures,
+            'times_opened': self.times_opened,
+        }
+
+class LatencyRecorder:
+    """Rolling window of call durations (seconds) with percentile summaries in ms"""
+
+    def __init__(self, size = 500):
+        self.samples = deque(maxlen=size)
+        self.count = 0
+
+    def record(self, seconds):
+        self.samples.append(seconds)
+        self.count += 1
+
+    def percentile(self, fraction):
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))] * 1000
+
+    def clear(self):
+        self.samples.clear()
+        self.count = 0
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'p50_ms': self.percentile(0.5),
+            'p95_ms': self.percentile(0.95),
+            'p99_ms': self.percentile(0.99),
+            'max_ms': max(self.samples) * 1000 if self.samples else None,
+        }
@@ -5,5 +5,7 @@ from . import consumers
 
 websocket_urlpatterns = [
     re_path(r'ws/pokemon/(?P<pokemon_id>\d+)/energy/$', consumers.PokemonEnergyConsumer.as_asgi()),
+    re_path(r'ws/pokemon/energy/$', consumers.EnergySubscriptionsConsumer.as_asgi()),
+    re_path(r'ws/pokemon/map/$', consumers.MapUpdatesConsumer.as_asgi()),
 ]
 
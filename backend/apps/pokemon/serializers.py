@@ -1,18 +1,86 @@
 # apps/pokemon/seralizers.py
 
 # handle convert database models to JSON and vice versa
+from django.conf import settings
+from django.core.cache import caches
 from rest_framework import serializers
 from .models import Pokemon, FavoritePokemon
 from django.contrib.auth.models import User
 
+class PokemonMapSerializer(serializers.ModelSerializer):
+    """User-independent Pokemon fields, used for the shared map snapshot and fragment cache"""
+    class Meta:
+        model = Pokemon
+        fields = '__all__'
+
+def fragment_cache_key(pokemon):
+    # updated_at changes on every save, so edited rows simply miss and old fragments age out
+    return f'pokemon:{pokemon.pk}:{pokemon.updated_at.isoformat() if pokemon.updated_at else ""}'
+
+def get_fragments(pokemon_list):
+    """User-independent serialized dicts for pokemon_list, read through the fragment cache"""
+    cache = caches[settings.POKEMON_FRAGMENT_CACHE]
+    keys = [fragment_cache_key(pokemon) for pokemon in pokemon_list]
+    cached = cache.get_many(keys)
+    
+    serializer = PokemonMapSerializer()
+    missing = {}
+    fragments = []
+    for key, pokemon in zip(keys, pokemon_list):
+        fragment = cached.get(key)
+        if fragment is None:
+            fragment = missing[key] = serializer.to_representation(pokemon)
+        fragments.append(fragment)
+    if missing:
+        cache.set_many(missing)
+    return fragments
+
+def get_favorite_ids(request):
+    if request and request.user.is_authenticated:
+        return set(FavoritePokemon.objects.filter(user=request.user).values_list('pokemon_id', flat=True))
+    return set()
+
+def with_favorite(fragment, favorite_ids):
+    # same key order as the declared serializer (id, is_favorite, model fields...)
+    data = {'id': fragment['id'], 'is_favorite': fragment['id'] in favorite_ids}
+    data.update(fragment)
+    return data
+
+class PokemonListSerializer(serializers.ListSerializer):
+    """Builds lists from cached fragments plus one favorites query for the whole list"""
+    def to_representation(self, data):
+        pokemon_list = list(data.all() if hasattr(data, 'all') else data)
+        fields = self.context.get('fields')
+        if fields is not None:
+            # sparse fieldsets skip the full fragments (their rows may not even load every column)
+            if 'is_favorite' in fields:
+                self.child.favorite_ids = get_favorite_ids(self.context.get('request'))
+            return [self.child.to_representation(pokemon) for pokemon in pokemon_list]
+        favorite_ids = get_favorite_ids(self.context.get('request'))
+        return [with_favorite(fragment, favorite_ids) for fragment in get_fragments(pokemon_list)]
+
 class PokemonSerializer(serializers.ModelSerializer):
     is_favorite = serializers.SerializerMethodField()
     
     class Meta:
         model = Pokemon
         fields = '__all__'
+        list_serializer_class = PokemonListSerializer
+    
+    # set by PokemonListSerializer, so lists don't query favorites once per row
+    favorite_ids = None
+    
+    def get_fields(self):
+        fields = super().get_fields()
+        # sparse fieldset (?fields=/?omit=) chosen by the view
+        requested = self.context.get('fields')
+        if requested is not None:
+            fields = {name: field for name, field in fields.items() if name in requested}
+        return fields
     
     def get_is_favorite(self, obj):
+        if self.favorite_ids is not None:
+            return obj.pk in self.favorite_ids
         request = self.context.get('request')
         if request and request.user.is_authenticated:
             return FavoritePokemon.objects.filter(
@@ -21,6 +89,12 @@ class PokemonSerializer(serializers.ModelSerializer):
             ).exists()
         return False
     
+    def to_representation(self, instance):
+        if self.context.get('fields') is not None:
+            return super().to_representation(instance)
+        fragment = get_fragments([instance])[0]
+        return with_favorite(fragment, {instance.pk} if self.get_is_favorite(instance) else set())
+    
 class PokemonCreateSerializer(serializers.ModelSerializer):
     class Meta:
         model = Pokemon
@@ -0,0 +1,84 @@
+# apps/pokemon/signals.py
+
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver, Signal
+from .models import Pokemon, PokemonTombstone
+from .snapshot import shared_map_snapshot
+from .broadcast import map_broadcaster
+from .pokemon_state import pokemon_states
+from .energy_history import energy_history
+from .invalidation import cache_invalidator
+from .utils import tombstone_cutoff
+
+# bulk_create sends no post_save, so bulk ingest sends this instead (instances=list of saved Pokemon)
+pokemon_bulk_created = Signal()
+
+@receiver(post_save, sender=Pokemon)
+@receiver(post_delete, sender=Pokemon)
+@receiver(pokemon_bulk_created, sender=Pokemon)
+def invalidate_map_snapshot(sender, **kwargs):
+    shared_map_snapshot.invalidate()
+
+@receiver(post_save, sender=Pokemon)
+@receiver(post_delete, sender=Pokemon)
+def invalidate_pokemon_state(sender, instance, **kwargs):
+    invalidate_states([instance.pk])
+
+@receiver(pokemon_bulk_created, sender=Pokemon)
+def invalidate_bulk_pokemon_state(sender, instances, **kwargs):
+    # SQLite can hand a deleted Pokemon's id to a new one
+    invalidate_states([instance.pk for instance in instances])
+
+def invalidate_states(pokemon_ids):
+    # now for this connection's own reads, and again on commit: a load from another
+    # connection before then still saw the old row and may have cached it
+    for pokemon_id in pokemon_ids:
+        pokemon_states.invalidate(pokemon_id)
+    transaction.on_commit(lambda: [pokemon_states.invalidate(pokemon_id) for pokemon_id in pokemon_ids])
+
+@receiver(post_delete, sender=Pokemon)
+def forget_energy_history(sender, instance, **kwargs):
+    energy_history.forget(instance.pk)
+
+@receiver(post_save, sender=Pokemon)
+def reset_energy_history(sender, instance, created, **kwargs):
+    # a new Pokemon may have been given a deleted one's id
+    if created:
+        energy_history.forget(instance.pk)
+
+@receiver(pokemon_bulk_created, sender=Pokemon)
+def reset_bulk_energy_history(sender, instances, **kwargs):
+    for instance in instances:
+        energy_history.forget(instance.pk)
+
+# the other workers' copies of the caches above
+@receiver(post_save, sender=Pokemon)
+def publish_save(sender, instance, created, **kwargs):
+    cache_invalidator.record([instance.pk], forget_history=created)
+
+@receiver(post_delete, sender=Pokemon)
+def publish_delete(sender, instance, **kwargs):
+    cache_invalidator.record([instance.pk], forget_history=True)
+
+@receiver(pokemon_bulk_created, sender=Pokemon)
+def publish_bulk_create(sender, instances, **kwargs):
+    cache_invalidator.record([instance.pk for instance in instances], forget_history=True)
+
+@receiver(post_delete, sender=Pokemon)
+def record_tombstone(sender, instance, **kwargs):
+    PokemonTombstone.objects.create(pokemon_id=instance.pk)
+    # one indexed range delete, usually of nothing
+    PokemonTombstone.objects.filter(deleted_at__lt=tombstone_cutoff()).delete()
+
+@receiver(post_save, sender=Pokemon)
+def broadcast_save(sender, instance, **kwargs):
+    map_broadcaster.record_upserts([instance])
+
+@receiver(pokemon_bulk_created, sender=Pokemon)
+def broadcast_bulk_create(sender, instances, **kwargs):
+    map_broadcaster.record_upserts(instances)
+
+@receiver(post_delete, sender=Pokemon)
+def broadcast_delete(sender, instance, **kwargs):
+    map_broadcaster.record_deletions([instance.pk])
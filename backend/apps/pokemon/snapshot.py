@@ -0,0 +1,112 @@
+# apps/pokemon/snapshot.py
+
+# Materialized, precompressed copy of the public map dataset (all_for_map without is_favorite)
+import gzip
+import hashlib
+import threading
+from django.conf import settings
+from django.db import connection, transaction
+from rest_framework.renderers import JSONRenderer
+from .models import Pokemon
+from .serializers import get_fragments
+
+try:
+    import brotli
+except ImportError:  # optional, gzip is always available
+    brotli = None
+
+class Snapshot:
+    """Immutable encoded snapshot: identity bytes plus precompressed variants"""
+    __slots__ = ('raw', 'gzip', 'br', 'etag', 'count')
+
+    def __init__(self, raw, count):
+        self.raw = raw
+        self.gzip = gzip.compress(raw, compresslevel=9, mtime=0)
+        self.br = brotli.compress(raw, quality=11) if brotli else None
+        self.etag = '"%s"' % hashlib.sha1(raw).hexdigest()
+        self.count = count
+
+    def encode_for(self, accept_encoding):
+        """Pick the smallest variant the client accepts, returns (body, content_encoding)"""
+        accepted = {token.split(';')[0].strip() for token in accept_encoding.split(',')}
+        if self.br is not None and 'br' in accepted:
+            return self.br, 'br'
+        if 'gzip' in accepted:
+            return self.gzip, 'gzip'
+        return self.raw, None
+
+class MapSnapshot:
+    """Holds the current Snapshot and rebuilds it after Pokemon writes
+
+    invalidate() marks the snapshot stale and, once the write commits, (re)starts a debounce
+    timer, so a burst of writes causes a single background rebuild. Until that runs, readers
+    keep getting the previous snapshot. A stale snapshot with no rebuild pending (e.g. the
+    write never committed a callback, as in tests) is rebuilt on read.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._build_lock = threading.RLock()
+        self._snapshot = None
+        self._generation = 0
+        self._built_generation = -1
+        self._timer = None
+
+    @property
+    def debounce(self):
+        return getattr(settings, 'POKEMON_MAP_SNAPSHOT_DEBOUNCE', 1.0)
+
+    def get(self):
+        snapshot = self._snapshot
+        if snapshot is not None and not self._needs_rebuild():
+            return snapshot
+        with self._build_lock:
+            # another reader may have rebuilt it while we waited
+            snapshot = self._snapshot
+            if snapshot is not None and not self._needs_rebuild():
+                return snapshot
+            return self.rebuild()
+
+    def _needs_rebuild(self):
+        return self._built_generation != self._generation and self._timer is None
+
+    def invalidate(self, committed = False):
+        """committed=True for writes already committed (e.g. by another worker)"""
+        with self._lock:
+            self._generation += 1
+        if committed:
+            self._schedule()
+        else:
+            transaction.on_commit(self._schedule)
+
+    def _schedule(self):
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+            self._timer = threading.Timer(self.debounce, self._rebuild_in_background)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _rebuild_in_background(self):
+        with self._lock:
+            self._timer = None
+        try:
+            self.rebuild()
+        finally:
+            # timer threads get their own DB connection, don't leak it
+            connection.close()
+
+    def rebuild(self):
+        """Re-serialize the dataset now and swap it in"""
+        with self._build_lock:
+            with self._lock:
+                generation = self._generation
+            results = get_fragments(list(Pokemon.objects.all()))
+            snapshot = Snapshot(JSONRenderer().render({'count': len(results), 'results': results}), len(results))
+            with self._lock:
+                # a write that landed mid-build leaves the generations apart, so it stays stale
+                self._snapshot = snapshot
+                self._built_generation = generation
+            return snapshot
+
+shared_map_snapshot = MapSnapshot()
@@ -1,10 +1,16 @@
 # apps/pokemon/utils.py
 
 import requests
-from .models import Pokemon
+import csv
+from .models import Pokemon, Move, Ability, PokemonMove, PokemonAbility
 import random
 import json
 from pathlib import Path
+from datetime import datetime, timedelta, timezone as dt_timezone
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+from asgiref.sync import sync_to_async
 
 def fetch_pokemon_from_api(limit = 100):
     """Fetch Pokemon from PokeAPI and assign coordinates"""
@@ -44,6 +50,7 @@ def fetch_pokemon_from_api(limit = 100):
                 source = 'API'
             )
             pokemon.save()
+            sync_moves_and_abilities([pokemon])
             pokemon_list.append(pokemon)
         except Exception as e:
             print(f"Error fetching Pokemon from API: {e}")
@@ -121,7 +128,7 @@ def get_moves_at_level(moves_data, level):
 def parse_csv_to_pokemon(row, user):
     """Parse CSV row to Pokemon object"""
     
-    return Pokemon(
+    pokemon = Pokemon(
         name = row['Pokemon'],
         latitude = float(row['Lat']),
         longitude = float(row['Long']),
@@ -129,10 +136,86 @@ def parse_csv_to_pokemon(row, user):
         location_name = row['Location'],
         moves = json.loads(row.get('Moves', '[]')),
         sprite = row.get('Sprite', ''),
+        # optional columns, written by the CSV export so it round-trips
+        type_secondary = row.get('SecondaryType') or '',
+        category = row.get('Category') or '',
+        height = float(row['Height']) if row.get('Height') else None,
+        weight = float(row['Weight']) if row.get('Weight') else None,
+        abilities = json.loads(row.get('Abilities') or '[]'),
+        stats = json.loads(row.get('Stats') or '{}'),
         source = 'CSV',
         uploaded_by = user
     )
-    
+    # rows are bulk created, which skips Pokemon.save()
+    pokemon.sync_stat_columns()
+    return pokemon
+
+# CSV column -> Pokemon field, in the layout parse_csv_to_pokemon reads
+CSV_COLUMNS = [
+    ('Pokemon', 'name'),
+    ('Lat', 'latitude'),
+    ('Long', 'longitude'),
+    ('Type', 'type_primary'),
+    ('Location', 'location_name'),
+    ('Moves', 'moves'),
+    ('Sprite', 'sprite'),
+    ('SecondaryType', 'type_secondary'),
+    ('Category', 'category'),
+    ('Height', 'height'),
+    ('Weight', 'weight'),
+    ('Abilities', 'abilities'),
+    ('Stats', 'stats'),
+]
+JSON_CSV_FIELDS = {'moves', 'abilities', 'stats'}
+
+EXPORT_FIELDS = [
+    'id', 'name', 'latitude', 'longitude', 'location_name', 'type_primary', 'type_secondary',
+    'category', 'moves', 'abilities', 'stats', 'height', 'weight', 'sprite', 'source', 'created_at',
+]
+
+class _Echo:
+    """File-like object whose write() hands the line back, so csv.writer can feed a generator"""
+    def write(self, value):
+        return value
+
+def iter_pokemon_ndjson(rows, batch_size = 500):
+    """Yield .values() rows as newline-delimited JSON, batch_size lines per chunk"""
+    encoder = DjangoJSONEncoder()
+    lines = []
+    for row in rows:
+        lines.append(encoder.encode(row) + '\n')
+        if len(lines) >= batch_size:
+            yield ''.join(lines)
+            lines = []
+    if lines:
+        yield ''.join(lines)
+
+def iter_pokemon_csv(rows, batch_size = 500):
+    """Yield .values() rows as CSV that upload_from_csv can read back, batch_size lines per chunk"""
+    writer = csv.writer(_Echo())
+    lines = [writer.writerow([column for column, _ in CSV_COLUMNS])]
+    for row in rows:
+        lines.append(writer.writerow([
+            json.dumps(row[field]) if field in JSON_CSV_FIELDS else ('' if row[field] is None else row[field])
+            for _, field in CSV_COLUMNS
+        ]))
+        if len(lines) >= batch_size:
+            yield ''.join(lines)
+            lines = []
+    if lines:
+        yield ''.join(lines)
+
+async def iter_in_sync_thread(chunks):
+    """Async iterator over a sync chunk generator, each chunk made in Django's sync thread
+
+    Under ASGI StreamingHttpResponse reads a sync iterator into a list before sending a
+    byte; this keeps the database cursor in the sync thread and the response streaming.
+    """
+    chunks = iter(chunks)
+    next_chunk = sync_to_async(next)
+    while (chunk := await next_chunk(chunks, None)) is not None:
+        yield chunk
+
 def load_polylines():
     """Load polyline data from files"""
     polylines = {}
@@ -140,4 +223,65 @@ def load_polylines():
         polylines['A-J'] = json.load(f)
     with open(Path(__file__).resolve().parent / 'data' / 'polylines_K-Z.json', 'r') as f:
         polylines['K-Z'] = json.load(f)
-    return polylines
\ No newline at end of file
+    return polylines
+
+def normalize_name(name):
+    """Normalize a move/ability name the way PokeAPI spells it (lowercase, hyphenated)"""
+    return name.strip().lower().replace(' ', '-')
+
+def sync_moves_and_abilities(pokemon_list, batch_size = 500):
+    """Mirror the moves/abilities JSON fields of saved Pokemon into the Move/Ability through-tables"""
+    pokemon_list = [pokemon for pokemon in pokemon_list if pokemon.pk]
+    if not pokemon_list:
+        return
+    
+    _sync_links(pokemon_list, 'moves', Move, PokemonMove, 'move', batch_size)
+    _sync_links(pokemon_list, 'abilities', Ability, PokemonAbility, 'ability', batch_size)
+
+def _sync_links(pokemon_list, attr, model, link_model, link_field, batch_size):
+    """Replace the through-table rows of each Pokemon with the names in its JSON field"""
+    names_by_pokemon = {}
+    for pokemon in pokemon_list:
+        names = getattr(pokemon, attr) or []
+        names_by_pokemon[pokemon.pk] = {
+            normalize_name(name) for name in names if isinstance(name, str) and name.strip()
+        }
+    
+    # drop the old links (chunked to stay under SQLite's variable limit)
+    pokemon_ids = list(names_by_pokemon)
+    for i in range(0, len(pokemon_ids), batch_size):
+        link_model.objects.filter(pokemon_id__in=pokemon_ids[i:i + batch_size]).delete()
+    
+    all_names = set().union(*names_by_pokemon.values())
+    if not all_names:
+        return
+    
+    # create any names we have not seen before, then resolve all of them to ids in one query
+    model.objects.bulk_create([model(name=name) for name in all_names], ignore_conflicts=True, batch_size=batch_size)
+    ids = dict(model.objects.filter(name__in=all_names).values_list('name', 'id'))
+    
+    link_model.objects.bulk_create([
+        link_model(pokemon_id=pokemon_id, **{f'{link_field}_id': ids[name]})
+        for pokemon_id, names in names_by_pokemon.items()
+        for name in names
+    ], batch_size=batch_size)
+
+CURSOR_EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+
+def encode_change_cursor(timestamp):
+    """Encode a change timestamp as an opaque cursor (microseconds since the epoch)"""
+    return str((timestamp - CURSOR_EPOCH) // timedelta(microseconds=1))
+
+def decode_change_cursor(cursor):
+    """Inverse of encode_change_cursor, raises ValueError for malformed cursors"""
+    microseconds = int(cursor)
+    if microseconds < 0:
+        raise ValueError('cursor must not be negative')
+    try:
+        return CURSOR_EPOCH + timedelta(microseconds=microseconds)
+    except OverflowError:
+        raise ValueError('cursor is out of range')
+
+def tombstone_cutoff():
+    """Tombstones older than this are pruned, so change cursors older than it need a full resync"""
+    return timezone.now() - timedelta(seconds=getattr(settings, 'POKEMON_TOMBSTONE_RETENTION', 2592000))
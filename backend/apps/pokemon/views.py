@@ -1,21 +1,52 @@
 # apps/pokemon/views.py
 
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.db.models import Exists, OuterRef, Q
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils import timezone
 from rest_framework import viewsets, status, filters
 from rest_framework.decorators import action
 from rest_framework.response import Response
-from rest_framework.permissions import IsAuthenticated
-from .models import Pokemon, FavoritePokemon
-from .serializers import PokemonSerializer, PokemonCreateSerializer
-from .utils import fetch_pokemon_from_api, parse_csv_to_pokemon
+from rest_framework.permissions import IsAuthenticated, IsAdminUser, SAFE_METHODS
+from rest_framework.exceptions import ValidationError
+from rest_framework.settings import api_settings
+from .models import Pokemon, FavoritePokemon, PokemonMove, PokemonAbility, PokemonTombstone, STAT_COLUMNS
+from .serializers import PokemonSerializer, PokemonCreateSerializer, PokemonMapSerializer
+from .renderers import NDJSONRenderer, CSVRenderer, ColumnarJSONRenderer, ColumnarBinaryRenderer
+from .mapdata import MAP_FIELDS, build_columnar_payload
+from .snapshot import shared_map_snapshot
+from .signals import pokemon_bulk_created
+from .weather import weather_cache
+from .energy import energy_scheduler, route_proximity
+# aliased, the viewset has actions of the same names
+from .energy_batch import energy_snapshot as batch_energy_snapshot
+from .loop_lag import loop_lag_monitor
+from .pokemon_state import pokemon_states
+from .energy_history import energy_history as energy_history_store
+from .utils import (
+    fetch_pokemon_from_api, parse_csv_to_pokemon, normalize_name, sync_moves_and_abilities,
+    EXPORT_FIELDS, iter_pokemon_ndjson, iter_pokemon_csv, iter_in_sync_thread,
+    encode_change_cursor, decode_change_cursor, tombstone_cutoff
+)
 import csv
 import io
+import math
+import time
+from datetime import timedelta
+
+MAX_HISTORY_BUCKETS = 1000
+STAT_FILTER_FIELDS = [*STAT_COLUMNS.values(), 'stat_total']
+STAT_FILTER_LOOKUPS = ['gt', 'gte', 'lt', 'lte']
+EXPORT_CHUNK_SIZE = 2000
 
 class PokemonViewSet(viewsets.ModelViewSet):
     queryset = Pokemon.objects.all()
     serializer_class = PokemonSerializer
     permission_classes = [IsAuthenticated]
-    filter_backends = [filters.SearchFilter]
+    filter_backends = [filters.SearchFilter, filters.OrderingFilter]
     search_fields = ['name', 'type_primary', 'type_secondary', 'category']
+    ordering_fields = ['name', *STAT_FILTER_FIELDS]
     
     def get_queryset(self):
         queryset = super().get_queryset()
@@ -25,22 +56,105 @@ class PokemonViewSet(viewsets.ModelViewSet):
         if source:
             queryset = queryset.filter(source=source.upper())
         
+        if self.action in ('list', 'retrieve'):
+            queryset = self.apply_sparse_fields(queryset)
+        
         return queryset
     
+    def get_sparse_fields(self):
+        """Response fields selected by ?fields= and/or ?omit= (comma separated), None for all
+
+        Reads only: writes always validate and return the full serializer.
+        """
+        if self.request.method not in SAFE_METHODS:
+            return None
+        if not hasattr(self, '_sparse_fields'):
+            fields = self.request.query_params.get('fields', None)
+            omit = self.request.query_params.get('omit', None)
+            self._sparse_fields = None
+            if fields is not None or omit is not None:
+                available = list(PokemonSerializer().fields)
+                selected = self.parse_field_list('fields', fields, available) if fields is not None else set(available)
+                omitted = self.parse_field_list('omit', omit, available) if omit is not None else set()
+                self._sparse_fields = selected - omitted
+        return self._sparse_fields
+    
+    def parse_field_list(self, param, value, available):
+        names = {name.strip() for name in value.split(',') if name.strip()}
+        unknown = sorted(names - set(available))
+        if unknown:
+            raise ValidationError({
+                param: f'Unknown field(s): {", ".join(unknown)}. Available fields: {", ".join(available)}'
+            })
+        return names
+    
+    def get_sparse_columns(self):
+        """Pokemon columns the sparse fieldset reads, None for all"""
+        fields = self.get_sparse_fields()
+        if fields is None:
+            return None
+        return {field.name for field in Pokemon._meta.concrete_fields} & fields
+    
+    def apply_sparse_fields(self, queryset):
+        """Only load the columns the sparse fieldset needs, so unused JSON blobs are never read"""
+        columns = self.get_sparse_columns()
+        if columns is None:
+            return queryset
+        return queryset.only('id', *columns)
+    
     def filter_queryset(self, queryset):
         # Apply source filter first
         source = self.request.query_params.get('source', None)
         if source:
             queryset = queryset.filter(source=source.upper())
         
-        # Then apply search filter
+        # Filter by move/ability through the indexed through-tables
+        move = self.request.query_params.get('move', None)
+        if move:
+            queryset = queryset.filter(Exists(PokemonMove.objects.filter(
+                pokemon=OuterRef('pk'), move__name=normalize_name(move)
+            )))
+        
+        ability = self.request.query_params.get('ability', None)
+        if ability:
+            queryset = queryset.filter(Exists(PokemonAbility.objects.filter(
+                pokemon=OuterRef('pk'), ability__name=normalize_name(ability)
+            )))
+        
+        # Stat range filters, e.g. ?stat_attack__gte=100&stat_speed__gt=90
+        queryset = queryset.filter(**self.get_stat_filters())
+        
+        # Then apply search filter and ordering
         for backend in list(self.filter_backends):
             queryset = backend().filter_queryset(self.request, queryset, self)
         
         return queryset
     
+    def get_stat_filters(self):
+        """Collect stat_<name>[__<lookup>] query params into ORM lookups on the indexed stat columns"""
+        stat_filters = {}
+        for param, value in self.request.query_params.items():
+            field, _, lookup = param.partition('__')
+            if field not in STAT_FILTER_FIELDS:
+                continue
+            if lookup and lookup not in STAT_FILTER_LOOKUPS:
+                raise ValidationError({param: f'Unsupported lookup, use one of: {", ".join(STAT_FILTER_LOOKUPS)}'})
+            try:
+                stat_filters[param] = int(value)
+            except ValueError:
+                raise ValidationError({param: 'Must be an integer'})
+        return stat_filters
+    
     def get_serializer_context(self):
-        return {'request': self.request}
+        return {'request': self.request, 'fields': self.get_sparse_fields()}
+    
+    def perform_create(self, serializer):
+        pokemon = serializer.save()
+        sync_moves_and_abilities([pokemon])
+    
+    def perform_update(self, serializer):
+        pokemon = serializer.save()
+        sync_moves_and_abilities([pokemon])
     
     @action(detail=False, methods=['post'])
     def fetch_from_api(self, request):
@@ -82,6 +196,8 @@ class PokemonViewSet(viewsets.ModelViewSet):
             
             # bulk create
             Pokemon.objects.bulk_create(pokemon_list)
+            sync_moves_and_abilities(pokemon_list)
+            pokemon_bulk_created.send(sender=Pokemon, instances=pokemon_list)
             
             serializer = PokemonSerializer(pokemon_list, many=True, context={'request': request})
             
@@ -120,10 +236,13 @@ class PokemonViewSet(viewsets.ModelViewSet):
         favorites = FavoritePokemon.objects.filter(
             user = request.user
         ).select_related('pokemon')
+        columns = self.get_sparse_columns()
+        if columns is not None:
+            favorites = favorites.only('pokemon', 'pokemon__id', *(f'pokemon__{column}' for column in columns))
         
         pokemon = [favorite.pokemon for favorite in favorites]
         
-        serializer = PokemonSerializer(pokemon, many = True, context = {'request': request})
+        serializer = PokemonSerializer(pokemon, many = True, context = self.get_serializer_context())
         
         return Response({
             'message': 'Successfully fetched list of favorite Pokemon',
@@ -131,12 +250,23 @@ class PokemonViewSet(viewsets.ModelViewSet):
             'results': serializer.data
         }, status = status.HTTP_200_OK)
     
-    @action(detail=False, methods=['get'])
+    @action(detail=False, methods=['get'], renderer_classes=[
+        *api_settings.DEFAULT_RENDERER_CLASSES, ColumnarJSONRenderer, ColumnarBinaryRenderer
+    ])
     def all_for_map(self, request):
-        """Get all Pokemon in a single request for map display"""
+        """Get all Pokemon in a single request for map display
+        
+        ?format=columnar (or the matching Accept type) returns the compact struct-of-arrays
+        payload and ?format=columnar-bin its binary variant, carrying only the fields the map uses.
+        """
         try:
-            pokemon_list = Pokemon.objects.all()
-            serializer = PokemonSerializer(pokemon_list, many=True, context={'request': request})
+            if request.accepted_renderer.format in (ColumnarJSONRenderer.format, ColumnarBinaryRenderer.format):
+                rows = Pokemon.objects.values_list(*MAP_FIELDS)
+                favorite_ids = FavoritePokemon.objects.filter(user=request.user).values_list('pokemon_id', flat=True)
+                return Response(build_columnar_payload(rows, favorite_ids), status=status.HTTP_200_OK)
+            
+            pokemon_list = self.apply_sparse_fields(Pokemon.objects.all())
+            serializer = PokemonSerializer(pokemon_list, many=True, context=self.get_serializer_context())
             
             return Response({
                 'count': len(serializer.data),
@@ -145,4 +275,183 @@ class PokemonViewSet(viewsets.ModelViewSet):
         except Exception as e:
             return Response({
                 'error': str(e)
-            }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
\ No newline at end of file
+            }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+    
+    @action(detail=False, methods=['get'])
+    def map_snapshot(self, request):
+        """Serve the shared, precompressed map dataset (all_for_map without is_favorite)
+        
+        Pair with favorite_ids for the per-user part.
+        """
+        snapshot = shared_map_snapshot.get()
+        if request.headers.get('If-None-Match') == snapshot.etag:
+            response = HttpResponse(status=status.HTTP_304_NOT_MODIFIED)
+        else:
+            body, encoding = snapshot.encode_for(request.headers.get('Accept-Encoding', ''))
+            response = HttpResponse(body, content_type='application/json')
+            if encoding:
+                response['Content-Encoding'] = encoding
+        response['ETag'] = snapshot.etag
+        response['Vary'] = 'Accept-Encoding'
+        response['Cache-Control'] = 'private, no-cache'
+        return response
+    
+    @action(detail=False, methods=['get'])
+    def favorite_ids(self, request):
+        """Get the ids of the user's favorite Pokemon"""
+        ids = list(FavoritePokemon.objects.filter(user=request.user).values_list('pokemon_id', flat=True))
+        return Response({
+            'count': len(ids),
+            'ids': ids
+        }, status=status.HTTP_200_OK)
+    
+    @action(detail=False, methods=['get'])
+    def changes(self, request):
+        """Get Pokemon created/updated and ids deleted after ?since=<cursor>
+        
+        since=0 returns everything. Pass the returned cursor on the next call. Changes from the
+        last POKEMON_CHANGES_OVERLAP seconds before the cursor are sent again (a write can commit
+        after a cursor past its updated_at was handed out), so apply them idempotently by id.
+        A cursor older than POKEMON_TOMBSTONE_RETENTION may have missed pruned deletions: the
+        response then has resync: true and every Pokemon, to replace the client's copy.
+        """
+        try:
+            since = decode_change_cursor(request.query_params.get('since', ''))
+        except ValueError:
+            return Response({
+                'error': 'since must be a cursor returned by this endpoint, or 0'
+            }, status=status.HTTP_400_BAD_REQUEST)
+        
+        overlap = timedelta(seconds=getattr(settings, 'POKEMON_CHANGES_OVERLAP', 60))
+        resync = since < tombstone_cutoff()
+        if resync:
+            upserts = list(Pokemon.objects.order_by('updated_at'))
+            deletions = []
+            since = timezone.now() - overlap
+        else:
+            start = since - overlap
+            upserts = list(Pokemon.objects.filter(updated_at__gt=start).order_by('updated_at'))
+            # an id that was deleted and then created again is live
+            deletions = list(
+                PokemonTombstone.objects.filter(deleted_at__gt=start)
+                .exclude(Exists(Pokemon.objects.filter(pk=OuterRef('pokemon_id'))))
+                .values_list('pokemon_id', 'deleted_at')
+            )
+        
+        latest = max([since] + [pokemon.updated_at for pokemon in upserts] + [deleted_at for _, deleted_at in deletions])
+        deleted_ids = {pokemon_id for pokemon_id, _ in deletions}
+        
+        return Response({
+            'cursor': encode_change_cursor(latest),
+            'resync': resync,
+            'count': len(upserts) + len(deleted_ids),
+            'upserts': PokemonMapSerializer(upserts, many=True).data,
+            'deletions': sorted(deleted_ids)
+        }, status=status.HTTP_200_OK)
+    
+    @action(detail=False, methods=['get'])
+    def energy_snapshot(self, request):
+        """Energy of every Pokemon in ?bbox=min_lon,min_lat,max_lon,max_lat, computed in one batch
+        
+        Weather comes from the shared cache only, so the request never waits on the upstream
+        (cells nobody has fetched get the no-weather default). ?seed= makes the variance
+        reproducible. At most POKEMON_ENERGY_SNAPSHOT_LIMIT Pokemon are returned.
+        """
+        try:
+            west, south, east, north = (float(value) for value in request.query_params.get('bbox', '').split(','))
+        except ValueError:
+            return Response({
+                'error': 'bbox must be min_lon,min_lat,max_lon,max_lat'
+            }, status=status.HTTP_400_BAD_REQUEST)
+        if south > north:
+            return Response({
+                'error': 'bbox min_lat must not be greater than max_lat'
+            }, status=status.HTTP_400_BAD_REQUEST)
+        
+        seed = request.query_params.get('seed', None)
+        try:
+            seed = int(seed) if seed is not None else None
+        except ValueError:
+            return Response({
+                'error': 'seed must be an integer'
+            }, status=status.HTTP_400_BAD_REQUEST)
+        
+        queryset = Pokemon.objects.filter(latitude__gte=south, latitude__lte=north)
+        if west <= east:
+            queryset = queryset.filter(longitude__gte=west, longitude__lte=east)
+        else:
+            # the box crosses the antimeridian
+            queryset = queryset.filter(Q(longitude__gte=west) | Q(longitude__lte=east))
+        limit = getattr(settings, 'POKEMON_ENERGY_SNAPSHOT_LIMIT', 5000)
+        rows = list(queryset.order_by().values_list('id', 'name', 'latitude', 'longitude')[:limit + 1])
+        
+        payload = batch_energy_snapshot(rows[:limit], weather_cache.peek, seed=seed)
+        payload['truncated'] = len(rows) > limit
+        return Response(payload, status=status.HTTP_200_OK)
+    
+    @action(detail=True, methods=['get'])
+    def energy_history(self, request, pk=None):
+        """Recent energy of a Pokemon as min/max/mean buckets
+        
+        ?window= seconds back from now (3600 by default), ?resolution= seconds per bucket
+        (window / 60 by default). Only covers the ticks of this process, see EnergyHistory.
+        """
+        pokemon = self.get_object()
+        try:
+            window = float(request.query_params.get('window', 3600))
+            resolution = float(request.query_params.get('resolution', window / 60))
+        except ValueError:
+            return Response({
+                'error': 'window and resolution must be numbers of seconds'
+            }, status=status.HTTP_400_BAD_REQUEST)
+        if not (window > 0 and resolution > 0 and math.isfinite(window) and math.isfinite(resolution)):
+            return Response({
+                'error': 'window and resolution must be positive and finite'
+            }, status=status.HTTP_400_BAD_REQUEST)
+        if not 1 <= math.ceil(window / resolution) <= MAX_HISTORY_BUCKETS:
+            return Response({
+                'error': f'window / resolution must be from 1 to {MAX_HISTORY_BUCKETS} buckets'
+            }, status=status.HTTP_400_BAD_REQUEST)
+        
+        return Response({
+            'pokemon_id': pokemon.id,
+            'window': window,
+            'resolution': resolution,
+            **energy_history_store.downsample(pokemon.id, window, resolution, time.time()),
+        }, status=status.HTTP_200_OK)
+    
+    @action(detail=False, methods=['get'], permission_classes=[IsAdminUser])
+    def realtime_metrics(self, request):
+        """Live-feed health of this process: weather breaker/latency, energy scheduler load and event loop lag (staff only)"""
+        return Response({
+            'weather': weather_cache.metrics(),
+            'energy': {
+                'connections': energy_scheduler.connections,
+                'ticking_pokemon': len(energy_scheduler.active_pokemon),
+                'interval': energy_scheduler.effective_interval(),
+                'route_proximity': route_proximity.metrics(),
+                'pokemon_states': pokemon_states.metrics(),
+                'history': energy_history_store.metrics(),
+            },
+            'event_loop': loop_lag_monitor.metrics(),
+        }, status=status.HTTP_200_OK)
+    
+    @action(detail=False, methods=['get'], renderer_classes=[NDJSONRenderer, CSVRenderer])
+    def export(self, request):
+        """Stream every (filtered) Pokemon as NDJSON or CSV without materializing the table"""
+        queryset = self.filter_queryset(self.get_queryset())
+        rows = queryset.values(*EXPORT_FIELDS).iterator(chunk_size=EXPORT_CHUNK_SIZE)
+        
+        csv_format = request.accepted_renderer.format == 'csv'
+        chunks = iter_pokemon_csv(rows) if csv_format else iter_pokemon_ndjson(rows)
+        # ASGI servers need an async iterator to stream, WSGI ones a sync one
+        if isinstance(request._request, ASGIRequest):
+            chunks = iter_in_sync_thread(chunks)
+        
+        if csv_format:
+            response = StreamingHttpResponse(chunks, content_type='text/csv; charset=utf-8')
+            response['Content-Disposition'] = 'attachment; filename="pokemon.csv"'
+        else:
+            response = StreamingHttpResponse(chunks, content_type='application/x-ndjson')
+            response['Content-Disposition'] = 'attachment; filename="pokemon.ndjson"'
+        return response
@@ -0,0 +1,174 @@
+# apps/pokemon/weather.py
+
+# Process-wide weather cache shared by every energy consumer
+import asyncio
+import math
+import time
+from django.conf import settings
+from .http_client import get_client_session
+from .resilience import CircuitBreaker, LatencyRecorder
+
+def fetch_settings():
+    """Weather settings, read at call time so they can be overridden per test/deployment"""
+    return {
+        'url': getattr(settings, 'OPENWEATHER_API_URL', 'https://api.openweathermap.org/data/2.5/weather'),
+        'ttl': getattr(settings, 'POKEMON_WEATHER_TTL', 300),
+        'max_stale': getattr(settings, 'POKEMON_WEATHER_MAX_STALE', 1800),
+        'cell_degrees': getattr(settings, 'POKEMON_WEATHER_CELL_DEGREES', 0.1),
+        'deadline': getattr(settings, 'POKEMON_WEATHER_DEADLINE', 2.0),
+    }
+
+def weather_cell(latitude, longitude, cell_degrees):
+    """Grid cell (integer indices) containing a point"""
+    return (math.floor(latitude / cell_degrees), math.floor(longitude / cell_degrees))
+
+def cell_center(cell, cell_degrees):
+    return ((cell[0] + 0.5) * cell_degrees, (cell[1] + 0.5) * cell_degrees)
+
+async def fetch_weather(latitude, longitude, api_key):
+    """Fetch current weather from OpenWeatherMap, returns {'description', 'temperature'} or None"""
+    url = f"{fetch_settings()['url']}?lat={latitude}&lon={longitude}&appid={api_key}&units=metric"
+    async with get_client_session().get(url) as response:
+        if response.status != 200:
+            return None
+        weather_data = await response.json()
+        return {
+            'description': weather_data['weather'][0]['description'],
+            'temperature': weather_data['main']['temp'],
+        }
+
+class WeatherEntry:
+    __slots__ = ('data', 'fetched_at')
+
+    def __init__(self, data, fetched_at):
+        self.data = data
+        self.fetched_at = fetched_at
+
+class WeatherCache:
+    """Weather per grid cell with a TTL, single-flight fetches and stale-while-revalidate
+
+    - fresh entries (younger than ttl) are returned directly
+    - stale entries (younger than max_stale) are returned while one background refresh runs
+    - misses (or entries past max_stale) wait for the fetch; concurrent misses for the same
+      cell share one in-flight request
+    Failed fetches are not cached, a stale entry keeps being served until one succeeds.
+
+    Callers wait at most `deadline` seconds (the fetch carries on in the background). Upstream
+    calls go through a circuit breaker; while it is open (or a caller's deadline passed) the
+    last known value of the cell is served whatever its age, or None for the default energy.
+    """
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self._entries = {}
+        self._inflight = {}
+        self.upstream_calls = 0
+        self.breaker = CircuitBreaker(clock=lambda: self.clock())
+        self.latency = LatencyRecorder()
+        self.counters = dict.fromkeys(
+            ['upstream_failures', 'upstream_timeouts', 'short_circuited', 'deadline_exceeded', 'fallbacks_served'], 0
+        )
+
+    def clear(self):
+        self._entries.clear()
+        self._inflight.clear()
+        self.breaker.reset()
+        self.latency.clear()
+        for name in self.counters:
+            self.counters[name] = 0
+
+    async def get(self, latitude, longitude, api_key):
+        config = fetch_settings()
+        cell = weather_cell(latitude, longitude, config['cell_degrees'])
+        entry = self._entries.get(cell)
+        if entry is not None:
+            age = self.clock() - entry.fetched_at
+            if age < config['ttl']:
+                return entry.data
+            if age < config['max_stale']:
+                self._refresh(cell, api_key, config)
+                return entry.data
+        try:
+            return await asyncio.wait_for(asyncio.shield(self._refresh(cell, api_key, config)), config['deadline'])
+        except asyncio.TimeoutError:
+            self.counters['deadline_exceeded'] += 1
+            return self._last_known(cell)
+
+    def cell_age(self, cell):
+        """Seconds since the cell was fetched, None if it never was"""
+        entry = self._entries.get(cell)
+        return None if entry is None else self.clock() - entry.fetched_at
+
+    def peek(self, latitude, longitude):
+        """Last known weather at a point whatever its age, never fetches (None if never fetched)"""
+        entry = self._entries.get(weather_cell(latitude, longitude, fetch_settings()['cell_degrees']))
+        return None if entry is None else entry.data
+
+    def is_fetching(self, cell):
+        task = self._inflight.get(cell)
+        return task is not None and not task.done()
+
+    async def prefetch(self, cell, api_key):
+        """Fetch a cell now (joining an in-flight fetch), used to refresh ahead of expiry"""
+        return await asyncio.shield(self._refresh(cell, api_key, fetch_settings()))
+
+    def _last_known(self, cell):
+        entry = self._entries.get(cell)
+        if entry is None:
+            return None
+        self.counters['fallbacks_served'] += 1
+        return entry.data
+
+    def _refresh(self, cell, api_key, config):
+        """Start (or join) the single in-flight fetch for a cell"""
+        loop = asyncio.get_running_loop()
+        task = self._inflight.get(cell)
+        if task is None or task.done() or task.get_loop() is not loop:
+            task = loop.create_task(self._fetch(cell, api_key, config))
+            self._inflight[cell] = task
+        return task
+
+    async def _fetch(self, cell, api_key, config):
+        try:
+            if not self.breaker.allow():
+                # upstream is known to be down, don't add to it
+                self.counters['short_circuited'] += 1
+                return self._last_known(cell)
+
+            self.upstream_calls += 1
+            started = self.clock()
+            try:
+                data = await fetch_weather(*cell_center(cell, config['cell_degrees']), api_key)
+            except asyncio.TimeoutError:
+                self.counters['upstream_timeouts'] += 1
+                data = None
+            except Exception:
+                data = None
+            self.latency.record(self.clock() - started)
+
+            if data is not None:
+                self.breaker.record_success()
+                self._entries[cell] = WeatherEntry(data, self.clock())
+                return data
+            self.counters['upstream_failures'] += 1
+            self.breaker.record_failure()
+            # keep serving what we had when the refresh failed, as long as it is not too old
+            entry = self._entries.get(cell)
+            if entry is not None and self.clock() - entry.fetched_at < config['max_stale']:
+                return entry.data
+            return None
+        finally:
+            if self._inflight.get(cell) is asyncio.current_task():
+                del self._inflight[cell]
+
+    def metrics(self):
+        return {
+            'breaker': self.breaker.snapshot(),
+            'upstream_calls': self.upstream_calls,
+            'upstream_latency': self.latency.snapshot(),
+            'cached_cells': len(self._entries),
+            'inflight': len(self._inflight),
+            **self.counters,
+        }
+
+weather_cache = WeatherCache()
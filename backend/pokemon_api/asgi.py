@@ -13,8 +13,10 @@ os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'pokemon_api.settings')
 django_asgi_app = get_asgi_application()
 
 from apps.pokemon.routing import websocket_urlpatterns
+from apps.pokemon.http_client import LifespanApp
 
-application = ProtocolTypeRouter({
+# LifespanApp runs the shutdown hooks under daphne too, which never sends lifespan events
+application = LifespanApp(ProtocolTypeRouter({
     # Django's ASGI application to handle traditional HTTP requests
     "http": django_asgi_app,
 
@@ -24,5 +26,5 @@ application = ProtocolTypeRouter({
             URLRouter(websocket_urlpatterns)
         )
     ),
-})
+}))
 
@@ -44,6 +44,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'apps.pokemon.middleware.MapBroadcastMiddleware',  # one live map message per request
 ]
 
 ROOT_URLCONF = 'pokemon_api.urls'
@@ -74,6 +75,24 @@ DATABASES = {
     }
 }
 
+# Caches
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # serialized Pokemon fragments keyed by (id, updated_at); LocMemCache evicts least recently used
+    'pokemon_fragments': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'pokemon-fragments',
+        'TIMEOUT': None,
+        'OPTIONS': {
+            'MAX_ENTRIES': 50000,
+            'CULL_FREQUENCY': 10,
+        },
+    },
+}
+POKEMON_FRAGMENT_CACHE = 'pokemon_fragments'
+
 # Password validation
 AUTH_PASSWORD_VALIDATORS = [
     {
@@ -130,3 +149,79 @@ CHANNEL_LAYERS = {
         'BACKEND': 'channels.layers.InMemoryChannelLayer',  # good for development, not for production use redis or rabbitmq for production
     }
 }
+
+# Several local daphne workers can share groups through a SQLite file instead (no broker needed)
+if os.environ.get('POKEMON_CHANNEL_LAYER_PATH'):
+    CHANNEL_LAYERS['default'] = {
+        'BACKEND': 'apps.pokemon.channel_layer.SQLiteChannelLayer',
+        'CONFIG': {
+            'path': os.environ['POKEMON_CHANNEL_LAYER_PATH'],
+        },
+    }
+
+# Map snapshot: seconds to wait after the last Pokemon write before rebuilding the precompressed snapshot
+POKEMON_MAP_SNAPSHOT_DEBOUNCE = float(os.environ.get('POKEMON_MAP_SNAPSHOT_DEBOUNCE', '1.0'))
+
+# Weather for the energy consumers: one cached OpenWeatherMap lookup per grid cell
+OPENWEATHER_API_URL = os.environ.get('OPENWEATHER_API_URL', 'https://api.openweathermap.org/data/2.5/weather')
+POKEMON_WEATHER_TTL = float(os.environ.get('POKEMON_WEATHER_TTL', '300'))  # seconds an observation is fresh
+POKEMON_WEATHER_MAX_STALE = float(os.environ.get('POKEMON_WEATHER_MAX_STALE', '1800'))  # served (while refreshing) up to this age
+POKEMON_WEATHER_CELL_DEGREES = float(os.environ.get('POKEMON_WEATHER_CELL_DEGREES', '0.1'))  # ~11 km cells
+POKEMON_WEATHER_DEADLINE = float(os.environ.get('POKEMON_WEATHER_DEADLINE', '2.0'))  # longest a tick waits for weather
+POKEMON_WEATHER_BREAKER_FAILURES = int(os.environ.get('POKEMON_WEATHER_BREAKER_FAILURES', '5'))  # consecutive failures that open the breaker
+POKEMON_WEATHER_BREAKER_RESET = float(os.environ.get('POKEMON_WEATHER_BREAKER_RESET', '30'))  # seconds before a half-open probe
+
+# Pooled outbound HTTP client (apps/pokemon/http_client.py), seconds for timeouts
+POKEMON_HTTP_POOL_LIMIT = int(os.environ.get('POKEMON_HTTP_POOL_LIMIT', '100'))
+POKEMON_HTTP_POOL_LIMIT_PER_HOST = int(os.environ.get('POKEMON_HTTP_POOL_LIMIT_PER_HOST', '20'))
+POKEMON_HTTP_DNS_TTL = int(os.environ.get('POKEMON_HTTP_DNS_TTL', '300'))
+POKEMON_HTTP_KEEPALIVE = float(os.environ.get('POKEMON_HTTP_KEEPALIVE', '30'))
+POKEMON_HTTP_CONNECT_TIMEOUT = float(os.environ.get('POKEMON_HTTP_CONNECT_TIMEOUT', '3'))
+POKEMON_HTTP_READ_TIMEOUT = float(os.environ.get('POKEMON_HTTP_READ_TIMEOUT', '5'))
+POKEMON_HTTP_TOTAL_TIMEOUT = float(os.environ.get('POKEMON_HTTP_TOTAL_TIMEOUT', '8'))
+
+# Multiplexed energy socket (ws/pokemon/energy/): Pokemon one connection may subscribe to
+POKEMON_ENERGY_MAX_SUBSCRIPTIONS = int(os.environ.get('POKEMON_ENERGY_MAX_SUBSCRIPTIONS', '200'))
+
+# Energy tick cadence: seconds between ticks of a watched Pokemon, and up to how many seconds
+# each tick is randomly delayed (0 keeps every tick on the interval boundary, batching frames)
+POKEMON_ENERGY_INTERVAL = float(os.environ.get('POKEMON_ENERGY_INTERVAL', '5.0'))
+POKEMON_ENERGY_JITTER = float(os.environ.get('POKEMON_ENERGY_JITTER', '0'))
+
+# Energy history: readings kept per Pokemon (720 = 1 hour of 5 s ticks, 12 bytes each), how many
+# Pokemon keep one (least recently ticked dropped first), and the seconds of it sent on connect
+POKEMON_ENERGY_HISTORY_SIZE = int(os.environ.get('POKEMON_ENERGY_HISTORY_SIZE', '720'))
+POKEMON_ENERGY_HISTORY_POKEMON = int(os.environ.get('POKEMON_ENERGY_HISTORY_POKEMON', '10000'))
+POKEMON_ENERGY_BACKFILL = float(os.environ.get('POKEMON_ENERGY_BACKFILL', '300'))
+
+# Energy frame delivery: frames waiting per slow connection (newest kept), unacknowledged frame
+# messages per connection (?ack=N overrides), change-only mode defaults (?changed_only=1),
+# and the per-process socket count past which ticks slow down
+POKEMON_ENERGY_SEND_QUEUE = int(os.environ.get('POKEMON_ENERGY_SEND_QUEUE', '256'))
+POKEMON_ENERGY_ACK_WINDOW = int(os.environ.get('POKEMON_ENERGY_ACK_WINDOW', '16'))
+POKEMON_ENERGY_CHANGE_THRESHOLD = float(os.environ.get('POKEMON_ENERGY_CHANGE_THRESHOLD', '2.0'))
+POKEMON_ENERGY_HEARTBEAT = float(os.environ.get('POKEMON_ENERGY_HEARTBEAT', '30'))
+POKEMON_ENERGY_MAX_CONNECTIONS = int(os.environ.get('POKEMON_ENERGY_MAX_CONNECTIONS', '5000'))
+
+# Route proximity checks run off the event loop: 'thread' or 'process' workers, and how many
+POKEMON_ENERGY_EXECUTOR = os.environ.get('POKEMON_ENERGY_EXECUTOR', 'thread')
+POKEMON_ENERGY_WORKERS = int(os.environ.get('POKEMON_ENERGY_WORKERS', '2'))
+
+# Pokemon (id, name, coordinates) kept in memory for the energy sockets, least recently used evicted
+POKEMON_STATE_CACHE_SIZE = int(os.environ.get('POKEMON_STATE_CACHE_SIZE', '10000'))
+
+# Most Pokemon one /api/pokemon/energy_snapshot/?bbox= response computes
+POKEMON_ENERGY_SNAPSHOT_LIMIT = int(os.environ.get('POKEMON_ENERGY_SNAPSHOT_LIMIT', '5000'))
+
+# Delta sync (/api/pokemon/changes/): seconds before the cursor read again so writes committed
+# late aren't skipped, and seconds tombstones are kept (older cursors get a full resync)
+POKEMON_CHANGES_OVERLAP = float(os.environ.get('POKEMON_CHANGES_OVERLAP', '60'))
+POKEMON_TOMBSTONE_RETENTION = float(os.environ.get('POKEMON_TOMBSTONE_RETENTION', '2592000'))
+
+# Weather prefetcher: refreshes the busiest cells ahead of expiry, at most RATE upstream calls
+# per minute (lazy misses included); INTERVAL/LEAD/RESCAN in seconds
+POKEMON_WEATHER_PREFETCH = os.environ.get('POKEMON_WEATHER_PREFETCH', 'True') == 'True'
+POKEMON_WEATHER_PREFETCH_RATE = int(os.environ.get('POKEMON_WEATHER_PREFETCH_RATE', '50'))
+POKEMON_WEATHER_PREFETCH_INTERVAL = float(os.environ.get('POKEMON_WEATHER_PREFETCH_INTERVAL', '15'))
+POKEMON_WEATHER_PREFETCH_LEAD = float(os.environ.get('POKEMON_WEATHER_PREFETCH_LEAD', '60'))
+POKEMON_WEATHER_PREFETCH_RESCAN = float(os.environ.get('POKEMON_WEATHER_PREFETCH_RESCAN', '300'))
@@ -1,20 +1,64 @@
 # tests/tests.py
 
-from django.test import TestCase
+from django.conf import settings
+from django.test import AsyncClient, TestCase, override_settings
 from django.contrib.auth.models import User
-from apps.pokemon.models import Pokemon, FavoritePokemon
+from django.utils import timezone
+from apps.pokemon.models import STAT_COLUMNS, Pokemon, FavoritePokemon, Move, PokemonMove, PokemonTombstone
+from apps.pokemon.utils import decode_change_cursor, encode_change_cursor, sync_moves_and_abilities
+from apps.pokemon.mapdata import unpack_columnar_binary
+from apps.pokemon.snapshot import shared_map_snapshot
+from apps.pokemon.broadcast import map_broadcaster
+from apps.pokemon.weather import WeatherCache, weather_cache
+from apps.pokemon.fake_weather import FakeWeatherServer
+from apps.pokemon.channel_layer import SQLiteChannelLayer
+from apps.pokemon.outbound import FrameQueue, SendPolicy
+from apps.pokemon.energy_codec import BINARY_SUBPROTOCOL, pack_batch, pack_energy_record, pack_heartbeat, unpack_frame
+from apps.pokemon.prefetch import WeatherPrefetcher
+from apps.pokemon.resilience import CircuitBreaker
+from apps.pokemon.http_client import LifespanApp, client_sessions, get_client_session
 from rest_framework.test import APIClient
+from rest_framework.authtoken.models import Token
 from rest_framework import status
 from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from channels.testing import WebsocketCommunicator
 from channels.db import database_sync_to_async
-from apps.pokemon.consumers import PokemonEnergyConsumer
+from apps.pokemon.energy import (
+    EnergyScheduler, RouteProximityPool, calculate_energy_based_on_weather, calculate_energy_level, energy_group, energy_scheduler, get_polyline_for_pokemon,
+    is_point_near_polyline, route_proximity,
+)
+from apps.pokemon.loop_lag import LoopLagMonitor
+from apps.pokemon.energy_batch import energy_batch, near_route_batch
+from apps.pokemon.pokemon_state import PokemonStateCache, pokemon_states
+from apps.pokemon.clock import VirtualClock
+from apps.pokemon.energy_history import EnergyHistory, EnergyRing, energy_history
+from apps.pokemon.invalidation import CacheInvalidator, cache_invalidator
+from apps.pokemon.consumers import EnergySubscriptionsConsumer, PokemonEnergyConsumer
+from django.urls import re_path
 from apps.pokemon.routing import websocket_urlpatterns
 from channels.routing import URLRouter
-from unittest.mock import patch, AsyncMock
+from channels.exceptions import ChannelFull
+from unittest.mock import ANY, patch, AsyncMock, Mock
 from asgiref.sync import async_to_sync
 import json
 import asyncio
+import re
+import gzip
+import brotli
+import os
+import tempfile
+import warnings
+import time
+from datetime import timedelta
+import signal
+import socket
+import subprocess
+import sys
+import urllib.error
+import urllib.request
+import numpy as np
 
 # User tests
 # Test user registration
@@ -349,9 +393,586 @@ class PokemonTestCase(TestCase):
             print(result)
             self.assertIn(result['category'], ['blastoise'])
         
+    # Test filtering Pokemon by move and ability
+    def test_filtering_pokemon_by_move_and_ability(self):
+        self.client.force_authenticate(user=self.user)
+        
+        csv_content = b'Pokemon,Lat,Long,Type,Location,Moves,Sprite\nMew,34.10214701,-118.9104645,Psychic,Floaroma Town,"[""shadow-ball"", ""ancient-power""]",https://example.com/151.png\nGengar,34.2,-118.8,Ghost,Lavender Town,"[""shadow-ball"", ""hypnosis""]",https://example.com/94.png'
+        csv_file = SimpleUploadedFile('test.csv', csv_content, content_type='text/csv')
+        response = self.client.post('/api/pokemon/upload_from_csv/', {'file': csv_file}, format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(Move.objects.count(), 3)
+        self.assertEqual(PokemonMove.objects.count(), 4)
+        
+        pikachu = Pokemon.objects.create(
+            name='Pikachu',
+            latitude=34.0522,
+            longitude=-118.2437,
+            type_primary='electric',
+            moves=['thunderbolt'],
+            abilities=['static', 'lightning-rod'],
+            sprite='https://example.com/25.png',
+            source='API'
+        )
+        sync_moves_and_abilities([pikachu])
+        
+        response = self.client.get('/api/pokemon/?move=shadow-ball')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([result['name'] for result in response.data['results']], ['Gengar', 'Mew'])
+        
+        response = self.client.get('/api/pokemon/?move=Thunderbolt')
+        self.assertEqual([result['name'] for result in response.data['results']], ['Pikachu'])
+        
+        response = self.client.get('/api/pokemon/?ability=static')
+        self.assertEqual([result['name'] for result in response.data['results']], ['Pikachu'])
+        
+        response = self.client.get('/api/pokemon/?move=shadow-ball&source=csv&search=mew')
+        self.assertEqual([result['name'] for result in response.data['results']], ['Mew'])
+        
+        # the through-tables follow edits to the JSON fields
+        response = self.client.patch(f'/api/pokemon/{pikachu.id}/', {'moves': ['surf']}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.client.get('/api/pokemon/?move=thunderbolt').data['results'], [])
+        response = self.client.get('/api/pokemon/?move=surf')
+        self.assertEqual([result['name'] for result in response.data['results']], ['Pikachu'])
+        
+    # Test filtering and ordering Pokemon by base stats
+    def test_filtering_pokemon_by_stats(self):
+        self.client.force_authenticate(user=self.user)
+        
+        for name, attack, speed in [('Machamp', 130, 55), ('Jolteon', 65, 130), ('Dragonite', 134, 80), ('Snorlax', 110, 30)]:
+            Pokemon.objects.create(
+                name=name,
+                latitude=34.0,
+                longitude=-118.0,
+                type_primary='normal',
+                sprite='https://example.com/sprite.png',
+                stats={'hp': 80, 'attack': attack, 'defense': 70, 'special-attack': 60, 'special-defense': 70, 'speed': speed},
+                source='API'
+            )
+        
+        dragonite = Pokemon.objects.get(name='Dragonite')
+        self.assertEqual(dragonite.stat_attack, 134)
+        self.assertEqual(dragonite.stat_total, 80 + 134 + 70 + 60 + 70 + 80)
+        
+        response = self.client.get('/api/pokemon/?stat_attack__gte=110&stat_speed__gt=50')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([result['name'] for result in response.data['results']], ['Dragonite', 'Machamp'])
+        
+        response = self.client.get('/api/pokemon/?ordering=-stat_total')
+        self.assertEqual([result['name'] for result in response.data['results']], ['Dragonite', 'Jolteon', 'Machamp', 'Snorlax'])
+        
+        response = self.client.get('/api/pokemon/?stat_attack__foo=1')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get('/api/pokemon/?stat_attack__gte=lots')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        
+        # the columns follow edits to the stats dict
+        dragonite.stats = {'attack': 10}
+        dragonite.save(update_fields=['stats'])
+        dragonite.refresh_from_db()
+        self.assertEqual(dragonite.stat_attack, 10)
+        self.assertEqual(dragonite.stat_total, 10)
+        self.assertIsNone(dragonite.stat_speed)
+        
+        # CSV uploads parse stats with json.loads, which takes Infinity and NaN
+        dragonite.stats = {'hp': float('inf'), 'attack': 40000, 'defense': float('nan'), 'speed': 80}
+        dragonite.sync_stat_columns()
+        self.assertEqual((dragonite.stat_hp, dragonite.stat_attack, dragonite.stat_defense), (None, None, None))
+        self.assertEqual(dragonite.stat_total, 80)
+        # a total past the column is left out too
+        dragonite.stats = {stat_name: 6000 for stat_name in STAT_COLUMNS}
+        dragonite.save()
+        self.assertEqual(dragonite.stat_hp, 6000)
+        self.assertIsNone(dragonite.stat_total)
+        
+    # Test streaming the Pokemon table as NDJSON and CSV
+    def test_exporting_pokemon(self):
+        self.client.force_authenticate(user=self.user)
+        
+        Pokemon.objects.create(
+            name='Pikachu',
+            latitude=34.0522,
+            longitude=-118.2437,
+            location_name='Los Angeles',
+            type_primary='electric',
+            moves=['thunderbolt', 'quick-attack'],
+            abilities=['static'],
+            stats={'hp': 35, 'attack': 55, 'speed': 90},
+            height=0.4,
+            weight=6.0,
+            category='mouse',
+            sprite='https://example.com/25.png',
+            source='API'
+        )
+        Pokemon.objects.create(
+            name='Mew',
+            latitude=34.1,
+            longitude=-118.9,
+            type_primary='psychic',
+            moves=['psychic'],
+            sprite='https://example.com/151.png',
+            source='CSV',
+            uploaded_by=self.user
+        )
+        
+        response = self.client.get('/api/pokemon/export/?format=ndjson')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        self.assertEqual([row['name'] for row in rows], ['Mew', 'Pikachu'])
+        self.assertEqual(rows[1]['moves'], ['thunderbolt', 'quick-attack'])
+        
+        # filters apply to the export too
+        response = self.client.get('/api/pokemon/export/?format=ndjson&source=api&search=pika')
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        self.assertEqual([row['name'] for row in rows], ['Pikachu'])
+        
+        # the CSV export round-trips through upload_from_csv
+        response = self.client.get('/api/pokemon/export/?format=csv')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response['Content-Type'].startswith('text/csv'))
+        csv_content = b''.join(response.streaming_content)
+        
+        Pokemon.objects.all().delete()
+        csv_file = SimpleUploadedFile('export.csv', csv_content, content_type='text/csv')
+        response = self.client.post('/api/pokemon/upload_from_csv/', {'file': csv_file}, format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['count'], 2)
+        
+        pikachu = Pokemon.objects.get(name='Pikachu')
+        self.assertEqual(pikachu.moves, ['thunderbolt', 'quick-attack'])
+        self.assertEqual(pikachu.abilities, ['static'])
+        self.assertEqual(pikachu.stats, {'hp': 35, 'attack': 55, 'speed': 90})
+        self.assertEqual(pikachu.stat_total, 180)
+        self.assertEqual(pikachu.height, 0.4)
+        self.assertEqual(pikachu.category, 'mouse')
+        self.assertEqual(pikachu.location_name, 'Los Angeles')
+        self.assertIsNone(Pokemon.objects.get(name='Mew').height)
+        
+    # Test that the export streams under ASGI too
+    def test_exporting_pokemon_under_asgi(self):
+        Pokemon.objects.bulk_create([
+            Pokemon(name=f'Pokemon{i:04d}', latitude=34.0, longitude=-118.0, sprite='', source='API')
+            for i in range(1200)
+        ])
+        token, _ = Token.objects.get_or_create(user=self.user)
+        
+        async def run_test():
+            response = await AsyncClient().get(
+                '/api/pokemon/export/?format=ndjson', headers={'authorization': f'Token {token.key}'}
+            )
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            # an async iterator, so daphne sends each chunk as it's made
+            self.assertTrue(response.is_async)
+            with warnings.catch_warnings(record=True) as caught:
+                warnings.simplefilter('always')
+                chunks = [chunk async for chunk in response]
+            self.assertEqual(caught, [])
+            self.assertEqual(len(chunks), 3)
+            self.assertEqual(sum(chunk.count(b'\n') for chunk in chunks), 1200)
+        async_to_sync(run_test)()
+        
+    # Test the compact columnar map payload
+    def test_columnar_map_payload(self):
+        self.client.force_authenticate(user=self.user)
+        
+        for i in range(200):
+            Pokemon.objects.create(
+                name=f'Pokemon{i:03d}',
+                latitude=34.0 + i / 1000,
+                longitude=-118.0 - i / 1000,
+                type_primary=['grass', 'water', 'fire'][i % 3],
+                type_secondary='poison' if i % 2 else '',
+                moves=['tackle', 'growl', 'vine-whip', 'razor-leaf'],
+                abilities=['overgrow', 'chlorophyll'],
+                stats={'hp': 45, 'attack': 49, 'defense': 49, 'special-attack': 65, 'special-defense': 65, 'speed': 45},
+                category='seed',
+                sprite=f'https://raw.githubusercontent.com/PokeAPI/sprites/master/sprites/pokemon/{i}.png',
+                source='API'
+            )
+        favorite = Pokemon.objects.get(name='Pokemon007')
+        FavoritePokemon.objects.create(user=self.user, pokemon=favorite)
+        
+        full = self.client.get('/api/pokemon/all_for_map/')
+        columnar = self.client.get('/api/pokemon/all_for_map/?format=columnar')
+        self.assertEqual(columnar.status_code, status.HTTP_200_OK)
+        self.assertEqual(columnar['Content-Type'], 'application/vnd.pokemon.columnar+json')
+        self.assertLess(len(columnar.content) * 4, len(full.content))
+        
+        # the same negotiation works through the Accept header
+        accepted = self.client.get('/api/pokemon/all_for_map/', HTTP_ACCEPT='application/vnd.pokemon.columnar+json')
+        self.assertEqual(accepted.content, columnar.content)
+        
+        # decoding the columns gives back what the map reads from the full payload
+        data = json.loads(columnar.content)
+        self.assertEqual(data['count'], 200)
+        self.assertEqual(data['favorite_ids'], [favorite.id])
+        for i, result in enumerate(full.data['results']):
+            self.assertEqual(data['ids'][i], result['id'])
+            self.assertEqual(data['names'][i], result['name'])
+            self.assertEqual(data['coords'][2 * i], result['latitude'])
+            self.assertEqual(data['coords'][2 * i + 1], result['longitude'])
+            self.assertEqual(data['sprite_prefix'] + data['sprites'][i], result['sprite'])
+            self.assertEqual(data['types'][data['type_primary'][i]], result['type_primary'])
+            self.assertEqual(data['types'][data['type_secondary'][i]], result['type_secondary'])
+        
+        binary = self.client.get('/api/pokemon/all_for_map/?format=columnar-bin')
+        self.assertEqual(binary.status_code, status.HTTP_200_OK)
+        self.assertLess(len(binary.content), len(columnar.content))
+        unpacked = unpack_columnar_binary(binary.content)
+        self.assertEqual(unpacked['ids'], data['ids'])
+        self.assertEqual(unpacked['type_primary'], data['type_primary'])
+        self.assertEqual(unpacked['favorite_ids'], [favorite.id])
+        for packed, exact in zip(unpacked['coords'], data['coords']):
+            self.assertAlmostEqual(packed, exact, places=4)
+    
+    # Free-text types and big ids widen the binary columns instead of failing
+    def test_columnar_binary_wide_columns(self):
+        self.client.force_authenticate(user=self.user)
+        Pokemon.objects.bulk_create([
+            Pokemon(name=f'Pokemon{i:03d}', latitude=34.0, longitude=-118.0, type_primary=f'type-{i}', moves=[], abilities=[], stats={})
+            for i in range(300)
+        ])
+        Pokemon.objects.create(id=2 ** 32 + 5, name='Missingno', latitude=0.0, longitude=0.0, type_primary='bird')
+        
+        data = self.client.get('/api/pokemon/all_for_map/?format=columnar').data
+        binary = self.client.get('/api/pokemon/all_for_map/?format=columnar-bin')
+        self.assertEqual(binary.status_code, status.HTTP_200_OK)
+        unpacked = unpack_columnar_binary(binary.content)
+        self.assertIn(2 ** 32 + 5, unpacked['ids'])
+        self.assertEqual(unpacked['ids'], data['ids'])
+        self.assertEqual(unpacked['type_primary'], data['type_primary'])
+        self.assertEqual(unpacked['types'], data['types'])
+        self.assertGreater(max(unpacked['type_primary']), 255)
+        
+# Serializer fragment cache tests
+class FragmentCacheTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='testuser',
+            password='testpass123'
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+        for name in ['Bulbasaur', 'Squirtle', 'Charmander']:
+            Pokemon.objects.create(
+                name=name,
+                latitude=34.0,
+                longitude=-118.0,
+                type_primary='normal',
+                moves=['tackle'],
+                sprite='https://example.com/sprite.png',
+                source='API'
+            )
+        self.squirtle = Pokemon.objects.get(name='Squirtle')
+        FavoritePokemon.objects.create(user=self.user, pokemon=self.squirtle)
+    
+    def test_list_is_built_from_cached_fragments(self):
+        first = self.client.get('/api/pokemon/all_for_map/')
+        self.assertEqual(first.status_code, status.HTTP_200_OK)
+        self.assertEqual({result['name']: result['is_favorite'] for result in first.data['results']},
+                         {'Bulbasaur': False, 'Charmander': False, 'Squirtle': True})
+        
+        # warm: no field serialization at all, and one favorites query for the whole list
+        with patch('apps.pokemon.serializers.PokemonMapSerializer.to_representation') as to_representation:
+            with self.assertNumQueries(2):
+                second = self.client.get('/api/pokemon/all_for_map/')
+        to_representation.assert_not_called()
+        self.assertEqual(second.data, first.data)
+        
+        # the favorite overlay is per user while the fragments are shared
+        other = User.objects.create_user(username='otheruser', password='testpass123')
+        self.client.force_authenticate(user=other)
+        response = self.client.get('/api/pokemon/all_for_map/')
+        self.assertFalse(any(result['is_favorite'] for result in response.data['results']))
+    
+    def test_edited_rows_miss_the_cache(self):
+        self.client.get('/api/pokemon/')
+        
+        response = self.client.patch(f'/api/pokemon/{self.squirtle.id}/', {'location_name': 'Cerulean City'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['location_name'], 'Cerulean City')
+        self.assertTrue(response.data['is_favorite'])
+        
+        response = self.client.get('/api/pokemon/?search=squirtle')
+        self.assertEqual(response.data['results'][0]['location_name'], 'Cerulean City')
+    
+# Sparse fieldset tests
+class SparseFieldsTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='testuser',
+            password='testpass123'
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+        self.pokemon = Pokemon.objects.create(
+            name='Pikachu',
+            latitude=34.0522,
+            longitude=-118.2437,
+            type_primary='electric',
+            moves=['thunderbolt'],
+            abilities=['static'],
+            stats={'hp': 35},
+            sprite='https://example.com/25.png',
+            source='API'
+        )
+        FavoritePokemon.objects.create(user=self.user, pokemon=self.pokemon)
+    
+    def test_fields_narrow_response_and_query(self):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get('/api/pokemon/?fields=id,name,sprite,is_favorite')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['results'], [{
+            'id': self.pokemon.id,
+            'name': 'Pikachu',
+            'sprite': 'https://example.com/25.png',
+            'is_favorite': True
+        }])
+        select = next(query['sql'] for query in context.captured_queries if query['sql'].startswith('SELECT "pokemon_pokemon"."id"'))
+        for column in ['moves', 'abilities', 'stats']:
+            self.assertNotIn(f'"pokemon_pokemon"."{column}"', select)
+        
+        response = self.client.get(f'/api/pokemon/{self.pokemon.id}/?fields=name')
+        self.assertEqual(response.data, {'name': 'Pikachu'})
+        
+        response = self.client.get('/api/pokemon/all_for_map/?fields=id,latitude,longitude')
+        self.assertEqual(response.data['results'], [{'id': self.pokemon.id, 'latitude': 34.0522, 'longitude': -118.2437}])
+    
+    def test_favorites_load_only_selected_columns(self):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get('/api/pokemon/favorites/?fields=id,name')
+        self.assertEqual(response.data['results'], [{'id': self.pokemon.id, 'name': 'Pikachu'}])
+        select = next(query['sql'] for query in context.captured_queries if 'pokemon_favoritepokemon' in query['sql'])
+        for column in ['moves', 'abilities', 'stats', 'sprite']:
+            self.assertNotIn(f'"pokemon_pokemon"."{column}"', select)
+    
+    def test_writes_ignore_sparse_fields(self):
+        response = self.client.post('/api/pokemon/?fields=name', {
+            'name': 'Eevee', 'latitude': 35.0, 'longitude': -119.0, 'type_primary': 'normal',
+            'sprite': 'https://example.com/133.png', 'source': 'CSV'
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(Pokemon.objects.get(name='Eevee').latitude, 35.0)
+        response = self.client.patch(f'/api/pokemon/{self.pokemon.id}/?fields=name', {'latitude': 36.0}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['latitude'], 36.0)
+    
+    def test_omit_drops_fields(self):
+        response = self.client.get('/api/pokemon/?omit=moves,abilities,stats')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        result = response.data['results'][0]
+        self.assertNotIn('moves', result)
+        self.assertNotIn('stats', result)
+        self.assertEqual(result['name'], 'Pikachu')
+        self.assertTrue(result['is_favorite'])
+    
+    def test_unknown_fields_are_rejected(self):
+        response = self.client.get('/api/pokemon/?fields=name,nickname')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('Unknown field(s): nickname', str(response.data['fields']))
+        response = self.client.get('/api/pokemon/?omit=power')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+    
+# Map snapshot tests
+class MapSnapshotTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='testuser',
+            password='testpass123'
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+        self.pokemon = Pokemon.objects.create(
+            name='Pikachu',
+            latitude=34.0522,
+            longitude=-118.2437,
+            type_primary='electric',
+            sprite='https://example.com/25.png',
+            source='API'
+        )
+    
+    def get_snapshot(self, **headers):
+        response = self.client.get('/api/pokemon/map_snapshot/', **headers)
+        self.assertIn(response.status_code, [status.HTTP_200_OK, status.HTTP_304_NOT_MODIFIED])
+        return response
+    
+    def test_snapshot_encodings(self):
+        identity = self.get_snapshot()
+        self.assertNotIn('Content-Encoding', identity)
+        data = json.loads(identity.content)
+        self.assertEqual(data['count'], 1)
+        self.assertEqual(data['results'][0]['name'], 'Pikachu')
+        self.assertNotIn('is_favorite', data['results'][0])
+        
+        gzipped = self.get_snapshot(HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(gzipped['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(gzipped.content), identity.content)
+        
+        brotlied = self.get_snapshot(HTTP_ACCEPT_ENCODING='gzip, deflate, br')
+        self.assertEqual(brotlied['Content-Encoding'], 'br')
+        self.assertEqual(brotli.decompress(brotlied.content), identity.content)
+        self.assertIn('Accept-Encoding', brotlied['Vary'])
+        
+        not_modified = self.get_snapshot(HTTP_IF_NONE_MATCH=identity['ETag'])
+        self.assertEqual(not_modified.status_code, status.HTTP_304_NOT_MODIFIED)
+    
+    def test_snapshot_follows_writes(self):
+        etag = self.get_snapshot()['ETag']
+        
+        Pokemon.objects.create(
+            name='Mew',
+            latitude=34.1,
+            longitude=-118.9,
+            type_primary='psychic',
+            sprite='https://example.com/151.png',
+            source='CSV'
+        )
+        response = self.get_snapshot(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([result['name'] for result in json.loads(response.content)['results']], ['Mew', 'Pikachu'])
+        
+        self.pokemon.delete()
+        self.assertEqual(json.loads(self.get_snapshot().content)['count'], 1)
+    
+    @override_settings(POKEMON_MAP_SNAPSHOT_DEBOUNCE=60)
+    def test_snapshot_rebuild_is_debounced(self):
+        before = shared_map_snapshot.get()
+        try:
+            with self.captureOnCommitCallbacks(execute=True):
+                for i in range(3):
+                    Pokemon.objects.create(
+                        name=f'Ditto{i}',
+                        latitude=34.0,
+                        longitude=-118.0,
+                        type_primary='normal',
+                        sprite='https://example.com/132.png',
+                        source='CSV'
+                    )
+            # one pending rebuild for the burst, readers keep the previous snapshot meanwhile
+            timer = shared_map_snapshot._timer
+            self.assertIsNotNone(timer)
+            self.assertIs(shared_map_snapshot.get(), before)
+        finally:
+            if shared_map_snapshot._timer is not None:
+                shared_map_snapshot._timer.cancel()
+                shared_map_snapshot._timer = None
+        self.assertEqual(shared_map_snapshot.get().count, 4)
+    
+    def test_favorite_ids(self):
+        FavoritePokemon.objects.create(user=self.user, pokemon=self.pokemon)
+        response = self.client.get('/api/pokemon/favorite_ids/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['ids'], [self.pokemon.id])
+        
+# Delta sync tests
+class DeltaSyncTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='testuser',
+            password='testpass123'
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+        for name in ['Bulbasaur', 'Squirtle', 'Charmander']:
+            Pokemon.objects.create(
+                name=name,
+                latitude=34.0,
+                longitude=-118.0,
+                type_primary='normal',
+                sprite='https://example.com/sprite.png',
+                source='API'
+            )
+    
+    def get_changes(self, since):
+        response = self.client.get(f'/api/pokemon/changes/?since={since}')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data
+    
+    @override_settings(POKEMON_CHANGES_OVERLAP=0)
+    def test_changes_since_cursor(self):
+        changes = self.get_changes(0)
+        self.assertTrue(changes['resync'])
+        self.assertEqual(len(changes['upserts']), 3)
+        self.assertEqual(changes['deletions'], [])
+        cursor = changes['cursor']
+        
+        # nothing happened since
+        changes = self.get_changes(cursor)
+        self.assertEqual(changes['count'], 0)
+        self.assertEqual(changes['cursor'], cursor)
+        
+        squirtle = Pokemon.objects.get(name='Squirtle')
+        squirtle.location_name = 'Cerulean City'
+        squirtle.save()
+        bulbasaur = Pokemon.objects.get(name='Bulbasaur')
+        bulbasaur_id = bulbasaur.id
+        bulbasaur.delete()
+        
+        changes = self.get_changes(cursor)
+        self.assertEqual([pokemon['name'] for pokemon in changes['upserts']], ['Squirtle'])
+        self.assertEqual(changes['upserts'][0]['location_name'], 'Cerulean City')
+        self.assertEqual(changes['deletions'], [bulbasaur_id])
+        self.assertEqual(changes['count'], 2)
+        
+        # bulk uploads show up too
+        cursor = changes['cursor']
+        csv_content = b'Pokemon,Lat,Long,Type,Location,Moves,Sprite\nMew,34.1,-118.9,Psychic,Floaroma Town,"[]",https://example.com/151.png'
+        csv_file = SimpleUploadedFile('test.csv', csv_content, content_type='text/csv')
+        response = self.client.post('/api/pokemon/upload_from_csv/', {'file': csv_file}, format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        changes = self.get_changes(cursor)
+        self.assertEqual([pokemon['name'] for pokemon in changes['upserts']], ['Mew'])
+        self.assertFalse(changes['resync'])
+    
+    def test_late_commits_are_read_again(self):
+        cursor = self.get_changes(0)['cursor']
+        # a write from another worker that commits after the cursor went out, with an older updated_at
+        mew = Pokemon.objects.create(name='Mew', latitude=34.1, longitude=-118.9, sprite='', source='API')
+        Pokemon.objects.filter(pk=mew.pk).update(updated_at=decode_change_cursor(cursor) - timedelta(seconds=5))
+        
+        changes = self.get_changes(cursor)
+        self.assertIn('Mew', [pokemon['name'] for pokemon in changes['upserts']])
+        self.assertGreaterEqual(int(changes['cursor']), int(cursor))
+    
+    def test_recreated_id_is_not_deleted(self):
+        cursor = self.get_changes(0)['cursor']
+        squirtle = Pokemon.objects.get(name='Squirtle')
+        squirtle_id = squirtle.id
+        squirtle.delete()
+        Pokemon.objects.create(id=squirtle_id, name='Wartortle', latitude=34.0, longitude=-118.0, sprite='', source='API')
+        
+        changes = self.get_changes(cursor)
+        self.assertIn(squirtle_id, [pokemon['id'] for pokemon in changes['upserts']])
+        self.assertEqual(changes['deletions'], [])
+    
+    @override_settings(POKEMON_TOMBSTONE_RETENTION=3600)
+    def test_old_cursors_resync_and_tombstones_are_pruned(self):
+        old = PokemonTombstone.objects.create(pokemon_id=999)
+        PokemonTombstone.objects.filter(pk=old.pk).update(deleted_at=timezone.now() - timedelta(hours=2))
+        squirtle = Pokemon.objects.get(name='Squirtle')
+        squirtle_id = squirtle.id
+        squirtle.delete()
+        self.assertEqual(list(PokemonTombstone.objects.values_list('pokemon_id', flat=True)), [squirtle_id])
+        
+        changes = self.get_changes(encode_change_cursor(timezone.now() - timedelta(hours=2)))
+        self.assertTrue(changes['resync'])
+        self.assertEqual(sorted(pokemon['name'] for pokemon in changes['upserts']), ['Bulbasaur', 'Charmander'])
+        self.assertEqual(changes['deletions'], [])
+    
+    def test_changes_rejects_bad_cursor(self):
+        # the last two are past timedelta's and datetime's range
+        for since in ['', 'yesterday', '-5', '99999999999999999999999', '999999999999999999']:
+            response = self.client.get(f'/api/pokemon/changes/?since={since}')
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        
 # WebSocket tests
 class WebSocketTestCase(TestCase):
     def setUp(self):
+        # the weather cache is process-wide, start every test from a miss
+        weather_cache.clear()
         self.user = User.objects.create_user(
             username='testuser',
             password='testpass123'
@@ -381,7 +1002,7 @@ class WebSocketTestCase(TestCase):
         communicator = WebsocketCommunicator(application, f'ws/pokemon/{pokemon_id}/energy/')
         return communicator
     
-    @patch('apps.pokemon.consumers.aiohttp.ClientSession')
+    @patch('apps.pokemon.http_client.aiohttp.ClientSession')
     def test_websocket_connection_success(self, mock_session):
         """Test successful WebSocket connection when Pokemon exists"""
         async def run_test():
@@ -446,8 +1067,8 @@ class WebSocketTestCase(TestCase):
         
         async_to_sync(run_test)()
     
-    @patch('apps.pokemon.consumers.aiohttp.ClientSession')
-    @patch('apps.pokemon.consumers.os.getenv')
+    @patch('apps.pokemon.http_client.aiohttp.ClientSession')
+    @patch('apps.pokemon.energy.os.getenv')
     def test_websocket_energy_update_format(self, mock_getenv, mock_session):
         """Test that energy updates are sent in the correct format"""
         async def run_test():
@@ -478,8 +1099,8 @@ class WebSocketTestCase(TestCase):
         
         async_to_sync(run_test)()
     
-    @patch('apps.pokemon.consumers.aiohttp.ClientSession')
-    @patch('apps.pokemon.consumers.os.getenv')
+    @patch('apps.pokemon.http_client.aiohttp.ClientSession')
+    @patch('apps.pokemon.energy.os.getenv')
     def test_websocket_multiple_energy_updates(self, mock_getenv, mock_session):
         """Test that multiple energy updates are received over time"""
         async def run_test():
@@ -504,7 +1125,7 @@ class WebSocketTestCase(TestCase):
         
         async_to_sync(run_test)()
     
-    @patch('apps.pokemon.consumers.aiohttp.ClientSession')
+    @patch('apps.pokemon.http_client.aiohttp.ClientSession')
     def test_websocket_weather_api_integration(self, mock_session):
         """Test that weather API is called and affects energy calculation"""
         async def run_test():
@@ -524,7 +1145,7 @@ class WebSocketTestCase(TestCase):
             mock_session.return_value.__aexit__ = AsyncMock(return_value=None)
             mock_session.return_value.get.return_value = mock_get
             
-            with patch('apps.pokemon.consumers.os.getenv', return_value='test-api-key'):
+            with patch('apps.pokemon.energy.os.getenv', return_value='test-api-key'):
                 communicator = self.get_communicator(self.pokemon.id)
                 connected, subprotocol = await communicator.connect()
                 
@@ -546,7 +1167,7 @@ class WebSocketTestCase(TestCase):
         
         async_to_sync(run_test)()
     
-    @patch('apps.pokemon.consumers.aiohttp.ClientSession')
+    @patch('apps.pokemon.http_client.aiohttp.ClientSession')
     def test_websocket_connection_disconnect(self, mock_session):
         """Test that WebSocket disconnects properly"""
         async def run_test():
@@ -583,7 +1204,7 @@ class WebSocketTestCase(TestCase):
         
         async_to_sync(run_test)()
     
-    @patch('apps.pokemon.consumers.aiohttp.ClientSession')
+    @patch('apps.pokemon.http_client.aiohttp.ClientSession')
     def test_websocket_energy_with_temperature_modifiers(self, mock_session):
         """Test energy calculation with different temperature conditions"""
         async def run_test():
@@ -603,7 +1224,7 @@ class WebSocketTestCase(TestCase):
             mock_session.return_value.__aexit__ = AsyncMock(return_value=None)
             mock_session.return_value.get.return_value = mock_get
             
-            with patch('apps.pokemon.consumers.os.getenv', return_value='test-api-key'):
+            with patch('apps.pokemon.energy.os.getenv', return_value='test-api-key'):
                 communicator = self.get_communicator(self.pokemon.id)
                 connected, subprotocol = await communicator.connect()
                 
@@ -621,3 +1242,1690 @@ class WebSocketTestCase(TestCase):
         
         async_to_sync(run_test)()
 
+
+
+# Energy feed tests
+class EnergySchedulerTestCase(TestCase):
+    """One energy tick per watched Pokemon, shared by every socket watching it"""
+
+    def setUp(self):
+        self.pokemon = Pokemon.objects.create(name='Pikachu', latitude=34.0522, longitude=-118.2437)
+        self.other = Pokemon.objects.create(name='Bulbasaur', latitude=35.0, longitude=-119.0)
+        self.interval = energy_scheduler.interval
+        energy_scheduler.interval = 0.05
+
+    def tearDown(self):
+        energy_scheduler.interval = self.interval
+
+    def get_communicator(self, pokemon_id):
+        # no history burst, the sockets joining after the first tick would get one first
+        return WebsocketCommunicator(URLRouter(websocket_urlpatterns), f'ws/pokemon/{pokemon_id}/energy/?backfill=0')
+
+    @patch('apps.pokemon.energy.calculate_energy_level')
+    def test_sockets_share_one_tick(self, mock_calculate):
+        mock_calculate.return_value = {'energy_level': 50.0, 'factors': {'weather': 'clear'}}
+
+        async def run_test():
+            communicators = [self.get_communicator(self.pokemon.id) for _ in range(5)]
+            for communicator in communicators:
+                connected, _ = await communicator.connect()
+                self.assertTrue(connected)
+                # the socket is accepted before it joins the group, wait for its first frame
+                response = await communicator.receive_json_from(timeout=1)
+                self.assertEqual(response['energy_level'], 50.0)
+            self.assertEqual(energy_scheduler.watcher_count(self.pokemon.id), 5)
+            self.assertEqual(energy_scheduler.active_pokemon, {self.pokemon.id})
+
+            ticks = mock_calculate.call_count
+            await asyncio.sleep(0.12)
+            # ~2 more ticks for the Pokemon, not 2 per socket
+            self.assertGreaterEqual(mock_calculate.call_count - ticks, 1)
+            self.assertLessEqual(mock_calculate.call_count - ticks, 3)
+            for communicator in communicators:
+                response = await communicator.receive_json_from(timeout=1)
+                self.assertEqual(response['energy_level'], 50.0)
+
+            for communicator in communicators[:4]:
+                await communicator.disconnect()
+            self.assertEqual(energy_scheduler.watcher_count(self.pokemon.id), 1)
+            self.assertEqual(energy_scheduler.active_pokemon, {self.pokemon.id})
+
+            await communicators[4].disconnect()
+            self.assertEqual(energy_scheduler.watcher_count(self.pokemon.id), 0)
+            self.assertEqual(energy_scheduler.active_pokemon, set())
+        async_to_sync(run_test)()
+
+    @patch('apps.pokemon.energy.calculate_energy_level')
+    def test_groups_are_per_pokemon(self, mock_calculate):
+        async def fake_calculate(pokemon):
+            return {'energy_level': float(pokemon.id), 'factors': {}}
+        mock_calculate.side_effect = fake_calculate
+
+        async def run_test():
+            first = self.get_communicator(self.pokemon.id)
+            second = self.get_communicator(self.other.id)
+            await first.connect()
+            await second.connect()
+            self.assertEqual((await first.receive_json_from(timeout=1))['energy_level'], float(self.pokemon.id))
+            self.assertEqual((await second.receive_json_from(timeout=1))['energy_level'], float(self.other.id))
+            self.assertEqual(energy_scheduler.active_pokemon, {self.pokemon.id, self.other.id})
+            self.assertNotEqual(energy_group(self.pokemon.id), energy_group(self.other.id))
+
+            await first.disconnect()
+            await second.disconnect()
+        async_to_sync(run_test)()
+
+    @patch('apps.pokemon.energy.calculate_energy_level')
+    def test_late_joiner_gets_latest_frame(self, mock_calculate):
+        mock_calculate.return_value = {'energy_level': 42.0, 'factors': {}}
+
+        async def run_test():
+            energy_scheduler.interval = 60
+            first = self.get_communicator(self.pokemon.id)
+            await first.connect()
+            await first.receive_json_from(timeout=1)
+
+            # joins mid-interval: served the cached frame instead of waiting for the next tick
+            late = self.get_communicator(self.pokemon.id)
+            await late.connect()
+            self.assertEqual((await late.receive_json_from(timeout=1))['energy_level'], 42.0)
+            self.assertEqual(mock_calculate.call_count, 1)
+
+            await first.disconnect()
+            await late.disconnect()
+        async_to_sync(run_test)()
+
+
+class EnergySubscriptionsTestCase(TestCase):
+    """Multiplexed energy socket: many Pokemon, one connection, batched frames"""
+
+    def setUp(self):
+        self.pokemon_list = [
+            Pokemon.objects.create(name=f'Pokemon {i}', latitude=34.0 + i, longitude=-118.0)
+            for i in range(3)
+        ]
+        self.ids = [pokemon.id for pokemon in self.pokemon_list]
+        self.interval = energy_scheduler.interval
+        energy_scheduler.interval = 0.2
+
+    def tearDown(self):
+        energy_scheduler.interval = self.interval
+
+    def get_communicator(self):
+        return WebsocketCommunicator(URLRouter(websocket_urlpatterns), 'ws/pokemon/energy/')
+
+    @patch('apps.pokemon.energy.calculate_energy_level')
+    def test_subscribe_receives_batched_frames(self, mock_calculate):
+        async def fake_calculate(pokemon):
+            return {'energy_level': float(pokemon.id), 'factors': {}}
+        mock_calculate.side_effect = fake_calculate
+
+        async def run_test():
+            communicator = self.get_communicator()
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+
+            await communicator.send_json_to({'action': 'subscribe', 'ids': self.ids + [99999]})
+            ack = await communicator.receive_json_from(timeout=1)
+            self.assertEqual(ack, {'type': 'subscribed', 'ids': sorted(self.ids), 'unknown': [99999]})
+
+            # the first tick of every Pokemon arrives in one message
+            message = await communicator.receive_json_from(timeout=1)
+            self.assertEqual(message['type'], 'energy')
+            self.assertEqual(set(message['frames']), {str(pokemon_id) for pokemon_id in self.ids})
+            for pokemon_id in self.ids:
+                self.assertEqual(message['frames'][str(pokemon_id)]['energy_level'], float(pokemon_id))
+
+            await communicator.send_json_to({'action': 'unsubscribe', 'ids': self.ids[:2]})
+            ack = await communicator.receive_json_from(timeout=1)
+            self.assertEqual(ack, {'type': 'unsubscribed', 'ids': [self.ids[2]]})
+            self.assertEqual(energy_scheduler.active_pokemon, {self.ids[2]})
+
+            message = await communicator.receive_json_from(timeout=1)
+            self.assertEqual(set(message['frames']), {str(self.ids[2])})
+
+            await communicator.disconnect()
+            self.assertEqual(energy_scheduler.active_pokemon, set())
+
+        # the subscribe batch is validated with a single query
+        with CaptureQueriesContext(connection) as queries:
+            async_to_sync(run_test)()
+        self.assertEqual(len(queries), 1)
+
+    def test_invalid_messages(self):
+        async def run_test():
+            communicator = self.get_communicator()
+            await communicator.connect()
+
+            await communicator.send_to(text_data='not json')
+            self.assertEqual((await communicator.receive_json_from(timeout=1))['type'], 'error')
+            await communicator.send_json_to({'action': 'watch', 'ids': [1]})
+            self.assertEqual((await communicator.receive_json_from(timeout=1))['type'], 'error')
+            await communicator.send_json_to({'action': 'subscribe', 'ids': ['abc']})
+            self.assertEqual((await communicator.receive_json_from(timeout=1))['type'], 'error')
+
+            # ids SQLite can't bind are unknown, not a crash
+            await communicator.send_json_to({'action': 'subscribe', 'ids': [2 ** 70, -2 ** 64]})
+            self.assertEqual(await communicator.receive_json_from(timeout=1), {
+                'type': 'subscribed', 'ids': [], 'unknown': [-2 ** 64, 2 ** 70],
+            })
+            self.assertTrue(await communicator.receive_nothing(timeout=0.05))
+
+            await communicator.disconnect()
+
+            # same for the single Pokemon socket
+            communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), f'ws/pokemon/{2 ** 70}/energy/')
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            self.assertEqual((await communicator.receive_output(timeout=1))['code'], 4004)
+        async_to_sync(run_test)()
+
+    @override_settings(POKEMON_ENERGY_MAX_SUBSCRIPTIONS=2)
+    def test_subscription_limit(self):
+        async def run_test():
+            communicator = self.get_communicator()
+            await communicator.connect()
+
+            await communicator.send_json_to({'action': 'subscribe', 'ids': self.ids})
+            response = await communicator.receive_json_from(timeout=1)
+            self.assertEqual(response['type'], 'error')
+            self.assertEqual(energy_scheduler.active_pokemon, set())
+
+            await communicator.disconnect()
+        async_to_sync(run_test)()
+
+
+class EnergyDeliveryTestCase(TestCase):
+    """Outbound queue limits, change-only frames and overload degradation"""
+
+    def test_slow_reader_keeps_only_newest_frames(self):
+        async def run_test():
+            sent = []
+
+            async def slow_send(text_data):
+                await asyncio.sleep(0.05)
+                sent.append(text_data)
+
+            queue = FrameQueue(slow_send, lambda pending: ','.join(pending.values()), maxsize=2)
+            for tick in range(10):
+                queue.put(1, f'a{tick}')
+                queue.put(2, f'b{tick}')
+                queue.put(3, f'c{tick}')
+                await asyncio.sleep(0)
+            await asyncio.sleep(0.2)
+            await queue.close()
+
+            # the first frame went out immediately, after that only the newest two waited
+            self.assertEqual(sent[-1], 'b9,c9')
+            self.assertLessEqual(len(sent), 3)
+            self.assertGreater(queue.dropped, 20)
+        async_to_sync(run_test)()
+
+    def test_ack_window_holds_the_sender(self):
+        async def run_test():
+            sent = []
+
+            async def send(text_data):
+                # never blocks, like daphne writing into the Twisted transport
+                sent.append(text_data)
+
+            queue = FrameQueue(send, lambda pending: ','.join(pending.values()), max_in_flight=2)
+            for tick in range(10):
+                queue.put(1, f'a{tick}')
+                await asyncio.sleep(0)
+            await asyncio.sleep(0.01)
+            self.assertEqual(sent, ['a0', 'a1'])
+            self.assertTrue(queue.held_back())
+
+            queue.ack()
+            await asyncio.sleep(0.01)
+            self.assertEqual(sent, ['a0', 'a1', 'a9'])
+            queue.ack(5)
+            self.assertEqual(queue.in_flight, 0)
+            await queue.close()
+        async_to_sync(run_test)()
+
+    def test_failed_send_stops_the_queue(self):
+        async def run_test():
+            async def send(text_data):
+                raise ConnectionResetError('gone')
+
+            queue = FrameQueue(send, lambda pending: ','.join(pending.values()))
+            queue.put(1, 'a')
+            await asyncio.sleep(0.01)
+            self.assertTrue(queue.stopped)
+            # nothing piles up behind the dead sender
+            queue.put(1, 'b')
+            self.assertEqual(queue._pending, {})
+            await queue.close()
+        async_to_sync(run_test)()
+
+    def test_heartbeat_does_not_replace_a_waiting_frame(self):
+        async def run_test():
+            sent = []
+
+            async def send(text_data):
+                sent.append(text_data)
+
+            consumer = PokemonEnergyConsumer()
+            consumer.binary = False
+            consumer.policy = SendPolicy(changed_only=True, threshold=5, heartbeat=0)
+            consumer.frames = FrameQueue(send, consumer.render_frame, max_in_flight=1)
+
+            def event(level):
+                return {'pokemon_id': 1, 'energy_level': level, 'factors': {}, 'text': f'frame {level}'}
+            await consumer.energy_update(event(50))
+            await asyncio.sleep(0.01)
+            await consumer.energy_update(event(60))
+            # too small a change, so a heartbeat is due instead
+            await consumer.energy_update(event(61))
+            consumer.frames.ack()
+            await asyncio.sleep(0.01)
+            self.assertEqual(sent, ['frame 50', 'frame 60'])
+            await consumer.frames.close()
+        async_to_sync(run_test)()
+
+    @override_settings(POKEMON_ENERGY_ACK_WINDOW=4)
+    @patch('apps.pokemon.energy.calculate_energy_level')
+    def test_reader_that_stops_reading(self, mock_calculate):
+        ticks = iter(range(1000))
+
+        async def fake_calculate(pokemon):
+            return {'energy_level': float(next(ticks)), 'factors': {}}
+        mock_calculate.side_effect = fake_calculate
+        pokemon = Pokemon.objects.create(name='Pikachu', latitude=34.0522, longitude=-118.2437)
+        clock = VirtualClock()
+        scheduler = EnergyScheduler(interval=5.0, clock=clock, sleep=clock.sleep, name='unread')
+        router = URLRouter([
+            re_path(r'ws/pokemon/(?P<pokemon_id>\d+)/energy/$', PokemonEnergyConsumer.as_asgi(scheduler=scheduler)),
+            re_path(r'ws/pokemon/energy/$', EnergySubscriptionsConsumer.as_asgi(scheduler=scheduler)),
+        ])
+
+        async def drain(communicator):
+            messages = []
+            while not await communicator.receive_nothing(timeout=0.05):
+                messages.append(await communicator.receive_json_from())
+            return messages
+
+        async def run_test():
+            # the test transport never blocks send(), as under daphne: whatever is sent piles up unread
+            default = WebsocketCommunicator(router, f'ws/pokemon/{pokemon.id}/energy/?backfill=0')
+            bounded = WebsocketCommunicator(router, f'ws/pokemon/{pokemon.id}/energy/?backfill=0&ack=2')
+            multiplexed = WebsocketCommunicator(router, 'ws/pokemon/energy/?backfill=0&ack=1')
+            for communicator in (default, bounded, multiplexed):
+                await communicator.connect()
+            await multiplexed.send_json_to({'action': 'subscribe', 'ids': [pokemon.id]})
+            self.assertEqual((await multiplexed.receive_json_from(timeout=1))['type'], 'subscribed')
+            for _ in range(20):
+                await clock.advance(5.0)
+
+            # bounded by POKEMON_ENERGY_ACK_WINDOW unless the client asks for another window
+            self.assertEqual([message['energy_level'] for message in await drain(default)], [0.0, 1.0, 2.0, 3.0])
+            self.assertEqual([message['energy_level'] for message in await drain(bounded)], [0.0, 1.0])
+            # the batch window may have folded every tick into that one message
+            self.assertEqual(len(await drain(multiplexed)), 1)
+            await clock.advance(5.0)
+            self.assertEqual(await drain(multiplexed), [])
+
+            # catching up gets the newest frame only
+            await bounded.send_json_to({'action': 'ack', 'count': 2})
+            self.assertEqual([message['energy_level'] for message in await drain(bounded)], [21.0])
+            await multiplexed.send_json_to({'action': 'ack'})
+            self.assertEqual(await drain(multiplexed), [{'type': 'energy', 'frames': {str(pokemon.id): ANY}}])
+
+            for communicator in (default, bounded, multiplexed):
+                await communicator.disconnect()
+        async_to_sync(run_test)()
+
+    def test_changed_only_policy(self):
+        now = [0.0]
+        policy = SendPolicy(changed_only=True, threshold=5, heartbeat=30, clock=lambda: now[0])
+        factors = {'weather': 'clear sky'}
+
+        def event(level, factors=factors, pokemon_id=1):
+            return {'pokemon_id': pokemon_id, 'energy_level': level, 'factors': factors}
+
+        self.assertTrue(policy.wants(event(50)))
+        self.assertFalse(policy.wants(event(53)))
+        self.assertTrue(policy.wants(event(56)))
+        self.assertTrue(policy.wants(event(56, factors={'weather': 'light rain'})))
+        # tracked per Pokemon
+        self.assertTrue(policy.wants(event(56, pokemon_id=2)))
+        # error frames always go out
+        self.assertTrue(policy.wants({'pokemon_id': 1, 'text': '{"error": "boom"}'}))
+
+        self.assertFalse(policy.heartbeat_due())
+        now[0] += 31
+        self.assertTrue(policy.heartbeat_due())
+        self.assertFalse(policy.heartbeat_due())
+
+        self.assertTrue(SendPolicy().wants(event(50)))
+        self.assertTrue(SendPolicy().wants(event(50)))
+
+    def test_policy_from_query_string(self):
+        policy = SendPolicy.from_scope({'query_string': b'changed_only=1&threshold=7.5'})
+        self.assertTrue(policy.changed_only)
+        self.assertEqual(policy.threshold, 7.5)
+        self.assertFalse(SendPolicy.from_scope({'query_string': b''}).changed_only)
+
+    @override_settings(POKEMON_ENERGY_MAX_CONNECTIONS=2)
+    def test_interval_degrades_past_connection_cap(self):
+        connections = energy_scheduler.connections
+        try:
+            energy_scheduler.connections = 2
+            self.assertEqual(energy_scheduler.effective_interval(), energy_scheduler.interval)
+            energy_scheduler.connections = 5
+            self.assertEqual(energy_scheduler.effective_interval(), energy_scheduler.interval * 2.5)
+        finally:
+            energy_scheduler.connections = connections
+
+    @override_settings(POKEMON_ENERGY_HEARTBEAT=0.15)
+    @patch('apps.pokemon.energy.calculate_energy_level')
+    def test_changed_only_socket_gets_heartbeats(self, mock_calculate):
+        mock_calculate.return_value = {'energy_level': 50.0, 'factors': {'weather': 'clear'}}
+        pokemon = Pokemon.objects.create(name='Pikachu', latitude=34.0522, longitude=-118.2437)
+        interval = energy_scheduler.interval
+        energy_scheduler.interval = 0.05
+
+        async def run_test():
+            communicator = WebsocketCommunicator(
+                URLRouter(websocket_urlpatterns), f'ws/pokemon/{pokemon.id}/energy/?changed_only=1'
+            )
+            await communicator.connect()
+            self.assertEqual((await communicator.receive_json_from(timeout=1))['energy_level'], 50.0)
+            self.assertEqual(energy_scheduler.connections, 1)
+
+            # nothing moved: a heartbeat instead of a frame every tick
+            message = await communicator.receive_json_from(timeout=1)
+            self.assertEqual(message['type'], 'heartbeat')
+            self.assertGreaterEqual(mock_calculate.call_count, 3)
+
+            await communicator.disconnect()
+            self.assertEqual(energy_scheduler.connections, 0)
+
+        try:
+            async_to_sync(run_test)()
+        finally:
+            energy_scheduler.interval = interval
+
+
+class EnergyBinaryFramesTestCase(TestCase):
+    """Binary energy subprotocol: codec and negotiation"""
+
+    def make_event(self, pokemon_id=25, energy_level=87.654, weather='light rain', temperature=12.3):
+        factors = {
+            'weather': weather, 'temperature': temperature, 'near_route': True,
+            'weather_modifier': -20, 'temp_modifier': 0, 'location_modifier': 0,
+        }
+        event = {
+            'type': 'energy.update', 'pokemon_id': pokemon_id, 'timestamp': time.time(),
+            'energy_level': energy_level, 'factors': factors,
+        }
+        event['text'] = json.dumps({'energy_level': energy_level, 'timestamp': 'now', 'factors': factors})
+        return event
+
+    def test_round_trip(self):
+        event = self.make_event()
+        record = pack_energy_record(event)
+        frame = unpack_frame(record)
+        self.assertEqual(frame['pokemon_id'], 25)
+        self.assertAlmostEqual(frame['energy_level'], 87.65)
+        self.assertAlmostEqual(frame['timestamp'], event['timestamp'], delta=0.01)
+        self.assertEqual(frame['factors']['weather'], 'light rain')
+        self.assertAlmostEqual(frame['factors']['temperature'], 12.3)
+        self.assertEqual(frame['factors']['weather_modifier'], -20)
+        self.assertTrue(frame['factors']['near_route'])
+        # a fraction of the JSON frame
+        self.assertEqual(len(record), 26)
+        self.assertLess(len(record) * 5, len(event['text']))
+
+        # descriptions outside the code table travel as text, missing temperatures survive
+        frame = unpack_frame(pack_energy_record(self.make_event(weather='volcanic ash', temperature=None)))
+        self.assertEqual(frame['factors']['weather'], 'volcanic ash')
+        self.assertIsNone(frame['factors']['temperature'])
+
+        error = unpack_frame(pack_energy_record({'pokemon_id': 3, 'text': json.dumps({'error': 'boom'})}))
+        self.assertEqual(error, {'type': 'error', 'pokemon_id': 3, 'error': 'boom'})
+        self.assertEqual(unpack_frame(pack_heartbeat())['type'], 'heartbeat')
+
+        batch = unpack_frame(pack_batch([pack_energy_record(self.make_event(pokemon_id=i)) for i in range(3)]))
+        self.assertEqual([frame['pokemon_id'] for frame in batch['frames']], [0, 1, 2])
+
+    def test_wide_ids_and_multibyte_weather(self):
+        # any id the database can hold, not only 32-bit ones
+        for pokemon_id in (2 ** 32, 2 ** 63 - 1, -5):
+            self.assertEqual(unpack_frame(pack_energy_record(self.make_event(pokemon_id=pokemon_id)))['pokemon_id'], pokemon_id)
+            error = {'pokemon_id': pokemon_id, 'text': json.dumps({'error': 'boom'})}
+            self.assertEqual(unpack_frame(pack_energy_record(error))['pokemon_id'], pokemon_id)
+
+        frame = unpack_frame(pack_energy_record(self.make_event(weather='brouillard givrant ❄')))
+        self.assertEqual(frame['factors']['weather'], 'brouillard givrant ❄')
+        # 255 bytes would end inside a 3-byte character, which is dropped rather than cut
+        frame = unpack_frame(pack_energy_record(self.make_event(weather='a' + '雪' * 100)))
+        self.assertEqual(frame['factors']['weather'], 'a' + '雪' * 84)
+
+        # timestamps still round-trip after the 497 days a 32-bit field would last
+        event = self.make_event()
+        event['timestamp'] += 600 * 86400
+        self.assertAlmostEqual(unpack_frame(pack_energy_record(event))['timestamp'], event['timestamp'], delta=0.01)
+
+    @patch('apps.pokemon.energy.calculate_energy_level')
+    def test_negotiated_binary_socket(self, mock_calculate):
+        mock_calculate.return_value = {'energy_level': 50.0, 'factors': {
+            'weather': 'clear', 'temperature': None, 'near_route': False,
+            'weather_modifier': 0, 'temp_modifier': 0, 'location_modifier': -15,
+        }}
+        pokemon = Pokemon.objects.create(name='Pikachu', latitude=34.0522, longitude=-118.2437)
+
+        async def run_test():
+            communicator = WebsocketCommunicator(
+                URLRouter(websocket_urlpatterns), f'ws/pokemon/{pokemon.id}/energy/', subprotocols=[BINARY_SUBPROTOCOL]
+            )
+            connected, subprotocol = await communicator.connect()
+            self.assertTrue(connected)
+            self.assertEqual(subprotocol, BINARY_SUBPROTOCOL)
+
+            hello = unpack_frame(await communicator.receive_from(timeout=1))
+            self.assertEqual(hello['type'], 'hello')
+            frame = unpack_frame(await communicator.receive_from(timeout=1), hello['epoch'])
+            self.assertEqual(frame['pokemon_id'], pokemon.id)
+            self.assertEqual(frame['energy_level'], 50.0)
+            self.assertEqual(frame['factors']['location_modifier'], -15)
+            await communicator.disconnect()
+
+            # without the subprotocol nothing changes
+            communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), f'ws/pokemon/{pokemon.id}/energy/?backfill=0')
+            connected, subprotocol = await communicator.connect()
+            self.assertIsNone(subprotocol)
+            self.assertEqual((await communicator.receive_json_from(timeout=1))['energy_level'], 50.0)
+            await communicator.disconnect()
+        async_to_sync(run_test)()
+
+    @patch('apps.pokemon.energy.calculate_energy_level')
+    def test_multiplexed_binary_batches(self, mock_calculate):
+        async def fake_calculate(pokemon):
+            return {'energy_level': float(pokemon.id), 'factors': {'weather': 'snow', 'temperature': -3.0}}
+        mock_calculate.side_effect = fake_calculate
+        ids = [Pokemon.objects.create(name=f'Pokemon {i}', latitude=34.0, longitude=-118.0).id for i in range(3)]
+
+        async def run_test():
+            communicator = WebsocketCommunicator(
+                URLRouter(websocket_urlpatterns), 'ws/pokemon/energy/', subprotocols=[BINARY_SUBPROTOCOL]
+            )
+            await communicator.connect()
+            self.assertEqual(unpack_frame(await communicator.receive_from(timeout=1))['type'], 'hello')
+
+            await communicator.send_json_to({'action': 'subscribe', 'ids': ids})
+            self.assertEqual((await communicator.receive_json_from(timeout=1))['type'], 'subscribed')
+            batch = unpack_frame(await communicator.receive_from(timeout=1))
+            self.assertEqual(batch['type'], 'batch')
+            self.assertEqual(sorted(frame['pokemon_id'] for frame in batch['frames']), ids)
+            self.assertEqual(batch['frames'][0]['factors']['weather'], 'snow')
+            await communicator.disconnect()
+        async_to_sync(run_test)()
+
+
+# Channel layer tests
+class SQLiteChannelLayerTestCase(TestCase):
+    """Two layer instances on one file stand in for two worker processes"""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'layer.sqlite3')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def run_layers(self, test, **config):
+        async def run_test():
+            layers = [SQLiteChannelLayer(self.path, **config) for _ in range(2)]
+            try:
+                await test(*layers)
+            finally:
+                for layer in layers:
+                    await layer.close()
+        async_to_sync(run_test)()
+
+    def test_group_send_reaches_both_processes(self):
+        async def test(first, second):
+            first_channel = await first.new_channel()
+            second_channel = await second.new_channel()
+            await first.group_add('pokemon_map', first_channel)
+            await second.group_add('pokemon_map', second_channel)
+
+            await first.group_send('pokemon_map', {'type': 'map.changes', 'text': '{}'})
+            self.assertEqual(await asyncio.wait_for(first.receive(first_channel), 1), {'type': 'map.changes', 'text': '{}'})
+            self.assertEqual(await asyncio.wait_for(second.receive(second_channel), 1), {'type': 'map.changes', 'text': '{}'})
+
+            await second.group_discard('pokemon_map', second_channel)
+            await first.group_send('pokemon_map', {'type': 'map.changes', 'text': '[]'})
+            self.assertEqual((await asyncio.wait_for(first.receive(first_channel), 1))['text'], '[]')
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(second.receive(second_channel), 0.2)
+        self.run_layers(test)
+
+    def test_send_to_general_channel(self):
+        async def test(first, second):
+            await first.send('energy-worker', {'type': 'tick', 'n': 1})
+            await first.send('energy-worker', {'type': 'tick', 'n': 2})
+            self.assertEqual((await asyncio.wait_for(second.receive('energy-worker'), 1))['n'], 1)
+            self.assertEqual((await asyncio.wait_for(second.receive('energy-worker'), 1))['n'], 2)
+        self.run_layers(test)
+
+    def test_capacity(self):
+        async def test(first, second):
+            await first.send('energy-worker', {'type': 'tick'})
+            await first.send('energy-worker', {'type': 'tick'})
+            with self.assertRaises(ChannelFull):
+                await first.send('energy-worker', {'type': 'tick'})
+
+            # group_send skips full channels instead of failing
+            channel = await second.new_channel()
+            await second.group_add('pokemon_map', channel)
+            await second.group_add('pokemon_map', 'energy-worker')
+            await first.group_send('pokemon_map', {'type': 'map.changes'})
+            self.assertEqual(await asyncio.wait_for(second.receive(channel), 1), {'type': 'map.changes'})
+        self.run_layers(test, capacity=2)
+
+    def test_expired_messages_leave_groups(self):
+        async def test(first, second):
+            await first.group_add('pokemon_map', 'energy-worker')
+            await first.send('energy-worker', {'type': 'tick'})
+            await asyncio.sleep(0.1)
+            first._last_cleanup = 0
+            await first._maybe_cleanup()
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(second.receive('energy-worker'), 0.2)
+            self.assertEqual(await first._run(first._group_channels, 'pokemon_map', time.time()), [])
+        self.run_layers(test, expiry=0.05)
+
+    def test_abandoned_queues_are_dropped(self):
+        async def test(first, second):
+            channels = [await first.new_channel() for _ in range(20)]
+            await first.group_add('pokemon_map', channels[0])
+            # consumers that connected and went away, one with a message still waiting for it
+            for channel in channels:
+                with self.assertRaises(asyncio.TimeoutError):
+                    await asyncio.wait_for(first.receive(channel), 0.01)
+            await second.group_send('pokemon_map', {'type': 'map.changes'})
+            await asyncio.sleep(0.1)
+            self.assertEqual(len(first._queues), 20)
+
+            await asyncio.sleep(0.2)
+            first._last_cleanup = 0
+            await first._maybe_cleanup()
+            self.assertEqual(first._queues, {})
+
+            # a channel someone is receiving on keeps its queue however long it waits
+            waiting = asyncio.ensure_future(first.receive(channels[1]))
+            await asyncio.sleep(0.3)
+            first._last_cleanup = 0
+            await first._maybe_cleanup()
+            self.assertIn(channels[1], first._queues)
+            await second.send(channels[1], {'type': 'late'})
+            self.assertEqual(await asyncio.wait_for(waiting, 1), {'type': 'late'})
+        self.run_layers(test, expiry=0.2)
+
+    @patch('apps.pokemon.energy.calculate_energy_level')
+    def test_ticks_stay_in_their_process(self, mock_calculate):
+        mock_calculate.return_value = {'energy_level': 50.0, 'factors': {}}
+        pokemon = Pokemon.objects.create(name='Pikachu', latitude=34.0522, longitude=-118.2437)
+
+        async def test(first, second):
+            # the same Pokemon watched in two workers, one ticking far more often
+            slow = EnergyScheduler(interval=60)
+            fast = EnergyScheduler(interval=0.05)
+            slow_channel = await first.new_channel()
+            fast_channel = await second.new_channel()
+            await slow.watch(pokemon, first, slow_channel)
+            await fast.watch(pokemon, second, fast_channel)
+            self.assertNotEqual(slow.group(pokemon.id), fast.group(pokemon.id))
+
+            await asyncio.sleep(0.5)
+            await slow.unwatch(pokemon.id, first, slow_channel)
+            await fast.unwatch(pokemon.id, second, fast_channel)
+            received = {slow_channel: 0, fast_channel: 0}
+            for layer, channel in ((first, slow_channel), (second, fast_channel)):
+                try:
+                    while True:
+                        await asyncio.wait_for(layer.receive(channel), 0.1)
+                        received[channel] += 1
+                except asyncio.TimeoutError:
+                    pass
+            # one frame per tick of its own worker only
+            self.assertEqual(received[slow_channel], 1)
+            self.assertGreater(received[fast_channel], 3)
+        self.run_layers(test)
+
+    def test_invalidations_reach_other_processes(self):
+        pokemon = Pokemon.objects.create(name='Pikachu', latitude=34.0522, longitude=-118.2437)
+
+        async def test(first, second):
+            writer = CacheInvalidator(channel_layer=first)
+            reader = CacheInvalidator(channel_layer=second)
+            reader.ensure_running()
+            # stands in for the reader's worker: a cached state, history and snapshot
+            await pokemon_states.get(pokemon.id)
+            energy_history.record(pokemon.id, time.time(), 50.0)
+            generation = shared_map_snapshot._generation
+            await asyncio.sleep(0.1)
+
+            await writer.send([pokemon.id], forget_history=[pokemon.id])
+            for _ in range(100):
+                if reader.received:
+                    break
+                await asyncio.sleep(0.01)
+            self.assertEqual(reader.received, 1)
+            self.assertIsNone(pokemon_states.peek(pokemon.id))
+            self.assertEqual(len(energy_history.readings(pokemon.id)[0]), 0)
+            self.assertGreater(shared_map_snapshot._generation, generation)
+
+            # a process ignores its own messages, its caches were invalidated locally
+            await reader.send([pokemon.id])
+            await asyncio.sleep(0.1)
+            self.assertEqual(reader.received, 1)
+            await reader.stop()
+        try:
+            self.run_layers(test)
+        finally:
+            pokemon_states.clear()
+            energy_history.clear()
+
+    def test_committed_writes_are_published(self):
+        with patch.object(cache_invalidator, 'publish') as publish:
+            with self.captureOnCommitCallbacks(execute=True):
+                pokemon = Pokemon.objects.create(name='Pikachu', latitude=34.0522, longitude=-118.2437)
+            publish.assert_called_once_with([pokemon.id], [pokemon.id])
+            with self.captureOnCommitCallbacks(execute=True):
+                pokemon.latitude = 35.0
+                pokemon.save()
+            publish.assert_called_with([pokemon.id], [])
+
+    def test_a_transaction_publishes_once(self):
+        with patch.object(cache_invalidator, 'publish') as publish:
+            with self.captureOnCommitCallbacks(execute=True):
+                mew, eevee, ditto = (Pokemon.objects.create(name=name, latitude=34.0, longitude=-118.0) for name in ('Mew', 'Eevee', 'Ditto'))
+                ids = sorted([mew.id, eevee.id, ditto.id])
+                mew.latitude = 35.0
+                mew.save()
+                eevee.delete()
+            # one message for everything the transaction wrote
+            publish.assert_called_once_with(ids, ids)
+
+
+# Weather cache and outbound HTTP tests
+class WeatherCacheTestCase(TestCase):
+    """Shared weather cache against a local fake OpenWeatherMap server"""
+
+    def run_with_server(self, test, **server_options):
+        async def run_test():
+            server = await FakeWeatherServer(**server_options).start()
+            try:
+                with override_settings(OPENWEATHER_API_URL=server.url, POKEMON_WEATHER_TTL=300, POKEMON_WEATHER_MAX_STALE=1800):
+                    await test(server)
+            finally:
+                await client_sessions.close_all()
+                await server.stop()
+        async_to_sync(run_test)()
+
+    def test_concurrent_misses_share_one_fetch(self):
+        async def test(server):
+            server.delay = 0.05
+            cache = WeatherCache()
+            # 50 Pokemon in the same ~11 km cell
+            results = await asyncio.gather(*[
+                cache.get(34.05 + i * 0.0001, -118.24, 'key') for i in range(50)
+            ])
+            self.assertEqual(server.requests, 1)
+            self.assertEqual(cache.upstream_calls, 1)
+            self.assertTrue(all(result == {'description': 'clear sky', 'temperature': 20.0} for result in results))
+
+            # served from cache afterwards
+            await cache.get(34.05, -118.24, 'key')
+            self.assertEqual(server.requests, 1)
+        self.run_with_server(test)
+
+    def test_different_cells_fetch_separately(self):
+        async def test(server):
+            cache = WeatherCache()
+            await asyncio.gather(
+                cache.get(34.05, -118.24, 'key'),
+                cache.get(40.71, -74.00, 'key'),
+            )
+            self.assertEqual(server.requests, 2)
+        self.run_with_server(test)
+
+    def test_stale_entry_served_while_refreshing(self):
+        async def test(server):
+            now = [1000.0]
+            cache = WeatherCache(clock=lambda: now[0])
+            await cache.get(34.05, -118.24, 'key')
+
+            server.description = 'light rain'
+            now[0] += 301  # past the TTL, within max stale
+            result = await cache.get(34.05, -118.24, 'key')
+            # the caller does not wait for the refresh
+            self.assertEqual(result['description'], 'clear sky')
+
+            await asyncio.sleep(0.1)
+            self.assertEqual(server.requests, 2)
+            result = await cache.get(34.05, -118.24, 'key')
+            self.assertEqual(result['description'], 'light rain')
+
+            # too old to serve: the caller waits for a fresh value
+            server.description = 'snow'
+            now[0] += 2000
+            result = await cache.get(34.05, -118.24, 'key')
+            self.assertEqual(result['description'], 'snow')
+        self.run_with_server(test)
+
+    def test_failures_are_not_cached(self):
+        async def test(server):
+            server.status = 500
+            cache = WeatherCache()
+            self.assertIsNone(await cache.get(34.05, -118.24, 'key'))
+
+            server.status = 200
+            result = await cache.get(34.05, -118.24, 'key')
+            self.assertEqual(result['description'], 'clear sky')
+            self.assertEqual(server.requests, 2)
+        self.run_with_server(test)
+
+    def test_fetches_reuse_pooled_connection(self):
+        async def test(server):
+            self.assertIs(get_client_session(), get_client_session())
+            for i in range(20):
+                # a different cell every time, so each one goes upstream
+                await WeatherCache().get(10 + i, 10, 'key')
+            self.assertEqual(server.requests, 20)
+            self.assertEqual(len(server.peers), 1)
+        self.run_with_server(test)
+
+    def test_lifespan_shutdown_closes_sessions(self):
+        async def run_test():
+            session = get_client_session()
+            messages = asyncio.Queue()
+            sent = []
+            await messages.put({'type': 'lifespan.startup'})
+            await messages.put({'type': 'lifespan.shutdown'})
+
+            async def send(message):
+                sent.append(message['type'])
+
+            await LifespanApp()({'type': 'lifespan'}, messages.get, send)
+            self.assertEqual(sent, ['lifespan.startup.complete', 'lifespan.shutdown.complete'])
+            self.assertTrue(session.closed)
+            self.assertIsNot(get_client_session(), session)
+            await client_sessions.close_all()
+        async_to_sync(run_test)()
+
+    def test_daphne_shutdown_closes_sessions(self):
+        # daphne sends no lifespan events, the shutdown hooks have to run on SIGTERM anyway
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            port = sock.getsockname()[1]
+        process = subprocess.Popen(
+            [sys.executable, '-m', 'daphne', '-b', '127.0.0.1', '-p', str(port), 'pokemon_api.asgi:application'],
+            cwd=settings.BASE_DIR, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True,
+        )
+        try:
+            deadline = time.monotonic() + 30
+            while True:
+                try:
+                    urllib.request.urlopen(f'http://127.0.0.1:{port}/api/pokemon/', timeout=1)
+                except urllib.error.HTTPError:
+                    # 401, the request went through the app
+                    break
+                except OSError:
+                    self.assertIsNone(process.poll())
+                    self.assertLess(time.monotonic(), deadline)
+                    time.sleep(0.2)
+            process.send_signal(signal.SIGTERM)
+            output, _ = process.communicate(timeout=15)
+        finally:
+            process.kill()
+        self.assertIn('Closed the outbound HTTP sessions and route proximity workers', output)
+
+    @override_settings(POKEMON_WEATHER_PREFETCH_RATE=2, POKEMON_WEATHER_PREFETCH_LEAD=60, POKEMON_WEATHER_PREFETCH_RESCAN=300)
+    def test_prefetcher_refreshes_hottest_cells_within_budget(self):
+        # placed Pokemon: 5 in one cell, 2 in another, 1 in a third
+        for latitude, count in [(10.05, 5), (20.05, 2), (30.05, 1)]:
+            for i in range(count):
+                Pokemon.objects.create(name=f'Placed {latitude} {i}', latitude=latitude, longitude=10.05)
+        # one socket watching a Pokemon elsewhere outranks them all
+        watched = Pokemon(name='Watched', latitude=40.05, longitude=10.05)
+
+        async def test(server):
+            now = [1000.0]
+            clock = lambda: now[0]
+            cache = WeatherCache(clock=clock)
+            scheduler = Mock(watched_pokemon=lambda: [(watched, 1)])
+            prefetcher = WeatherPrefetcher(cache=cache, scheduler=scheduler, clock=clock)
+
+            with patch('apps.pokemon.prefetch.os.getenv', return_value='key'):
+                fetched = await prefetcher.run_once()
+                self.assertEqual(fetched, [(400, 100), (100, 100)])
+                self.assertEqual(server.requests, 2)
+
+                # budget spent
+                self.assertEqual(await prefetcher.run_once(), [])
+
+                # 30 s refill one call of the 2/min budget
+                now[0] += 30
+                self.assertEqual(await prefetcher.run_once(), [(200, 100)])
+
+                # a lazy miss is charged to the same budget
+                now[0] += 30
+                await cache.get(50.05, 10.05, 'key')
+                self.assertEqual(await prefetcher.run_once(), [])
+
+                # warm cells come back due once they are within the lead of the TTL
+                now[0] += 300 - 60 - 60
+                fetched = await prefetcher.run_once()
+                self.assertEqual(fetched, [(400, 100), (100, 100)])
+                self.assertLessEqual(server.requests, 2 + 1 + 1 + 2)
+        self.run_with_server(test)
+
+    def test_circuit_breaker_states(self):
+        now = [0.0]
+        breaker = CircuitBreaker(failure_threshold=3, reset_timeout=30, clock=lambda: now[0])
+        for _ in range(2):
+            self.assertTrue(breaker.allow())
+            breaker.record_failure()
+        self.assertEqual(breaker.state, 'closed')
+        breaker.record_failure()
+        self.assertEqual(breaker.state, 'open')
+        self.assertFalse(breaker.allow())
+
+        # half-open lets exactly one probe through
+        now[0] += 30
+        self.assertEqual(breaker.state, 'half_open')
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.record_failure()
+        self.assertEqual(breaker.state, 'open')
+
+        now[0] += 30
+        self.assertTrue(breaker.allow())
+        breaker.record_success()
+        self.assertEqual(breaker.state, 'closed')
+        self.assertEqual(breaker.snapshot(), {'state': 'closed', 'consecutive_failures': 0, 'times_opened': 2})
+
+    @override_settings(POKEMON_WEATHER_BREAKER_FAILURES=3, POKEMON_WEATHER_BREAKER_RESET=30)
+    def test_open_breaker_skips_upstream_and_serves_last_known(self):
+        async def test(server):
+            now = [1000.0]
+            cache = WeatherCache(clock=lambda: now[0])
+            await cache.get(34.05, -118.24, 'key')
+
+            server.status = 503
+            now[0] += 5000  # past max stale
+            for i in range(3):
+                self.assertIsNone(await cache.get(10 + i, 10, 'key'))
+            self.assertEqual(cache.breaker.state, 'open')
+            requests = server.requests
+
+            # upstream is skipped, the known cell is served whatever its age
+            result = await cache.get(34.05, -118.24, 'key')
+            self.assertEqual(result['description'], 'clear sky')
+            self.assertIsNone(await cache.get(50, 50, 'key'))
+            self.assertEqual(server.requests, requests)
+            self.assertEqual(cache.metrics()['short_circuited'], 2)
+
+            # half-open probe succeeds and closes the breaker
+            server.status = 200
+            server.description = 'light rain'
+            now[0] += 30
+            result = await cache.get(34.05, -118.24, 'key')
+            self.assertEqual(result['description'], 'light rain')
+            self.assertEqual(cache.breaker.state, 'closed')
+            self.assertEqual(server.requests, requests + 1)
+        self.run_with_server(test)
+
+    @override_settings(POKEMON_WEATHER_DEADLINE=0.05)
+    def test_deadline_bounds_the_wait(self):
+        async def test(server):
+            server.delay = 0.3
+            cache = WeatherCache()
+            started = time.monotonic()
+            self.assertIsNone(await cache.get(34.05, -118.24, 'key'))
+            self.assertLess(time.monotonic() - started, 0.25)
+            self.assertEqual(cache.metrics()['deadline_exceeded'], 1)
+
+            # the fetch kept going in the background and fills the cache
+            await asyncio.sleep(0.4)
+            self.assertEqual((await cache.get(34.05, -118.24, 'key'))['description'], 'clear sky')
+            self.assertEqual(server.requests, 1)
+            self.assertEqual(cache.metrics()['upstream_latency']['count'], 1)
+        self.run_with_server(test)
+
+    def test_realtime_metrics_endpoint(self):
+        client = APIClient()
+        client.force_authenticate(user=User.objects.create_user(username='trainer', password='testpass123'))
+        self.assertEqual(client.get('/api/pokemon/realtime_metrics/').status_code, status.HTTP_403_FORBIDDEN)
+
+        client.force_authenticate(user=User.objects.create_user(username='staff', password='testpass123', is_staff=True))
+        response = client.get('/api/pokemon/realtime_metrics/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['weather']['breaker']['state'], 'closed')
+        self.assertIn('p99_ms', response.data['weather']['upstream_latency'])
+        self.assertIn('connections', response.data['energy'])
+
+    def test_energy_consumer_uses_cached_weather(self):
+        pokemon = Pokemon.objects.create(name='Pikachu', latitude=34.0522, longitude=-118.2437)
+
+        async def test(server):
+            server.description = 'light rain'
+            with patch('apps.pokemon.energy.os.getenv', return_value='test_api_key'):
+                for _ in range(3):
+                    energy_data = await calculate_energy_level(pokemon)
+                    self.assertEqual(energy_data['factors']['weather'], 'light rain')
+            self.assertEqual(server.requests, 1)
+
+        weather_cache.clear()
+        self.run_with_server(test)
+
+
+# Energy engine tests
+class EventLoopLagTestCase(TestCase):
+    """CPU-bound energy work must not block the event loop"""
+
+    # far from every route, so each check walks all the segments
+    POINTS = [('Pikachu', 10.0 + i * 0.01, 20.0) for i in range(20)] + [('Abra', 10.0 + i * 0.01, 20.0) for i in range(20)]
+
+    def test_monitor_reports_blocking(self):
+        async def run_test():
+            monitor = LoopLagMonitor(interval=0.01)
+            monitor.ensure_running()
+            await asyncio.sleep(0.05)
+            time.sleep(0.2)
+            await asyncio.sleep(0.05)
+            await monitor.stop()
+            return monitor.metrics()
+        metrics = async_to_sync(run_test)()
+        self.assertGreaterEqual(metrics['lag']['max_ms'], 150)
+        self.assertGreater(metrics['lag']['count'], 5)
+
+    def test_route_checks_are_batched_off_the_loop(self):
+        pool = RouteProximityPool()
+        self.addCleanup(pool.shutdown)
+
+        async def run_test():
+            monitor = LoopLagMonitor(interval=0.005)
+            monitor.ensure_running()
+            await asyncio.sleep(0.02)
+            results = await asyncio.gather(*[pool.is_near_route(*point) for point in self.POINTS])
+            await asyncio.sleep(0.02)
+            await monitor.stop()
+            return results, monitor.metrics()
+
+        results, metrics = async_to_sync(run_test)()
+        expected = [is_point_near_polyline(lat, lon, get_polyline_for_pokemon(name)) for name, lat, lon in self.POINTS]
+        self.assertEqual(results, expected)
+        self.assertEqual(pool.metrics(), {'batches': 1, 'checks': 40, 'largest_batch': 40})
+        # the same checks inline take well over 100 ms
+        self.assertLess(metrics['lag']['max_ms'], 100)
+
+    @patch('apps.pokemon.energy.os.getenv', return_value=None)
+    def test_energy_ticks_do_not_block_the_loop(self, mock_getenv):
+        pokemon = [Pokemon(id=i, name=name, latitude=lat, longitude=lon) for i, (name, lat, lon) in enumerate(self.POINTS)]
+        batches = route_proximity.batches
+
+        async def run_test():
+            monitor = LoopLagMonitor(interval=0.005)
+            monitor.ensure_running()
+            await asyncio.sleep(0.02)
+            results = await asyncio.gather(*[calculate_energy_level(p) for p in pokemon])
+            await monitor.stop()
+            return results, monitor.metrics()
+
+        results, metrics = async_to_sync(run_test)()
+        self.assertTrue(all(result['energy_level'] == 85.0 for result in results))
+        self.assertEqual(route_proximity.batches - batches, 1)
+        self.assertLess(metrics['lag']['max_ms'], 100)
+
+
+class EnergySnapshotTestCase(TestCase):
+    """Batch energy engine and the map-wide energy_snapshot endpoint"""
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(user=User.objects.create_user(username='trainer', password='testpass123'))
+
+    def test_batch_matches_scalar_energy(self):
+        weather = [('light rain', 12.0), ('light snow', -4.0), ('clear sky', 35.0), ('Heavy Rain', 31.0), ('mist', 20.0)]
+        descriptions = [description for description, _ in weather]
+        near_route = [True, False, True, False, True]
+        energy = energy_batch(range(5), descriptions, [t for _, t in weather], near_route, rng=np.random.default_rng(7))
+
+        draws = list(np.random.default_rng(7).uniform(0.8, 1.2, 5))
+        with patch('apps.pokemon.energy.random.uniform', side_effect=draws):
+            expected = [
+                calculate_energy_based_on_weather(description, temperature, 1.0 if near else 0.85, near)['energy_level']
+                for (description, temperature), near in zip(weather, near_route)
+            ]
+        np.testing.assert_allclose(energy, expected)
+
+    def test_batch_without_weather_uses_default(self):
+        energy = energy_batch([0, 0], [''], [np.nan, np.nan], [True, False])
+        self.assertEqual(energy.tolist(), [100.0, 85.0])
+
+    def test_batch_route_check_matches_polyline_check(self):
+        line = get_polyline_for_pokemon('Pikachu')['coordinates'][0]
+        points = [('Pikachu', lat + offset, lon) for lon, lat in line[:40:4] for offset in (0.0, 0.005, 0.02)]
+        points += [('Abra', 10.0, 20.0), ('Zubat', 34.05, -118.24)]
+        expected = [is_point_near_polyline(lat, lon, get_polyline_for_pokemon(name)) for name, lat, lon in points]
+        self.assertEqual(near_route_batch(*zip(*points)).tolist(), expected)
+        self.assertIn(True, expected)
+        self.assertIn(False, expected)
+
+    def test_energy_snapshot_endpoint(self):
+        inside = Pokemon.objects.create(name='Pikachu', latitude=34.05, longitude=-118.24)
+        rainy = Pokemon.objects.create(name='Bulbasaur', latitude=34.5, longitude=-118.5)
+        Pokemon.objects.create(name='Charmander', latitude=40.7, longitude=-74.0)
+
+        def peek(latitude, longitude):
+            return {'description': 'light rain', 'temperature': 15.0} if latitude == 34.5 else None
+
+        with patch.object(weather_cache, 'peek', side_effect=peek):
+            response = self.client.get('/api/pokemon/energy_snapshot/?bbox=-119,34,-118,35&seed=3')
+            again = self.client.get('/api/pokemon/energy_snapshot/?bbox=-119,34,-118,35&seed=3')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['count'], 2)
+        self.assertFalse(response.data['truncated'])
+        levels = dict(zip(response.data['ids'], response.data['energy_levels']))
+        self.assertEqual(set(levels), {inside.id, rainy.id})
+        near = dict(zip(response.data['ids'], response.data['near_route']))
+        # no cached weather: the default energy, no variance
+        self.assertEqual(levels[inside.id], 100.0 if near[inside.id] else 85.0)
+        self.assertLessEqual(levels[rainy.id], 100 * 0.8 * 1.2)
+        self.assertEqual(again.data, response.data)
+
+    def test_energy_snapshot_validates_bbox(self):
+        for query in ('', '?bbox=1,2,3', '?bbox=a,b,c,d', '?bbox=0,10,1,5', '?bbox=0,0,1,1&seed=x'):
+            response = self.client.get(f'/api/pokemon/energy_snapshot/{query}')
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, query)
+
+    @override_settings(POKEMON_ENERGY_SNAPSHOT_LIMIT=2)
+    def test_energy_snapshot_limit_and_antimeridian(self):
+        for longitude in (179.5, -179.5, 179.9, 0.0):
+            Pokemon.objects.create(name='Mew', latitude=0.0, longitude=longitude)
+        response = self.client.get('/api/pokemon/energy_snapshot/?bbox=179,-1,-179,1')
+        self.assertEqual(response.data['count'], 2)
+        self.assertTrue(response.data['truncated'])
+
+
+class PokemonStateCacheTestCase(TestCase):
+    """In-process LRU of the energy-relevant Pokemon state"""
+
+    def setUp(self):
+        self.pokemon = Pokemon.objects.create(
+            name='Pikachu', latitude=34.0522, longitude=-118.2437, stats={'hp': 35}, abilities=['static']
+        )
+
+    def test_concurrent_misses_share_one_narrow_query(self):
+        cache = PokemonStateCache()
+
+        async def run_test():
+            return await asyncio.gather(*[cache.get(self.pokemon.id) for _ in range(20)])
+
+        with CaptureQueriesContext(connection) as queries:
+            states = async_to_sync(run_test)()
+            again = async_to_sync(cache.get)(self.pokemon.id)
+        self.assertEqual(len(queries), 1)
+        self.assertNotIn('stats', queries[0]['sql'])
+        self.assertTrue(all(state is states[0] for state in states))
+        self.assertIs(again, states[0])
+        self.assertEqual((again.name, again.latitude, again.longitude), ('Pikachu', 34.0522, -118.2437))
+        self.assertEqual(cache.metrics()['hits'], 1)
+
+    def test_get_many_and_unknown_ids(self):
+        other = Pokemon.objects.create(name='Abra', latitude=1.0, longitude=2.0)
+        cache = PokemonStateCache()
+        async_to_sync(cache.get)(self.pokemon.id)
+        with CaptureQueriesContext(connection) as queries:
+            states = async_to_sync(cache.get_many)({self.pokemon.id, other.id, 999999})
+        self.assertEqual(len(queries), 1)
+        self.assertEqual({state.id for state in states}, {self.pokemon.id, other.id})
+        self.assertIsNone(async_to_sync(cache.get)(999999))
+        self.assertIsNone(cache.peek(999999))
+
+    def test_least_recently_used_is_evicted(self):
+        others = [Pokemon.objects.create(name=f'Pokemon {i}', latitude=i, longitude=i) for i in range(2)]
+        cache = PokemonStateCache(maxsize=2)
+        for pokemon in (self.pokemon, others[0], self.pokemon, others[1]):
+            async_to_sync(cache.get)(pokemon.id)
+        self.assertIsNotNone(cache.peek(self.pokemon.id))
+        self.assertIsNone(cache.peek(others[0].id))
+        self.assertEqual(cache.metrics()['size'], 2)
+
+    def test_save_and_delete_invalidate(self):
+        state = async_to_sync(pokemon_states.get)(self.pokemon.id)
+        self.assertEqual(state.latitude, 34.0522)
+
+        self.pokemon.latitude = 40.0
+        self.pokemon.save()
+        self.assertIsNone(pokemon_states.peek(self.pokemon.id))
+        self.assertEqual(async_to_sync(pokemon_states.get)(self.pokemon.id).latitude, 40.0)
+
+        pokemon_id = self.pokemon.id
+        self.pokemon.delete()
+        self.assertIsNone(async_to_sync(pokemon_states.get)(pokemon_id))
+
+    def test_load_before_commit_is_dropped_on_commit(self):
+        # another worker loading between the save and the commit would cache the old row
+        with self.captureOnCommitCallbacks(execute=True):
+            self.pokemon.latitude = 40.0
+            self.pokemon.save()
+            async_to_sync(pokemon_states.get)(self.pokemon.id)
+            self.assertIsNotNone(pokemon_states.peek(self.pokemon.id))
+        self.assertIsNone(pokemon_states.peek(self.pokemon.id))
+
+    def test_load_racing_an_invalidation_is_not_stored(self):
+        cache = PokemonStateCache()
+        fetch_rows = cache.fetch_rows
+
+        async def fetch_then_invalidate(ids):
+            rows = await fetch_rows(ids)
+            cache.invalidate(self.pokemon.id)
+            return rows
+
+        with patch.object(cache, 'fetch_rows', side_effect=fetch_then_invalidate):
+            self.assertIsNotNone(async_to_sync(cache.get)(self.pokemon.id))
+        self.assertIsNone(cache.peek(self.pokemon.id))
+
+    @patch('apps.pokemon.energy.calculate_energy_level')
+    def test_moved_pokemon_ticks_from_new_position(self, mock_calculate):
+        async def fake_calculate(pokemon):
+            return {'energy_level': pokemon.latitude, 'factors': {}}
+        mock_calculate.side_effect = fake_calculate
+        interval = energy_scheduler.interval
+        energy_scheduler.interval = 0.05
+        self.addCleanup(setattr, energy_scheduler, 'interval', interval)
+
+        @database_sync_to_async
+        def move():
+            self.pokemon.latitude = 50.0
+            self.pokemon.save()
+
+        async def run_test():
+            communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), f'ws/pokemon/{self.pokemon.id}/energy/')
+            await communicator.connect()
+            self.assertEqual((await communicator.receive_json_from(timeout=1))['energy_level'], 34.0522)
+            await move()
+            for _ in range(5):
+                if (await communicator.receive_json_from(timeout=1))['energy_level'] == 50.0:
+                    break
+            else:
+                self.fail('tick kept the old coordinates')
+            await communicator.disconnect()
+        async_to_sync(run_test)()
+
+
+class EnergyTickClockTestCase(TestCase):
+    """Tick interval/jitter from settings or per route, driven by a virtual clock"""
+
+    def setUp(self):
+        self.pokemon = Pokemon.objects.create(name='Pikachu', latitude=34.0522, longitude=-118.2437)
+        self.clock = VirtualClock()
+
+    def make_router(self, scheduler):
+        return URLRouter([
+            re_path(r'ws/pokemon/(?P<pokemon_id>\d+)/energy/$', PokemonEnergyConsumer.as_asgi(scheduler=scheduler)),
+            re_path(r'ws/pokemon/energy/$', EnergySubscriptionsConsumer.as_asgi(scheduler=scheduler)),
+        ])
+
+    def ticking(self, mock_calculate):
+        ticks = iter(range(1000))
+
+        async def fake_calculate(pokemon):
+            return {'energy_level': float(next(ticks)), 'factors': {}}
+        mock_calculate.side_effect = fake_calculate
+
+    @patch('apps.pokemon.energy.calculate_energy_level')
+    def test_many_ticks_in_virtual_time(self, mock_calculate):
+        self.ticking(mock_calculate)
+        scheduler = EnergyScheduler(interval=5.0, clock=self.clock, sleep=self.clock.sleep, name='virtual')
+
+        async def run_test():
+            communicator = WebsocketCommunicator(self.make_router(scheduler), f'ws/pokemon/{self.pokemon.id}/energy/')
+            await communicator.connect()
+            self.assertEqual((await communicator.receive_json_from(timeout=1))['energy_level'], 0.0)
+            for tick in range(1, 21):
+                # more frames than the ack window, so acknowledged like the frontend does
+                await communicator.send_json_to({'action': 'ack'})
+                await self.clock.advance(5.0)
+                self.assertEqual((await communicator.receive_json_from(timeout=1))['energy_level'], float(tick))
+            # nothing is due between boundaries
+            await self.clock.advance(4.9)
+            self.assertTrue(await communicator.receive_nothing(timeout=0.05))
+            # the default scheduler and its groups are untouched
+            self.assertEqual(energy_scheduler.active_pokemon, set())
+            await communicator.disconnect()
+            self.assertEqual(self.clock.sleepers, 0)
+
+        started = time.perf_counter()
+        async_to_sync(run_test)()
+        # 100 virtual seconds
+        self.assertLess(time.perf_counter() - started, 5)
+        self.assertEqual(mock_calculate.call_count, 21)
+
+    @patch('apps.pokemon.energy.random.uniform', return_value=0.5)
+    @patch('apps.pokemon.energy.calculate_energy_level')
+    def test_jitter_delays_ticks(self, mock_calculate, mock_uniform):
+        self.ticking(mock_calculate)
+        scheduler = EnergyScheduler(interval=5.0, jitter=1.0, clock=self.clock, sleep=self.clock.sleep, name='jittered')
+
+        async def run_test():
+            communicator = WebsocketCommunicator(self.make_router(scheduler), f'ws/pokemon/{self.pokemon.id}/energy/')
+            await communicator.connect()
+            await communicator.receive_json_from(timeout=1)
+            await self.clock.advance(5.0)
+            self.assertTrue(await communicator.receive_nothing(timeout=0.05))
+            await self.clock.advance(0.5)
+            self.assertEqual((await communicator.receive_json_from(timeout=1))['energy_level'], 1.0)
+            await communicator.disconnect()
+
+        async_to_sync(run_test)()
+        mock_uniform.assert_called_with(0, 1.0)
+
+    @patch('apps.pokemon.energy.calculate_energy_level')
+    def test_multiplexed_socket_on_a_route_scheduler(self, mock_calculate):
+        self.ticking(mock_calculate)
+        scheduler = EnergyScheduler(interval=1.0, clock=self.clock, sleep=self.clock.sleep, name='fast')
+
+        async def run_test():
+            communicator = WebsocketCommunicator(self.make_router(scheduler), 'ws/pokemon/energy/')
+            await communicator.connect()
+            await communicator.send_json_to({'action': 'subscribe', 'ids': [self.pokemon.id]})
+            messages = [await communicator.receive_json_from(timeout=1) for _ in range(2)]
+            self.assertEqual({message['type'] for message in messages}, {'subscribed', 'energy'})
+            for _ in range(3):
+                await self.clock.advance(1.0)
+                message = await communicator.receive_json_from(timeout=1)
+                self.assertIn(str(self.pokemon.id), message['frames'])
+            await communicator.disconnect()
+
+        async_to_sync(run_test)()
+
+    @override_settings(POKEMON_ENERGY_INTERVAL=2.0, POKEMON_ENERGY_JITTER=0.25)
+    def test_interval_and_jitter_from_settings(self):
+        scheduler = EnergyScheduler()
+        self.assertEqual((scheduler.interval, scheduler.jitter), (2.0, 0.25))
+        self.assertEqual(scheduler.effective_interval(), 2.0)
+        self.assertEqual(EnergyScheduler(interval=1.0).interval, 1.0)
+
+
+class EnergyHistoryTestCase(TestCase):
+    """Ring-buffered energy history: bounds, downsampling, endpoint and backfill on connect"""
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(user=User.objects.create_user(username='trainer', password='testpass123'))
+        self.pokemon = Pokemon.objects.create(name='Pikachu', latitude=34.0522, longitude=-118.2437)
+        self.clock = VirtualClock()
+        energy_history.clear()
+
+    def tearDown(self):
+        energy_history.clear()
+
+    def test_ring_keeps_the_latest_readings(self):
+        ring = EnergyRing(4)
+        for i in range(6):
+            ring.append(1000.0 + i, float(i))
+        timestamps, values = ring.ordered()
+        self.assertEqual(timestamps.tolist(), [1002.0, 1003.0, 1004.0, 1005.0])
+        self.assertEqual(values.tolist(), [2.0, 3.0, 4.0, 5.0])
+        self.assertEqual(ring.nbytes, 4 * 12)
+
+    def test_memory_is_bounded(self):
+        history = EnergyHistory(capacity=10, max_pokemon=3)
+        for pokemon_id in range(5):
+            for i in range(50):
+                history.record(pokemon_id, 1000.0 + i, 50.0)
+        # the least recently ticked Pokemon go first
+        self.assertEqual(len(history.readings(0)[0]), 0)
+        self.assertEqual(len(history.readings(4)[0]), 10)
+        self.assertEqual(history.metrics(), {
+            'pokemon': 3, 'max_pokemon': 3, 'readings_per_pokemon': 10, 'bytes_per_pokemon': 120, 'bytes': 360,
+        })
+        history.forget(4)
+        self.assertEqual(history.metrics()['pokemon'], 2)
+
+    def test_downsample_buckets(self):
+        history = EnergyHistory(capacity=100)
+        for second, energy in [(1, 10.0), (2, 30.0), (5, 50.0), (25, 70.0), (29, 90.0)]:
+            history.record(1, 1000.0 + second, energy)
+        series = history.downsample(1, window=30, resolution=10, now=1030.0)
+        # the 10-20 s bucket has no readings
+        self.assertEqual(series['timestamps'], [1000.0, 1020.0])
+        self.assertEqual(series['min'], [10.0, 70.0])
+        self.assertEqual(series['max'], [50.0, 90.0])
+        self.assertEqual(series['mean'], [30.0, 80.0])
+        self.assertEqual(series['count'], [3, 2])
+        self.assertEqual(history.downsample(2, window=30, resolution=10, now=1030.0)['count'], [])
+
+    def test_endpoint(self):
+        now = time.time()
+        for seconds_ago in (50, 40, 5):
+            energy_history.record(self.pokemon.id, now - seconds_ago, 100.0 - seconds_ago)
+        url = f'/api/pokemon/{self.pokemon.id}/energy_history/'
+        response = self.client.get(url, {'window': 60, 'resolution': 30})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['pokemon_id'], self.pokemon.id)
+        self.assertEqual(response.data['count'], [2, 1])
+        self.assertEqual(response.data['min'], [50.0, 95.0])
+        self.assertEqual(response.data['max'], [60.0, 95.0])
+        # default window is the last hour in 60 buckets
+        response = self.client.get(url)
+        self.assertEqual((response.data['window'], response.data['resolution']), (3600.0, 60.0))
+        self.assertEqual(sum(response.data['count']), 3)
+
+        for params in ({'window': 'soon'}, {'window': -1}, {'resolution': 0}, {'window': 3600, 'resolution': 1},
+                       {'window': 'inf'}, {'window': 10, 'resolution': 'inf'}, {'window': 'nan'},
+                       {'window': 1e-300, 'resolution': 1e300}):
+            self.assertEqual(self.client.get(url, params).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.client.get('/api/pokemon/999999/energy_history/').status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_deleted_pokemon_history_is_dropped(self):
+        energy_history.record(self.pokemon.id, time.time(), 50.0)
+        self.pokemon.delete()
+        self.assertEqual(energy_history.metrics()['pokemon'], 0)
+
+    @patch('apps.pokemon.energy.calculate_energy_level')
+    def test_ticks_are_recorded_and_sent_as_backfill(self, mock_calculate):
+        ticks = iter(range(1000))
+
+        async def fake_calculate(pokemon):
+            return {'energy_level': float(next(ticks)), 'factors': {}}
+        mock_calculate.side_effect = fake_calculate
+        scheduler = EnergyScheduler(interval=5.0, clock=self.clock, sleep=self.clock.sleep, name='history')
+        router = URLRouter([
+            re_path(r'ws/pokemon/(?P<pokemon_id>\d+)/energy/$', PokemonEnergyConsumer.as_asgi(scheduler=scheduler)),
+            re_path(r'ws/pokemon/energy/$', EnergySubscriptionsConsumer.as_asgi(scheduler=scheduler)),
+        ])
+
+        async def run_test():
+            first = WebsocketCommunicator(router, f'ws/pokemon/{self.pokemon.id}/energy/')
+            await first.connect()
+            # nothing recorded yet, so no history message
+            self.assertEqual((await first.receive_json_from(timeout=1))['energy_level'], 0.0)
+            for _ in range(3):
+                await self.clock.advance(5.0)
+                await first.receive_json_from(timeout=1)
+
+            late = WebsocketCommunicator(router, f'ws/pokemon/{self.pokemon.id}/energy/')
+            await late.connect()
+            history = await late.receive_json_from(timeout=1)
+            self.assertEqual(history['type'], 'history')
+            self.assertEqual(history['series'][str(self.pokemon.id)]['energy_levels'], [0.0, 1.0, 2.0, 3.0])
+            self.assertEqual((await late.receive_json_from(timeout=1))['energy_level'], 3.0)
+
+            # binary sockets get the burst as JSON text after their hello
+            binary = WebsocketCommunicator(
+                router, f'ws/pokemon/{self.pokemon.id}/energy/', subprotocols=[BINARY_SUBPROTOCOL]
+            )
+            await binary.connect()
+            self.assertEqual(unpack_frame(await binary.receive_from(timeout=1))['type'], 'hello')
+            self.assertEqual((await binary.receive_json_from(timeout=1))['type'], 'history')
+
+            off = WebsocketCommunicator(router, f'ws/pokemon/{self.pokemon.id}/energy/?backfill=0')
+            await off.connect()
+            self.assertEqual((await off.receive_json_from(timeout=1))['energy_level'], 3.0)
+
+            multiplexed = WebsocketCommunicator(router, 'ws/pokemon/energy/')
+            await multiplexed.connect()
+            await multiplexed.send_json_to({'action': 'subscribe', 'ids': [self.pokemon.id]})
+            messages = [await multiplexed.receive_json_from(timeout=1) for _ in range(3)]
+            self.assertEqual({message['type'] for message in messages}, {'subscribed', 'history', 'energy'})
+
+            for communicator in (first, late, binary, off, multiplexed):
+                await communicator.disconnect()
+
+        async_to_sync(run_test)()
+        self.assertEqual(len(energy_history.readings(self.pokemon.id)[0]), 4)
+
+
+# Live map update tests
+class MapUpdatesTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='testuser',
+            password='testpass123'
+        )
+        self.pokemon = Pokemon.objects.create(
+            name='Pikachu',
+            latitude=34.0522,
+            longitude=-118.2437,
+            type_primary='electric',
+            sprite='https://example.com/25.png',
+            source='API'
+        )
+    
+    def get_communicator(self):
+        application = URLRouter(websocket_urlpatterns)
+        return WebsocketCommunicator(application, 'ws/pokemon/map/')
+    
+    def test_writes_are_broadcast_as_one_batch(self):
+        pikachu_id = self.pokemon.id
+        
+        def write():
+            with map_broadcaster.batch():
+                with self.captureOnCommitCallbacks(execute=True):
+                    for i in range(3):
+                        Pokemon.objects.create(
+                            name=f'Ditto{i}',
+                            latitude=34.0,
+                            longitude=-118.0,
+                            type_primary='normal',
+                            sprite='https://example.com/132.png',
+                            source='CSV'
+                        )
+                    ditto = Pokemon.objects.get(name='Ditto0')
+                    ditto.latitude = 35.0
+                    ditto.save()
+                    self.pokemon.delete()
+        
+        async def run_test():
+            communicator = self.get_communicator()
+            connected, subprotocol = await communicator.connect()
+            self.assertTrue(connected)
+            
+            await database_sync_to_async(write)()
+            
+            message = await communicator.receive_json_from(timeout=5)
+            self.assertEqual(message['type'], 'changes')
+            self.assertEqual(sorted(pokemon['name'] for pokemon in message['upserts']), ['Ditto0', 'Ditto1', 'Ditto2'])
+            # coalesced: the later update replaced the create event
+            ditto = next(pokemon for pokemon in message['upserts'] if pokemon['name'] == 'Ditto0')
+            self.assertEqual(ditto['latitude'], 35.0)
+            self.assertEqual(message['deletions'], [pikachu_id])
+            self.assertTrue(await communicator.receive_nothing(timeout=0.1))
+            
+            await communicator.disconnect()
+        
+        async_to_sync(run_test)()
+    
+    def test_csv_upload_is_broadcast_as_one_message(self):
+        client = APIClient()
+        client.force_authenticate(user=self.user)
+        rows = ''.join(f'\nPokemon{i},34.1,-118.9,Psychic,Floaroma Town,"[]",https://example.com/{i}.png' for i in range(50))
+        csv_content = ('Pokemon,Lat,Long,Type,Location,Moves,Sprite' + rows).encode()
+        
+        def upload():
+            with self.captureOnCommitCallbacks(execute=True):
+                csv_file = SimpleUploadedFile('test.csv', csv_content, content_type='text/csv')
+                response = client.post('/api/pokemon/upload_from_csv/', {'file': csv_file}, format='multipart')
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        
+        async def run_test():
+            communicator = self.get_communicator()
+            connected, subprotocol = await communicator.connect()
+            self.assertTrue(connected)
+            
+            await database_sync_to_async(upload)()
+            
+            message = await communicator.receive_json_from(timeout=5)
+            self.assertEqual(len(message['upserts']), 50)
+            self.assertTrue(await communicator.receive_nothing(timeout=0.1))
+            
+            await communicator.disconnect()
+        
+        async_to_sync(run_test)()
+    
+    def test_rolled_back_writes_are_not_broadcast(self):
+        def write():
+            # no commit callbacks run for this write (the test transaction rolls back)
+            Pokemon.objects.create(
+                name='Missingno',
+                latitude=34.0,
+                longitude=-118.0,
+                type_primary='bird',
+                sprite='https://example.com/0.png',
+                source='CSV'
+            )
+        
+        async def run_test():
+            communicator = self.get_communicator()
+            connected, subprotocol = await communicator.connect()
+            self.assertTrue(connected)
+            
+            await database_sync_to_async(write)()
+            self.assertTrue(await communicator.receive_nothing(timeout=0.1))
+            
+            await communicator.disconnect()
+        
+        async_to_sync(run_test)()
+    
+# Query plan tests
+class QueryPlanTestCase(TestCase):
+    """Run EXPLAIN QUERY PLAN over every query the viewsets issue"""
+    
+    # SQLite reports a full table scan as a bare "SCAN <table>" (no index), "SCAN TABLE <table>" before 3.36
+    FULL_SCAN = re.compile(r'^SCAN (TABLE )?\w+$')
+    
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='testuser',
+            password='testpass123'
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+        
+        for i, (name, type_primary, source, moves) in enumerate([
+            ('Bulbasaur', 'grass', 'API', ['vine-whip', 'tackle']),
+            ('Squirtle', 'water', 'API', ['water-gun', 'tackle']),
+            ('Mew', 'psychic', 'CSV', ['psychic']),
+            ('Psyduck', 'water', 'CSV', ['water-gun', 'confusion']),
+        ]):
+            pokemon = Pokemon.objects.create(
+                name=name,
+                latitude=34.0 + i,
+                longitude=-118.0 - i,
+                type_primary=type_primary,
+                category=name.lower(),
+                moves=moves,
+                abilities=['damp'] if type_primary == 'water' else [],
+                stats={'hp': 40 + i, 'attack': 50 + 10 * i, 'speed': 90 - 10 * i},
+                sprite='https://example.com/sprite.png',
+                source=source,
+                uploaded_by=self.user if source == 'CSV' else None
+            )
+            sync_moves_and_abilities([pokemon])
+        self.pokemon = Pokemon.objects.get(name='Mew')
+    
+    def explain(self, sql):
+        """Return the detail column of EXPLAIN QUERY PLAN for a captured query"""
+        with connection.cursor() as cursor:
+            cursor.execute(f'EXPLAIN QUERY PLAN {sql}')
+            return [row[-1] for row in cursor.fetchall()]
+    
+    def assertQueriesUseIndexes(self, method, url, allow_bounded_sort=False):
+        """Issue a request and fail if any query full-scans a table or sorts in a temp B-tree
+        
+        allow_bounded_sort accepts a temp B-tree only when every table is reached through an
+        index SEARCH, i.e. the sort covers the rows an index range selected, never the whole table.
+        """
+        with CaptureQueriesContext(connection) as context:
+            response = getattr(self.client, method)(url)
+            # streamed bodies run their queries while being consumed
+            body = b''.join(response.streaming_content) if response.streaming else response.content
+        self.assertLess(response.status_code, 400, body)
+        
+        checked = 0
+        for query in context.captured_queries:
+            sql = query['sql']
+            if not sql.lstrip().upper().startswith(('SELECT', 'UPDATE', 'DELETE')):
+                continue
+            details = self.explain(sql)
+            bounded = allow_bounded_sort and not any(detail.startswith('SCAN ') for detail in details)
+            for detail in details:
+                self.assertIsNone(self.FULL_SCAN.match(detail), f'{url}: full scan ({detail}) in {sql}')
+                if not bounded:
+                    self.assertNotIn('TEMP B-TREE', detail, f'{url}: temp B-tree sort in {sql}')
+            checked += 1
+        self.assertGreater(checked, 0)
+    
+    def test_list_query_plans(self):
+        self.assertQueriesUseIndexes('get', '/api/pokemon/')
+        self.assertQueriesUseIndexes('get', '/api/pokemon/?page=1')
+    
+    def test_source_filter_query_plans(self):
+        self.assertQueriesUseIndexes('get', '/api/pokemon/?source=csv')
+        self.assertQueriesUseIndexes('get', '/api/pokemon/?source=api&search=water')
+    
+    def test_search_query_plans(self):
+        self.assertQueriesUseIndexes('get', '/api/pokemon/?search=water')
+        self.assertQueriesUseIndexes('get', '/api/pokemon/?search=squirtle')
+    
+    def test_move_ability_filter_query_plans(self):
+        self.assertQueriesUseIndexes('get', '/api/pokemon/?move=water-gun')
+        self.assertQueriesUseIndexes('get', '/api/pokemon/?ability=damp&source=csv')
+    
+    def test_stat_filter_query_plans(self):
+        # a range on one column ordered by another sorts the rows the range index selected
+        self.assertQueriesUseIndexes('get', '/api/pokemon/?stat_attack__gte=60', allow_bounded_sort=True)
+        self.assertQueriesUseIndexes('get', '/api/pokemon/?stat_attack__gte=60&ordering=-stat_attack')
+        self.assertQueriesUseIndexes('get', '/api/pokemon/?ordering=-stat_total')
+        self.assertQueriesUseIndexes('get', '/api/pokemon/?stat_speed__gt=70&ordering=-stat_speed')
+    
+    def test_export_query_plans(self):
+        self.assertQueriesUseIndexes('get', '/api/pokemon/export/?format=ndjson')
+        self.assertQueriesUseIndexes('get', '/api/pokemon/export/?format=csv&source=csv')
+    
+    def test_sparse_fields_query_plans(self):
+        self.assertQueriesUseIndexes('get', '/api/pokemon/?fields=id,name,sprite')
+        self.assertQueriesUseIndexes('get', '/api/pokemon/all_for_map/?omit=moves,stats')
+    
+    def test_detail_query_plans(self):
+        self.assertQueriesUseIndexes('get', f'/api/pokemon/{self.pokemon.id}/')
+    
+    def test_favorites_query_plans(self):
+        self.assertQueriesUseIndexes('post', f'/api/pokemon/{self.pokemon.id}/favorite/')
+        self.assertQueriesUseIndexes('get', '/api/pokemon/favorites/')
+        self.assertQueriesUseIndexes('post', f'/api/pokemon/{self.pokemon.id}/favorite/')
+    
+    def test_map_snapshot_query_plans(self):
+        shared_map_snapshot.invalidate()
+        self.assertQueriesUseIndexes('get', '/api/pokemon/map_snapshot/')
+        self.assertQueriesUseIndexes('get', '/api/pokemon/favorite_ids/')
+    
+    def test_changes_query_plans(self):
+        Pokemon.objects.get(name='Squirtle').delete()
+        self.assertQueriesUseIndexes('get', '/api/pokemon/changes/?since=0')
+        # a recent cursor, older ones resync
+        since = encode_change_cursor(timezone.now() - timedelta(minutes=5))
+        self.assertQueriesUseIndexes('get', f'/api/pokemon/changes/?since={since}')
+    
+    def test_energy_snapshot_query_plans(self):
+        # through pokemon_location_idx, also when the box crosses the antimeridian
+        self.assertQueriesUseIndexes('get', '/api/pokemon/energy_snapshot/?bbox=-122,33,-117,36&seed=1')
+        self.assertQueriesUseIndexes('get', '/api/pokemon/energy_snapshot/?bbox=170,33,-117,36&seed=1')
+    
+    def test_all_for_map_query_plans(self):
+        self.assertQueriesUseIndexes('get', '/api/pokemon/all_for_map/')
+        self.assertQueriesUseIndexes('get', '/api/pokemon/all_for_map/?format=columnar')
+    
+    def test_delete_query_plans(self):
+        FavoritePokemon.objects.create(user=self.user, pokemon=self.pokemon)
+        self.assertQueriesUseIndexes('delete', f'/api/pokemon/{self.pokemon.id}/')
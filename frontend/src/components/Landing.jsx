@@ -58,6 +58,10 @@ function Landing({ allPokemon = [], loadingPokemon = false, onPokemonUpdate }) {
       
       ws.onmessage = (event) => {
         const data = JSON.parse(event.data);
+        // the server holds frames back until earlier ones are acknowledged
+        if (data.type !== 'history') {
+          ws.send(JSON.stringify({ action: 'ack' }));
+        }
         if (data.energy_level !== undefined) {
           setEnergyLevel(data.energy_level);
           setEnergyTimestamp(data.timestamp);